@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Spread of centrals over several adapters. Runs the hub against the mock
+org.bluez of harness.py with --adapters controllers, connects --centrals
+centrals one after the other, each to one of the adapters advertising at
+the time, and prints how many each adapter got, and the busiest
+adapter's share against what connecting at random to any adapter would
+give (averaged over TRIALS draws). Then adds an adapter and removes
+one while the hub runs, timing how long it takes to serve the new one.
+
+    python3 bench/adapters.py [--backend glib|aio] [--adapters N]
+                              [--centrals N]
+
+"""
+
+import argparse
+import asyncio
+import collections
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from dbus_next.aio import MessageBus
+
+from harness import SRC, start_bus, wait_registered
+from mock_bluez import MockBluez
+
+# Time the hub gets to rebalance between two connections.
+SETTLE_S = 0.05
+TRIALS = 1000
+
+
+async def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise RuntimeError('timed out')
+        await asyncio.sleep(0.005)
+
+
+def spread(counts, adapters):
+    return ' '.join('%d' % counts.get(adapter.path, 0)
+                    for adapter in adapters)
+
+
+def random_busiest(adapters, centrals):
+    total = 0
+    for _ in range(TRIALS):
+        counts = collections.Counter(random.randrange(adapters)
+                                     for _ in range(centrals))
+        total += max(counts.values())
+    return total / float(TRIALS)
+
+
+async def run(args, address):
+    bus = await MessageBus(bus_address=address).connect()
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    kinds = set()
+
+    def on_registered(reg):
+        kinds.add(reg.kind)
+        if len(kinds) == 2 and not ready.done():
+            ready.set_result(None)
+
+    mock = MockBluez(bus, adapters=args.adapters,
+                     on_registered=on_registered)
+    await mock.start()
+    env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS=address,
+               HUB_LOG_LEVEL='WARNING')
+    hub = subprocess.Popen([sys.executable, os.path.join(SRC, 'main.py'),
+                            '--backend', args.backend,
+                            '--wifi-backend', 'stub'], env=env)
+    try:
+        await wait_registered(hub, ready, 30)
+        await wait_for(lambda: all(a.applications for a in mock.adapters))
+        await asyncio.sleep(SETTLE_S)
+
+        balanced = collections.Counter()
+        for _ in range(args.centrals):
+            device = mock.connect()
+            if device is None:
+                break
+            balanced[device.rsplit('/', 1)[0]] += 1
+            await asyncio.sleep(SETTLE_S)
+        print('centrals per adapter, %d of %d connected on %d adapters: '
+              '%s' % (sum(balanced.values()), args.centrals, args.adapters,
+                      spread(balanced, mock.adapters)))
+        print('busiest adapter: %d balanced, %.2f at random' % (
+                max(balanced.values()),
+                random_busiest(args.adapters, args.centrals)))
+
+        start = time.perf_counter()
+        adapter = mock.add_adapter()
+        await wait_for(lambda: adapter.applications and
+                       adapter.advertisements)
+        print('added %s: application and advertisement in %.1f ms' % (
+                adapter.path, (time.perf_counter() - start) * 1000))
+        device = mock.connect()
+        print('next central went to %s' % device.rsplit('/', 1)[0])
+
+        removed = mock.adapters[0]
+        mock.remove_adapter(removed)
+        await asyncio.sleep(SETTLE_S)
+        if hub.poll() is not None:
+            raise RuntimeError('hub exited after removing an adapter')
+        print('removed %s, advertising on: %s' % (removed.path, ', '.join(
+                a.path for a in mock.adapters if a.advertisements)))
+    finally:
+        hub.send_signal(signal.SIGINT)
+        try:
+            hub.wait(5)
+        except subprocess.TimeoutExpired:
+            hub.kill()
+        bus.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=('glib', 'aio'), default='aio')
+    parser.add_argument('--adapters', type=int, default=3)
+    parser.add_argument('--centrals', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        daemon, address = start_bus(tmpdir)
+        try:
+            asyncio.run(run(args, address))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Latency of the audio engine: time from play() to the first period of the
+clip written to a (real time paced) null sink, for clips already decoded
+and for clips decoded on demand, with 'overlap' clips playing at once.
+Also prints the decode time and cache hit rate the engine reports.
+
+The clips are those of hub/storage/audios when ffmpeg or mpg123 can
+decode them, and generated WAV tones otherwise.
+
+    python3 bench/audio.py [--plays N] [--overlap N]
+
+"""
+
+import argparse
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import wave
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import audio
+from storage import STORAGE_ROOT, Storage
+
+
+def tone(path, seconds, freq):
+    samples = array('h', [int(8000 * math.sin(2 * math.pi * freq * i /
+                                              audio.SAMPLE_RATE))
+                          for i in range(int(seconds * audio.SAMPLE_RATE))])
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(audio.SAMPLE_WIDTH)
+        f.setframerate(audio.SAMPLE_RATE)
+        f.writeframes(samples.tobytes())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--plays', type=int, default=50)
+    parser.add_argument('--overlap', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        storage = Storage(root)
+        os.makedirs(storage.resolve(audio.AUDIO_DIR))
+        if any(shutil.which(command[0]) for command in audio.DECODERS):
+            source = os.path.join(STORAGE_ROOT, audio.AUDIO_DIR)
+            for name in os.listdir(source):
+                shutil.copy(os.path.join(source, name),
+                            storage.resolve(audio.AUDIO_DIR))
+        else:
+            for i in range(3):
+                tone(storage.resolve('%s/tone%d.wav' % (audio.AUDIO_DIR, i)),
+                     0.5 + i, 220 * (i + 1))
+        clips = ['%s/%s' % (audio.AUDIO_DIR, name) for name in
+                 sorted(os.listdir(storage.resolve(audio.AUDIO_DIR)))]
+
+        engine = audio.AudioEngine(storage, audio.NullSink())
+        engine.start()
+        for clip in clips:
+            # Waits for the preload to finish.
+            engine.play(clip).wait()
+        engine.stop_all()
+        print('clips=%d, preloaded: %s' % (len(clips), engine.stats()))
+
+        engine.latencies.clear()
+        for _ in range(args.plays):
+            voices = [engine.play(random.choice(clips))
+                      for _ in range(args.overlap)]
+            time.sleep(0.05)
+            engine.stop_all()
+            for voice in voices:
+                voice.wait()
+        stats = engine.stats()
+        print('cached: p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+                stats['latency_p50_ms'], stats['latency_p99_ms'],
+                stats['latency_max_ms']))
+
+        # On demand: an empty cache, so every play waits for its decode.
+        engine.cache.entries.clear()
+        engine.cache.size = 0
+        start = time.perf_counter()
+        voice = engine.play(clips[-1])
+        while voice.pos == 0 and not voice.finished.is_set():
+            time.sleep(0.0005)
+        print('uncached: %.2f ms' % ((time.perf_counter() - start) * 1000))
+        print(engine.stats())
+        engine.close()
+
+
+if __name__ == '__main__':
+    main()
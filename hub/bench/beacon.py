@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Status in the advertisement, as a passive scanner would see it. Runs the
+hub against the mock org.bluez of harness.py, decodes the ManufacturerData
+status the advertisement was registered with, then starts programs
+through the PROGRAM characteristic: once one alone, timing how long the
+"programs running" count takes to reach the advertisement, then a burst
+of --programs, counting the PropertiesChanged the burst costs and the
+shortest gap between two.
+
+    python3 bench/beacon.py [--backend glib|aio] [--programs N]
+
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from dbus_next.aio import MessageBus
+
+from harness import (DBUS_OM_IFACE, HUB_SVC_UUID, PROGRAM_UUID, SRC,
+                     Central, find_chrc, start_bus, wait_registered)
+from mock_bluez import MockBluez
+
+import beacon
+
+PROGRAM = 'import time\ntime.sleep(%g)\n'
+
+
+def status(reg):
+    data = reg.objects['ManufacturerData'].value[beacon.COMPANY_ID].value
+    version, battery, flags, programs, generation = \
+            beacon.STATUS.unpack(data[:beacon.STATUS.size])
+    return {'version': version, 'battery': battery, 'flags': flags,
+            'programs': programs, 'generation': generation}
+
+
+async def wait_for(predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise RuntimeError('timed out')
+        await asyncio.sleep(0.002)
+
+
+async def run(args, address):
+    bus = await MessageBus(bus_address=address).connect()
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    registrations = {}
+
+    def on_registered(reg):
+        registrations.setdefault(reg.kind, reg)
+        if len(registrations) == 2 and not ready.done():
+            ready.set_result(None)
+
+    mock = MockBluez(bus, on_registered=on_registered)
+    await mock.start()
+    env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS=address,
+               HUB_LOG_LEVEL='WARNING')
+    hub = subprocess.Popen([sys.executable, os.path.join(SRC, 'main.py'),
+                            '--backend', args.backend,
+                            '--wifi-backend', 'stub'], env=env)
+    try:
+        await wait_registered(hub, ready, 30)
+        app = registrations['application']
+        adv = registrations['advertisement']
+        print('registered with %s' % status(adv))
+
+        central = Central(bus, app.sender)
+        objects = (await central.call(app.path, DBUS_OM_IFACE,
+                                      'GetManagedObjects')).body[0]
+        program = find_chrc(objects, HUB_SVC_UUID, PROGRAM_UUID)
+        # Past the rate limit of whatever was advertised at startup.
+        await asyncio.sleep(beacon.MIN_INTERVAL_MS / 1000.0)
+
+        start = time.monotonic()
+        await central.write(program, json.dumps(
+                {'source': PROGRAM % 1}).encode())
+        await wait_for(lambda: status(adv)['programs'] == 1)
+        print('program started, advertised in %.1f ms' % (
+                (time.monotonic() - start) * 1000))
+        await wait_for(lambda: status(adv)['programs'] == 0)
+
+        first = len(adv.updates)
+        for _ in range(args.programs):
+            await central.write(program, json.dumps(
+                    {'source': PROGRAM % 0.2}).encode())
+        await wait_for(lambda: status(adv)['programs'] > 0)
+        await wait_for(lambda: status(adv)['programs'] == 0, timeout=60)
+        updates = adv.updates[first:]
+        gaps = [b - a for a, b in zip(updates, updates[1:])]
+        print('burst of %d programs (%d state changes): %d '
+              'PropertiesChanged, shortest gap %.0f ms' % (
+                      args.programs, args.programs * 2, len(updates),
+                      min(gaps) * 1000 if gaps else 0))
+        print('final %s' % status(adv))
+    finally:
+        hub.send_signal(signal.SIGINT)
+        try:
+            hub.wait(5)
+        except subprocess.TimeoutExpired:
+            hub.kill()
+        bus.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=('glib', 'aio'), default='aio')
+    parser.add_argument('--programs', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        daemon, address = start_bus(tmpdir)
+        try:
+            asyncio.run(run(args, address))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+
+if __name__ == '__main__':
+    main()
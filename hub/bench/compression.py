@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+What compressed downloads would do for the files under a directory
+(hub/storage by default): for each file, the encoding compression.Cache
+picks when the client accepts every codec, the compressed size and ratio,
+the time spent compressing on the first download and on a repeat one,
+and the estimated transfer time saved at compression.LINK_RATE. The
+cache lives in a temporary directory.
+
+    python3 bench/compression.py [--root DIR] [--accept lzma,zlib]
+
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import compression
+from storage import STORAGE_ROOT
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default=STORAGE_ROOT)
+    parser.add_argument('--accept', default=','.join(compression.CODECS))
+    args = parser.parse_args()
+    accepted = args.accept.split(',')
+
+    print('%-44s%9s%10s%7s%10s%10s%10s' % ('file', 'encoding', 'bytes',
+                                           'ratio', 'first ms', 'repeat ms',
+                                           'saved ms'))
+    with tempfile.TemporaryDirectory() as root:
+        cache = compression.Cache(root)
+        for dirpath, _, names in os.walk(args.root):
+            for name in sorted(names):
+                full = os.path.join(dirpath, name)
+                times = []
+                for _ in range(2):
+                    start = time.perf_counter()
+                    data, info = cache.open(full, accepted)
+                    times.append((time.perf_counter() - start) * 1000)
+                print('%-44s%9s%10d%7.3f%10.1f%10.1f%10d' % (
+                        os.path.relpath(full, args.root)[-43:],
+                        info['encoding'], info['encoded_size'], info['ratio'],
+                        times[0], times[1], info['saved_ms']))
+
+
+if __name__ == '__main__':
+    main()
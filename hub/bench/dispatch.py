@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Control write latency behind a bulk upload, with calls served in arrival
+order and by dispatch.py. One client keeps --inflight upload frames
+outstanding, handled by transfer.UploadReceiver into a temporary storage,
+while a Heart Rate Control Point write arrives every 2 ms, from another
+client and then from the uploading one. Calls are delivered the way the
+backends deliver them, each in a main loop callback of its own, in order,
+so in arrival order a control write waits for every frame delivered before
+it. Each frame also takes --cost-ms more, standing in for a slower hub: on
+a Pi Zero the handler runs some 20 to 30 times slower than on a desktop.
+Prints the control write latency percentiles and the upload throughput of
+each order and client.
+
+The harness measures the same through the bus (control_under_upload).
+
+    python3 bench/dispatch.py [--size KB] [--inflight N] [--cost-ms MS]
+                              [--bulk-rate BYTES]
+
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import dispatch
+import eventloop
+from backend_aio import AsyncioLoop
+from storage import Storage
+import transfer
+
+DEVICE = '/org/bluez/hci0/dev_00_00_00_00_00_02'
+OTHER_DEVICE = '/org/bluez/hci0/dev_00_00_00_00_00_03'
+CONTROL_INTERVAL_S = 0.002
+
+
+class UploadChrc(object):
+    PRIORITY = dispatch.BULK
+
+    def __init__(self, receiver, cost_s):
+        self.receiver = receiver
+        self.cost_s = cost_s
+
+    def WriteValue(self, value, options):
+        self.receiver.handle(value, options['device'])
+        if self.cost_s:
+            time.sleep(self.cost_s)
+
+
+class ControlChrc(object):
+    PRIORITY = dispatch.CONTROL
+
+    def WriteValue(self, value, options):
+        pass
+
+
+def frames_of(data, mtu=247):
+    chunk = transfer.upload_chunk_size(mtu)
+    frames = [transfer.upload_frame(transfer.OP_OPEN, 1, len(data),
+                                    bytes([transfer.OPEN_OVERWRITE]) +
+                                    b'upload.bin')]
+    frames.extend(transfer.upload_frame(transfer.OP_DATA, 1, offset,
+                                        data[offset:offset + chunk])
+                  for offset in range(0, len(data), chunk))
+    frames.append(transfer.upload_frame(transfer.OP_COMMIT, 1, len(data),
+                                        crc=zlib.crc32(data)))
+    return frames
+
+
+def deliver(dispatcher, handler, value, options, done):
+    """Serves a call as a backend would; done() once it is answered."""
+    result = dispatcher.submit(handler, value, options)
+    if hasattr(result, 'add_callback'):
+        result.add_callback(lambda value, error: done())
+    else:
+        done()
+
+
+async def run(args, fair, control_device, tmpdir):
+    loop = asyncio.get_running_loop()
+    dispatcher = dispatch.Dispatcher(bulk_rate=args.bulk_rate)
+    dispatcher.fair = fair
+    upload = UploadChrc(transfer.UploadReceiver(Storage(tmpdir)),
+                        args.cost_ms / 1000.0)
+    control = ControlChrc()
+    data = os.urandom(args.size * 1024)
+    frames = iter(frames_of(data))
+    finished = loop.create_future()
+    options = {'device': DEVICE, 'type': 'command'}
+    outstanding = [0]
+
+    def send():
+        while outstanding[0] < args.inflight:
+            frame = next(frames, None)
+            if frame is None:
+                if not outstanding[0] and not finished.done():
+                    finished.set_result(None)
+                return
+            outstanding[0] += 1
+            loop.call_soon(deliver, dispatcher, upload.WriteValue, frame,
+                           options, answered)
+
+    def answered():
+        outstanding[0] -= 1
+        send()
+
+    samples = []
+
+    async def write_control():
+        while not finished.done():
+            answer = loop.create_future()
+            start = time.perf_counter()
+            loop.call_soon(deliver, dispatcher, control.WriteValue, b'\x01',
+                           {'device': control_device},
+                           lambda: answer.set_result(
+                                   time.perf_counter() - start))
+            samples.append(await answer)
+            await asyncio.sleep(CONTROL_INTERVAL_S)
+
+    start = time.perf_counter()
+    send()
+    await asyncio.gather(finished, write_control())
+    elapsed = time.perf_counter() - start
+    samples.sort()
+    print('%-16s %-9s control p50 %6.2f ms  p99 %6.2f ms  max %6.2f ms  '
+          'upload %6.0f kB/s' % (
+                  'dispatch.py' if fair else 'arrival order',
+                  'uploader' if control_device == DEVICE else 'other',
+                  samples[len(samples) // 2] * 1000,
+                  samples[len(samples) * 99 // 100] * 1000,
+                  samples[-1] * 1000, args.size / elapsed))
+
+
+async def bench(args):
+    eventloop.use(AsyncioLoop(asyncio.get_running_loop()))
+    for control_device in (OTHER_DEVICE, DEVICE):
+        for fair in (False, True):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                await run(args, fair, control_device, tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--inflight', type=int, default=32)
+    parser.add_argument('--cost-ms', type=float, default=0.2)
+    parser.add_argument('--bulk-rate', type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
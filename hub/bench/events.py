@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Cost of the event bus: publishing an event with one matching handler
+while N other subscriptions exist, then event to handler latency into a
+program running on a worker, through its shared memory ring, with events
+published back-to-back and spaced out (the worker asleep on its
+doorbell in between).
+
+    python3 bench/events.py [--events N] [--interval-ms MS]
+
+"""
+
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import eventloop
+import events
+import runner
+from backend_aio import AsyncioLoop
+
+PROGRAM = '''
+count = 0
+
+@events.on('bench')
+def on_bench(event):
+    global count
+    count += 1
+'''
+
+
+def publish_cost(others, count=20000):
+    bus = events.EventBus()
+    for i in range(others):
+        bus.subscribe('sensor', i, lambda event: None)
+    bus.subscribe('bench', None, lambda event: None)
+    start = time.perf_counter()
+    for i in range(count):
+        bus.publish('bench', None, i)
+    return (time.perf_counter() - start) * 1e6 / count
+
+
+async def wait_for(predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise RuntimeError('timed out')
+        await asyncio.sleep(0.001)
+
+
+async def latency(args):
+    eventloop.use(AsyncioLoop(asyncio.get_running_loop()))
+    bus = events.EventBus()
+    pool = runner.ProgramRunner(size=1, bus=bus)
+    pool.start()
+    await wait_for(lambda: all(w.ready for w in pool.workers))
+    run = pool.run(PROGRAM, 'bench')
+    await wait_for(lambda: bus.subscriptions)
+
+    for name, interval in (('back-to-back', 0),
+                           ('every %g ms' % args.interval_ms,
+                            args.interval_ms / 1000.0)):
+        # Every sample, not just the runner's last LATENCY_SAMPLES.
+        pool.event_latencies = collections.deque()
+        for i in range(args.events):
+            bus.publish('bench', None, i)
+            if interval:
+                await asyncio.sleep(interval)
+        await wait_for(lambda: len(pool.event_latencies) >= args.events)
+        stats = runner.percentiles(pool.event_latencies, '')
+        print('%-16s p50 %7.3f ms  p99 %7.3f ms  max %7.3f ms' % (
+                name, stats['_p50_ms'], stats['_p99_ms'], stats['_max_ms']))
+    pool.stop(run.id)
+    await wait_for(lambda: run.state == 'stopped')
+    pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=500)
+    parser.add_argument('--interval-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    print('publish, us per event with N other subscriptions:')
+    for others in (0, 100, 10000):
+        print('  N=%-6d %.2f' % (others, publish_cost(others)))
+    print('event to handler latency, %d events:' % args.events)
+    asyncio.run(latency(args))
+
+
+if __name__ == '__main__':
+    main()
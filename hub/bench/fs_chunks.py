@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+What chunked uploads send for the files under a directory (hub/storage
+by default), copied into a temporary storage first: for each file, the
+upload stream when the hub has nothing, when it already has the file
+under another path, and after an edit of 'edit' bytes in the middle.
+Also prints how long chunking took, which the hub pays once per file.
+
+    python3 bench/fs_chunks.py [--root DIR] [--edit BYTES]
+
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import chunks
+import eventloop
+import index
+from storage import STORAGE_ROOT, Storage
+
+
+class NoLoop(object):
+    """Sources are never run; saving is left out of the measurements."""
+
+    def timeout_add_seconds(self, interval, callback):
+        return 1
+
+    def source_remove(self, source_id):
+        pass
+
+
+def known(store, data):
+    hashes = [hashlib.sha256(data[offset:offset + length]).digest()
+              for offset, length in chunks.cut(data)]
+    bitmap = store.have(b''.join(hashes))
+    return set(digest for i, digest in enumerate(hashes)
+               if bitmap[i >> 3] >> (i & 7) & 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default=STORAGE_ROOT)
+    parser.add_argument('--edit', type=int, default=16)
+    args = parser.parse_args()
+
+    eventloop.use(NoLoop())
+    index.Index._start_inotify = lambda self: None
+
+    with tempfile.TemporaryDirectory() as root:
+        storage = Storage(os.path.join(root, 'storage'))
+        store = chunks.ChunkStore(
+                storage, index.Index(storage, os.path.join(root, 'i.json')),
+                os.path.join(root, 'c.json'))
+
+        print('%-40s%10s%10s%10s%10s%9s' % ('file', 'bytes', 'new', 'copy',
+                                            'edited', 'cut ms'))
+        for dirpath, _, names in os.walk(args.root):
+            for name in sorted(names):
+                full = os.path.join(dirpath, name)
+                with open(full, 'rb') as f:
+                    data = f.read()
+                new = len(chunks.encode(data, known(store, data)))
+                start = time.perf_counter()
+                shutil.copy(full, storage.resolve(name))
+                store.refresh()
+                cut_ms = (time.perf_counter() - start) * 1000
+                copy = len(chunks.encode(data, known(store, data)))
+                middle = len(data) // 2
+                edited = data[:middle] + os.urandom(args.edit) + data[middle:]
+                edit = len(chunks.encode(edited, known(store, edited)))
+                print('%-40s%10d%10d%10d%10d%9.1f' % (
+                        os.path.relpath(full, args.root)[-39:], len(data),
+                        new, copy, edit, cut_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Cost of answering FS_LIST for a directory of N files: Storage.list(),
+which walks and stats the directory on every call, against the storage
+index serving the whole listing, one MTU sized page, and the changes
+since a generation after one file was written. The index is built once
+beforehand and its build time is reported separately.
+
+    python3 bench/fs_list.py [--files N] [--count N] [--mtu N]
+
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import eventloop
+import index
+from storage import Storage
+
+
+class NoLoop(object):
+    """Sources are never run: no inotify, so the mtime fallback is used."""
+
+    def timeout_add_seconds(self, interval, callback):
+        return 1
+
+    def source_remove(self, source_id):
+        pass
+
+
+def measure(func, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - start) * 1e6 / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--mtu', type=int, default=247)
+    args = parser.parse_args()
+
+    eventloop.use(NoLoop())
+    index.Index._start_inotify = lambda self: None
+
+    with tempfile.TemporaryDirectory() as root:
+        storage = Storage(os.path.join(root, 'storage'))
+        for i in range(args.files):
+            storage.write('programs/program-%04d.py' % i, b'print(1)\n')
+        idx = index.Index(storage, os.path.join(root, 'index.json'))
+
+        start = time.perf_counter()
+        idx.list('')
+        build = (time.perf_counter() - start) * 1000
+
+        storage.write('programs/new.py', b'')
+        since = idx.generation
+        idx.changes(since)
+        storage.write('programs/new.py', b'print(2)\n')
+
+        print('files=%d, index built in %.1f ms (us per call)' %
+              (args.files, build))
+        for name, func in (
+                ('Storage.list', lambda: storage.list('programs')),
+                ('Index.list', lambda: idx.list('programs')),
+                ('Index.page', lambda: idx.page('programs', None, None,
+                                                args.mtu - 1)),
+                ('Index.changes', lambda: idx.changes(since))):
+            print('%-16s%10.1f' % (name, measure(func, args.count)))
+
+
+if __name__ == '__main__':
+    main()
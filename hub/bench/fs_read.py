@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Hub-side cost of a bulk FS_READ download: frames a file with
+transfer.DownloadStream, acking every window the way the client does, and
+reports throughput and peak RSS. D-Bus and the radio are not involved, so
+this is the ceiling the framing puts on a download, not link speed.
+
+The 'list' mode measures the old path for comparison: the whole file read
+into memory and turned into a list of byte values.
+
+    python3 bench/fs_read.py [--size MB] [--mtu N] [--window N] [--mode M]
+
+"""
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from storage import Storage
+import transfer
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_stream(storage, name, mtu, window):
+    stream = transfer.DownloadStream(storage.open_map(name), mtu, 0, window)
+    frames = 0
+    while not stream.done:
+        frame = stream.next_frame()
+        if frame is None:
+            stream.ack((stream.seq - 1) % transfer.SEQ_MOD)
+            continue
+        frames += 1
+    stream.close()
+    return frames
+
+
+def run_list(storage, name):
+    with open(storage.resolve(name), 'rb') as f:
+        value = list(f.read())
+    return len(value)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=float, default=5.0)
+    parser.add_argument('--mtu', type=int, default=247)
+    parser.add_argument('--window', type=int, default=transfer.DEFAULT_WINDOW)
+    parser.add_argument('--mode', choices=('stream', 'list'),
+                        default='stream')
+    args = parser.parse_args()
+
+    size = int(args.size * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as root:
+        storage = Storage(root)
+        with open(os.path.join(root, 'blob.bin'), 'wb') as f:
+            for _ in range(0, size, 1 << 16):
+                f.write(os.urandom(1 << 16))
+            f.truncate(size)
+
+        rss_before = peak_rss_kb()
+        start = time.perf_counter()
+        if args.mode == 'stream':
+            frames = run_stream(storage, 'blob.bin', args.mtu, args.window)
+        else:
+            frames = run_list(storage, 'blob.bin')
+        elapsed = time.perf_counter() - start
+        rss_after = peak_rss_kb()
+
+    print('mode=%s size=%d mtu=%d window=%d' %
+          (args.mode, size, args.mtu, args.window))
+    if args.mode == 'stream':
+        print('frames=%d payload=%d bytes/frame' %
+              (frames, transfer.chunk_size(args.mtu)))
+    print('elapsed=%.3f s throughput=%.0f KB/s' %
+          (elapsed, size / 1024.0 / elapsed))
+    print('peak_rss=%d KB (+%d KB)' % (rss_after, rss_after - rss_before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Hub-side cost of uploading a file to FS_WRITE, JSON + base64 against the
+binary upload frames of transfer.py. The JSON request goes through the
+long write reassembly the way BlueZ replays it, then is parsed, decoded
+and written; the frames go through transfer.UploadReceiver one write
+without response at a time. No bus or radio is involved.
+
+For each mode it prints the ATT bytes on air per uploaded MB (request
+PDUs and the responses a long write needs) and the CPU time per MB.
+
+    python3 bench/fs_write.py [--size MB] [--mtu N]
+
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import eventloop
+import reassembly
+from storage import Storage
+import transfer
+
+# Opcode (1) + handle (2) + offset (2) of a Prepare Write request, echoed
+# back in its response.
+PREPARE_OVERHEAD = 5
+# Execute Write request and response.
+EXECUTE_BYTES = 2 + 1
+WRITE_CMD_OVERHEAD = transfer.ATT_NOTIFY_OVERHEAD
+
+
+class NoLoop(object):
+    """Sources are never run; the bench finishes long before a sweep."""
+
+    def timeout_add_seconds(self, interval, callback):
+        return 1
+
+    def source_remove(self, source_id):
+        pass
+
+
+def run_json(storage, data, mtu):
+    import main as hub
+
+    value = json.dumps({
+            'path': 'upload.bin',
+            'data': base64.b64encode(data).decode('ascii'),
+            'overwrite': True,
+    }).encode('utf-8')
+
+    start = time.process_time()
+    uploads = reassembly.Uploads(budget=len(value))
+    chunk = mtu - PREPARE_OVERHEAD
+    air = EXECUTE_BYTES
+    for phase in ({'prepare-authorize': True}, {}):
+        for offset in range(0, len(value), chunk):
+            piece = value[offset:offset + chunk]
+            options = dict(phase, offset=offset, device='bench')
+            complete = uploads.write('/fs', piece, options)
+            if phase:
+                air += 2 * (PREPARE_OVERHEAD + len(piece))
+    request = hub.parse_json_value(complete)
+    storage.write(request['path'], hub.decode_base64(request['data']),
+                  request['overwrite'])
+    return air, time.process_time() - start
+
+
+def run_frames(storage, data, mtu):
+    chunk = transfer.upload_chunk_size(mtu)
+    frames = [transfer.upload_frame(
+                      transfer.OP_OPEN, 1, len(data),
+                      bytes([transfer.OPEN_OVERWRITE]) + b'upload.bin')]
+    view = memoryview(data)
+    for offset in range(0, len(data), chunk):
+        frames.append(transfer.upload_frame(transfer.OP_DATA, 1, offset,
+                                            view[offset:offset + chunk]))
+    frames.append(transfer.upload_frame(transfer.OP_COMMIT, 1, len(data),
+                                        crc=zlib.crc32(data)))
+
+    start = time.process_time()
+    receiver = transfer.UploadReceiver(storage)
+    air = 0
+    for frame in frames:
+        receiver.handle(frame, 'bench')
+        air += WRITE_CMD_OVERHEAD + len(frame)
+    # The client reads the status once, at the end.
+    air += 1 + len(receiver.get_status('bench'))
+    return air, time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=float, default=1.0)
+    parser.add_argument('--mtu', type=int, default=247)
+    args = parser.parse_args()
+
+    eventloop.use(NoLoop())
+    size = int(args.size * 1024 * 1024)
+    data = os.urandom(size)
+    mb = size / (1024.0 * 1024.0)
+    print('size=%.2fMB mtu=%d' % (mb, args.mtu))
+    print('%-8s%18s%14s' % ('mode', 'air bytes/MB', 'cpu ms/MB'))
+    with tempfile.TemporaryDirectory() as root:
+        storage = Storage(root)
+        for mode, run in (('json', run_json), ('frames', run_frames)):
+            air, cpu = run(storage, data, args.mtu)
+            with open(os.path.join(root, 'upload.bin'), 'rb') as f:
+                assert f.read() == data, mode
+            print('%-8s%18d%14.1f' % (mode, air / mb, cpu * 1000 / mb))
+
+
+if __name__ == '__main__':
+    main()
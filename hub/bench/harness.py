@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Offline benchmark of the hub. Starts a private dbus-daemon, serves a mock
+org.bluez on it (see mock_bluez.py), launches hub/src/main.py against that
+bus as its system bus and then acts as a central:
+
+- startup: time from launching the hub until the application and the
+  advertisement are registered, GetManagedObjects/GetAll callbacks
+  included, and when the hub itself saw each of its startup phases end
+  (read from the STARTUP characteristic, see startup.py)
+- GetManagedObjects latency
+- ReadValue / WriteValue round trips on the test characteristic
+- long writes to the test characteristic, prepared and executed the way
+  BlueZ forwards them
+- notification throughput of a bulk FS_READ download
+- Heart Rate Control Point write round trips, idle and while another
+  client uploads a file to FS_WRITE with --inflight frames outstanding
+  (see dispatch.py), and the throughput of that upload
+- event to handler latency: a program subscribed to an event topic runs
+  on the hub while events are published through the EVENTS
+  characteristic; the latency percentiles are the ones the hub measured
+- RSS of the hub process
+
+Results are written as JSON, by default to
+bench/results/<commit>-<backend>.json, and can be compared with an earlier
+run, e.g. of the other backend or of the hub serving calls in arrival
+order (--hub-arg=--dispatch=fifo):
+
+    python3 bench/harness.py [--backend glib|aio] [--output FILE]
+                             [--compare FILE] [--upload-kb KB]
+                             [--inflight N] [--hub-arg ARG]
+
+Needs dbus-daemon and dbus_next here, and whatever the hub itself needs.
+
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', 'src')
+sys.path.insert(0, SRC)
+
+from dbus_next import Message, MessageType, Variant
+from dbus_next.aio import MessageBus
+
+from mock_bluez import MockBluez, DBUS_OM_IFACE
+import transfer
+
+GATT_CHRC_IFACE = 'org.bluez.GattCharacteristic1'
+TEST_CHRC_UUID = '12345678-1234-5678-1234-56789abcdef1'
+TEST_SVC_UUID = '12345678-1234-5678-1234-56789abcdee0'
+FS_SVC_UUID = '12345678-1234-5678-1234-56789abcdef0'
+FS_DELETE_UUID = '12345678-1234-5678-1234-56789abcdef3'
+FS_READ_UUID = '12345678-1234-5678-1234-56789abcdef4'
+FS_WRITE_UUID = '12345678-1234-5678-1234-56789abcdef5'
+HR_SVC_UUID = '0000180d-0000-1000-8000-00805f9b34fb'
+HR_CONTROL_UUID = '00002a39-0000-1000-8000-00805f9b34fb'
+HUB_SVC_UUID = '12345678-1234-5678-1234-56789abcde00'
+PROGRAM_UUID = '12345678-1234-5678-1234-56789abcde03'
+EVENTS_UUID = '12345678-1234-5678-1234-56789abcde04'
+STARTUP_UUID = '12345678-1234-5678-1234-56789abcde05'
+EVENT_PROGRAM = '''
+@events.on('bench')
+def on_bench(event):
+    pass
+'''
+DEFAULT_FILE = 'audios/funny-cartoon-sound-397415.mp3'
+# The 'device' option of calls that need one.
+DEVICE = '/org/bluez/hci0/dev_00_00_00_00_00_01'
+UPLOADER = '/org/bluez/hci0/dev_00_00_00_00_00_02'
+UPLOAD_FILE = 'bench-upload.bin'
+
+BUS_CONFIG = '''<!DOCTYPE busconfig PUBLIC
+ "-//freedesktop//DTD D-Bus Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+  <type>session</type>
+  <listen>unix:dir=%s</listen>
+  <auth>EXTERNAL</auth>
+  <policy context="default">
+    <allow send_destination="*" eavesdrop="true"/>
+    <allow eavesdrop="true"/>
+    <allow own="*"/>
+  </policy>
+</busconfig>
+'''
+
+
+def start_bus(tmpdir):
+    config = os.path.join(tmpdir, 'bus.conf')
+    with open(config, 'w') as f:
+        f.write(BUS_CONFIG % tmpdir)
+    daemon = subprocess.Popen(['dbus-daemon', '--config-file', config,
+                               '--nofork', '--print-address'],
+                              stdout=subprocess.PIPE, text=True)
+    address = daemon.stdout.readline().strip()
+    return daemon, address
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=HERE, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def summarize(samples):
+    """Latency percentiles in milliseconds."""
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+            'count': len(samples),
+            'mean': 1000.0 * sum(samples) / len(samples),
+            'p50': 1000.0 * pick(0.50),
+            'p90': 1000.0 * pick(0.90),
+            'p99': 1000.0 * pick(0.99),
+            'max': 1000.0 * samples[-1],
+    }
+
+
+def process_rss(pid):
+    rss = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key == 'VmRSS':
+                rss['rss_kb'] = int(value.split()[0])
+            elif key == 'VmHWM':
+                rss['peak_rss_kb'] = int(value.split()[0])
+    return rss
+
+
+def find_chrc(objects, svc_uuid, chrc_uuid):
+    for path, ifaces in objects.items():
+        props = ifaces.get(GATT_CHRC_IFACE)
+        if props is None or props['UUID'].value != chrc_uuid:
+            continue
+        service = objects[props['Service'].value]
+        if service['org.bluez.GattService1']['UUID'].value == svc_uuid:
+            return path
+    raise LookupError('no characteristic %s in %s' % (chrc_uuid, svc_uuid))
+
+
+class Central(object):
+    """Talks to the hub the way bluetoothd does on behalf of a client."""
+
+    def __init__(self, bus, hub):
+        self.bus = bus
+        self.hub = hub
+
+    async def call(self, path, interface, member, signature='', body=()):
+        reply = await self.bus.call(Message(
+                destination=self.hub, path=path, interface=interface,
+                member=member, signature=signature, body=list(body)))
+        if reply.message_type == MessageType.ERROR:
+            raise RuntimeError('%s.%s: %s %s' % (interface, member,
+                                                 reply.error_name, reply.body))
+        return reply
+
+    async def timed(self, count, *args):
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter()
+            await self.call(*args)
+            samples.append(time.perf_counter() - start)
+        return summarize(samples)
+
+    async def write(self, path, value, options=None):
+        await self.call(path, GATT_CHRC_IFACE, 'WriteValue', 'aya{sv}',
+                        [bytes(value), options or {}])
+
+    async def long_write(self, path, value, mtu, device=DEVICE):
+        """Prepares and executes 'value' in chunks of an ATT MTU."""
+        chunk = mtu - 5
+        chunks = [(offset, value[offset:offset + chunk])
+                  for offset in range(0, len(value), chunk)]
+        for offset, data in chunks:
+            await self.write(path, data, {
+                    'offset': Variant('q', offset),
+                    'device': Variant('o', device),
+                    'prepare-authorize': Variant('b', True)})
+        for offset, data in chunks:
+            await self.write(path, data, {
+                    'offset': Variant('q', offset),
+                    'device': Variant('o', device)})
+
+    async def download(self, path, name, mtu, window):
+        """Streams 'name' through FS_READ and returns (bytes, frames, s)."""
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        state = {'bytes': 0, 'frames': 0, 'acked': -1}
+
+        def on_signal(msg):
+            if msg.message_type != MessageType.SIGNAL or \
+                    msg.path != path or msg.member != 'PropertiesChanged':
+                return None
+            value = msg.body[1].get('Value')
+            if value is None:
+                return None
+            frame = value.value
+            seq, _ = transfer.FRAME_HEADER.unpack_from(frame)
+            payload = len(frame) - transfer.FRAME_HEADER.size
+            state['frames'] += 1
+            state['bytes'] += payload
+            if payload == 0 and not done.done():
+                done.set_result(None)
+            elif window and state['frames'] - 1 - state['acked'] >= \
+                    window // 2:
+                state['acked'] = state['frames'] - 1
+                ack = transfer.ACK_FORMAT.pack(transfer.ACK_OPCODE, seq)
+                loop.create_task(self.write(path, ack))
+            return None
+
+        rule = ("type='signal',sender='%s',path='%s',"
+                "interface='org.freedesktop.DBus.Properties'" %
+                (self.hub, path))
+        await self.bus.call(Message(
+                destination='org.freedesktop.DBus',
+                path='/org/freedesktop/DBus',
+                interface='org.freedesktop.DBus', member='AddMatch',
+                signature='s', body=[rule]))
+        self.bus.add_message_handler(on_signal)
+        await self.call(path, GATT_CHRC_IFACE, 'StartNotify')
+
+        request = json.dumps({'path': name, 'mode': 'stream',
+                              'window': window}).encode('utf-8')
+        start = time.perf_counter()
+        await self.write(path, request, {'mtu': Variant('q', mtu)})
+        await asyncio.wait_for(done, 120)
+        elapsed = time.perf_counter() - start
+
+        self.bus.remove_message_handler(on_signal)
+        await self.call(path, GATT_CHRC_IFACE, 'StopNotify')
+        return state['bytes'], state['frames'], elapsed
+
+
+    async def upload(self, path, name, data, mtu, inflight):
+        """
+        Sends 'data' to FS_WRITE as upload frames written without
+        response, at most 'inflight' unanswered at once, as UPLOADER.
+
+        """
+        chunk = transfer.upload_chunk_size(mtu)
+        frames = [transfer.upload_frame(
+                transfer.OP_OPEN, 1, len(data),
+                bytes([transfer.OPEN_OVERWRITE]) + name.encode('utf-8'))]
+        frames.extend(transfer.upload_frame(transfer.OP_DATA, 1, offset,
+                                            data[offset:offset + chunk])
+                      for offset in range(0, len(data), chunk))
+        frames.append(transfer.upload_frame(transfer.OP_COMMIT, 1, len(data),
+                                            crc=zlib.crc32(data)))
+        options = {'device': Variant('o', UPLOADER),
+                   'type': Variant('s', 'command')}
+        slots = asyncio.Semaphore(inflight)
+
+        async def send(frame):
+            try:
+                await self.write(path, frame, options)
+            finally:
+                slots.release()
+        pending = []
+        for frame in frames:
+            await slots.acquire()
+            pending.append(asyncio.ensure_future(send(frame)))
+        await asyncio.gather(*pending)
+
+    async def under_load(self, address, control, fs_write, size, mtu,
+                         inflight):
+        """
+        Writes 'control' back to back while a process of its own uploads
+        'size' bytes, so that the uploads do not hold up this loop.
+        Returns the write round trips and the upload throughput.
+
+        """
+        loop = asyncio.get_running_loop()
+        context = multiprocessing.get_context('spawn')
+        pipe, child = context.Pipe()
+        uploader = context.Process(target=upload_process, args=(
+                address, self.hub, fs_write, size, mtu, inflight, child))
+        uploader.start()
+        # Ours closed, the pipe reads EOF should the uploader die.
+        child.close()
+        try:
+            await loop.run_in_executor(None, pipe.recv)
+            elapsed = loop.run_in_executor(None, pipe.recv)
+            samples = []
+            while not elapsed.done():
+                start = time.perf_counter()
+                await self.write(control, b'\x01')
+                samples.append(time.perf_counter() - start)
+                await asyncio.sleep(0.002)
+            return {
+                    'control': summarize(samples),
+                    'upload_kb_per_s': size / 1024.0 / await elapsed,
+            }
+        finally:
+            uploader.join(5)
+
+    async def read_json(self, path):
+        reply = await self.call(path, GATT_CHRC_IFACE, 'ReadValue', 'a{sv}',
+                                [{}])
+        return json.loads(bytes(reply.body[0]).decode('utf-8'))
+
+    async def events(self, program, events, count, interval=0.005):
+        """
+        Runs EVENT_PROGRAM and publishes 'count' events to it, 'interval'
+        seconds apart. Returns the publish round trips and the event to
+        handler latencies the hub measured.
+
+        """
+        await self.write(program, json.dumps(
+                {'source': EVENT_PROGRAM}).encode('utf-8'))
+        deadline = time.monotonic() + 10
+        while not (await self.read_json(events))['subscriptions']:
+            if time.monotonic() > deadline:
+                raise RuntimeError('event program did not subscribe')
+            await asyncio.sleep(0.01)
+        samples = []
+        for i in range(count):
+            request = json.dumps({'topic': 'bench', 'value': i})
+            start = time.perf_counter()
+            await self.write(events, request.encode('utf-8'))
+            samples.append(time.perf_counter() - start)
+            await asyncio.sleep(interval)
+        # Latencies are reported when the program goes idle.
+        await asyncio.sleep(0.1)
+        stats = await self.read_json(events)
+        await self.write(program, b'{"stop": true}')
+        return {
+                'publish': summarize(samples),
+                'handler_p50_ms': stats['event_latency_p50_ms'],
+                'handler_p99_ms': stats['event_latency_p99_ms'],
+                'handler_max_ms': stats['event_latency_max_ms'],
+        }
+
+
+def upload_process(address, hub, path, size, mtu, inflight, pipe):
+    """
+    Central.upload() of 'size' random bytes on a bus connection of its
+    own. Tells 'pipe' when it starts, then how many seconds it took.
+
+    """
+    # A remote client does not compete with the hub for its CPU.
+    os.nice(19)
+
+    async def upload():
+        bus = await MessageBus(bus_address=address).connect()
+        data = os.urandom(size)
+        pipe.send(None)
+        start = time.perf_counter()
+        await Central(bus, hub).upload(path, UPLOAD_FILE, data, mtu,
+                                       inflight)
+        pipe.send(time.perf_counter() - start)
+        bus.disconnect()
+    asyncio.run(upload())
+
+
+async def wait_registered(hub, ready, timeout):
+    deadline = time.monotonic() + timeout
+    while not ready.done():
+        if hub.poll() is not None:
+            raise RuntimeError('hub exited with status %d' % hub.returncode)
+        if time.monotonic() > deadline:
+            raise RuntimeError('hub did not register within %.0f s' % timeout)
+        await asyncio.wait([ready], timeout=0.05)
+
+
+async def run(args, address):
+    bus = await MessageBus(bus_address=address).connect()
+    loop = asyncio.get_running_loop()
+    registrations = {}
+    ready = loop.create_future()
+
+    def on_registered(reg):
+        registrations.setdefault(reg.kind, reg)
+        if len(registrations) == 2 and not ready.done():
+            ready.set_result(None)
+
+    mock = MockBluez(bus, on_registered=on_registered)
+    await mock.start()
+
+    env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS=address,
+               HUB_LOG_LEVEL='WARNING')
+    launched = time.monotonic()
+    hub_args = ['--backend', args.backend] + (args.hub_arg or [])
+    hub = subprocess.Popen([sys.executable, os.path.join(SRC, 'main.py')] +
+                           hub_args, env=env)
+    results = {'commit': git_commit(), 'time': int(time.time()),
+               'backend': args.backend, 'hub_args': hub_args}
+    try:
+        await wait_registered(hub, ready, args.timeout)
+        app = registrations['application']
+        adv = registrations['advertisement']
+        results['startup'] = {
+                'registered_s': app.completed - launched,
+                'advertised_s': adv.completed - launched,
+        }
+
+        central = Central(bus, app.sender)
+        results['get_managed_objects'] = await central.timed(
+                args.calls, app.path, DBUS_OM_IFACE, 'GetManagedObjects')
+
+        objects = (await central.call(app.path, DBUS_OM_IFACE,
+                                      'GetManagedObjects')).body[0]
+        breakdown = await central.read_json(
+                find_chrc(objects, HUB_SVC_UUID, STARTUP_UUID))
+        results['startup']['phases_ms'] = dict(
+                (phase['phase'], phase['at_ms'])
+                for phase in breakdown['phases'])
+        test = find_chrc(objects, TEST_SVC_UUID, TEST_CHRC_UUID)
+        value = os.urandom(args.value_size)
+        results['write_value'] = await central.timed(
+                args.calls, test, GATT_CHRC_IFACE, 'WriteValue', 'aya{sv}',
+                [value, {}])
+        results['read_value'] = await central.timed(
+                args.calls, test, GATT_CHRC_IFACE, 'ReadValue', 'a{sv}', [{}])
+
+        value = os.urandom(transfer.MAX_ATTR_LEN)
+        samples = []
+        for _ in range(args.calls // 10):
+            start = time.perf_counter()
+            await central.long_write(test, value, args.mtu)
+            samples.append(time.perf_counter() - start)
+        results['long_write'] = summarize(samples)
+        # Values are per client (see sessions.py), so read as the writer.
+        reply = await central.call(test, GATT_CHRC_IFACE, 'ReadValue',
+                                   'a{sv}', [{'device': Variant('o', DEVICE)}])
+        if reply.body[0] != value:
+            raise RuntimeError('long write did not reassemble')
+
+        fs_read = find_chrc(objects, FS_SVC_UUID, FS_READ_UUID)
+        size, frames, elapsed = await central.download(
+                fs_read, args.file, args.mtu, args.window)
+        results['notify'] = {
+                'file': args.file,
+                'mtu': args.mtu,
+                'window': args.window,
+                'bytes': size,
+                'frames': frames,
+                'frames_per_s': frames / elapsed,
+                'kb_per_s': size / 1024.0 / elapsed,
+        }
+
+        control = find_chrc(objects, HR_SVC_UUID, HR_CONTROL_UUID)
+        results['control_write'] = await central.timed(
+                args.calls // 5, control, GATT_CHRC_IFACE, 'WriteValue',
+                'aya{sv}', [b'\x01', {}])
+        fs_write = find_chrc(objects, FS_SVC_UUID, FS_WRITE_UUID)
+        loaded = await central.under_load(
+                address, control, fs_write, args.upload_kb * 1024, args.mtu,
+                args.inflight)
+        results['control_under_upload'] = loaded['control']
+        results['upload'] = {'kb': args.upload_kb,
+                             'inflight': args.inflight,
+                             'kb_per_s': loaded['upload_kb_per_s']}
+        await central.write(find_chrc(objects, FS_SVC_UUID, FS_DELETE_UUID),
+                            json.dumps({'path': UPLOAD_FILE}).encode('utf-8'))
+
+        program = find_chrc(objects, HUB_SVC_UUID, PROGRAM_UUID)
+        events = find_chrc(objects, HUB_SVC_UUID, EVENTS_UUID)
+        results['events'] = await central.events(program, events,
+                                                 args.events)
+
+        results['memory'] = process_rss(hub.pid)
+    finally:
+        hub.send_signal(signal.SIGINT)
+        try:
+            hub.wait(5)
+        except subprocess.TimeoutExpired:
+            hub.kill()
+        bus.disconnect()
+    return results
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old, new):
+    old = flatten(old)
+    new = flatten(new)
+    for key in sorted(new):
+        if key in ('time',) or key not in old:
+            continue
+        delta = '' if not old[key] else \
+                '%+.1f%%' % (100.0 * (new[key] - old[key]) / old[key])
+        print('%-36s %12.3f %12.3f %9s' % (key, old[key], new[key], delta))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=('glib', 'aio'),
+                        default='glib')
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--value-size', type=int, default=512)
+    parser.add_argument('--file', default=DEFAULT_FILE)
+    parser.add_argument('--mtu', type=int, default=247)
+    parser.add_argument('--window', type=int,
+                        default=transfer.DEFAULT_WINDOW)
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--upload-kb', type=int, default=1024)
+    parser.add_argument('--inflight', type=int, default=32)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--hub-arg', action='append',
+                        help='extra argument for main.py, may be repeated')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        daemon, address = start_bus(tmpdir)
+        try:
+            results = asyncio.run(run(args, address))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+    output = args.output or os.path.join(
+            HERE, 'results', '%s-%s.json' % (results['commit'], args.backend))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    print('results written to ' + output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Per message cost of what each backend puts on and takes off the bus,
+without a bus: a ReadValue reply carrying a stored value, a
+PropertiesChanged notification of a download frame, the cached
+GetManagedObjects reply of the hub's attribute tree, and demarshalling a
+WriteValue call. The glib backend is measured with dbus-python and the
+aio backend with dbus_next; a backend whose binding is not installed is
+skipped.
+
+    python3 bench/marshal.py [--size BYTES] [--count N]
+
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import gatt
+import transfer
+
+
+def glib_cases(payload, frame, app):
+    import dbus
+    import dbus.lowlevel
+
+    import backend_glib
+
+    stored = dbus.ByteArray(payload)
+    tree = dbus.Dictionary(
+            dict((dbus.ObjectPath(path), backend_glib.marshal_properties(p))
+                 for path, p in app.get_managed_objects().items()),
+            signature='oa{sa{sv}}')
+
+    def read_reply():
+        msg = dbus.lowlevel.SignalMessage('/bench', 'org.example.Bench', 'R')
+        msg.append(stored, signature='ay')
+
+    def notify():
+        msg = dbus.lowlevel.SignalMessage('/bench', gatt.DBUS_PROP_IFACE,
+                                          'PropertiesChanged')
+        msg.append(gatt.GATT_CHRC_IFACE,
+                   {'Value': dbus.ByteArray(frame)}, [],
+                   signature='sa{sv}as')
+
+    def managed_objects():
+        msg = dbus.lowlevel.SignalMessage('/bench', 'org.example.Bench', 'M')
+        msg.append(tree, signature='a{oa{sa{sv}}}')
+
+    write = dbus.lowlevel.SignalMessage('/bench', gatt.GATT_CHRC_IFACE, 'W')
+    write.append(dbus.ByteArray(payload), {'offset': dbus.UInt16(0)},
+                 signature='aya{sv}')
+
+    def write_value():
+        write.get_args_list(byte_arrays=True)
+
+    return read_reply, notify, managed_objects, write_value
+
+
+def aio_cases(payload, frame, app):
+    from dbus_next import Message, MessageType, Variant
+    from dbus_next._private.unmarshaller import Unmarshaller
+
+    import backend_aio
+
+    tree = dict((path, backend_aio.marshal_properties(p))
+                for path, p in app.get_managed_objects().items())
+
+    def read_reply():
+        Message(message_type=MessageType.SIGNAL, path='/bench',
+                interface='org.example.Bench', member='R', signature='ay',
+                body=[payload])._marshall()
+
+    def notify():
+        Message.new_signal('/bench', gatt.DBUS_PROP_IFACE,
+                           'PropertiesChanged', 'sa{sv}as',
+                           [gatt.GATT_CHRC_IFACE,
+                            {'Value': Variant('ay', frame)}, []])._marshall()
+
+    def managed_objects():
+        Message(message_type=MessageType.SIGNAL, path='/bench',
+                interface='org.example.Bench', member='M',
+                signature='a{oa{sa{sv}}}', body=[tree])._marshall()
+
+    write = Message(message_type=MessageType.SIGNAL, path='/bench',
+                    interface=gatt.GATT_CHRC_IFACE, member='W',
+                    signature='aya{sv}',
+                    body=[payload, {'offset': Variant('q', 0)}])._marshall()
+
+    def write_value():
+        unmarshaller = Unmarshaller(io.BytesIO(write))
+        unmarshaller.unmarshall()
+        backend_aio.unwrap(unmarshaller.message.body[1])
+
+    return read_reply, notify, managed_objects, write_value
+
+
+def measure(func, count):
+    func()
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - start) * 1e6 / count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=transfer.MAX_ATTR_LEN)
+    parser.add_argument('--count', type=int, default=2000)
+    args = parser.parse_args()
+
+    # The attribute tree is built without a bus; nothing is exported.
+    import main as hub
+    app = hub.Application(None)
+    payload = os.urandom(args.size)
+    frame = os.urandom(transfer.chunk_size(247) + transfer.FRAME_HEADER.size)
+
+    names = ('read_reply', 'notify', 'managed_objects', 'write_value')
+    print('size=%d count=%d (us per message)' % (args.size, args.count))
+    print('%-8s' % 'backend' + ''.join('%16s' % name for name in names))
+    for backend, cases in (('glib', glib_cases), ('aio', aio_cases)):
+        try:
+            funcs = cases(payload, frame, app)
+        except ImportError as e:
+            print('%-8s skipped: %s' % (backend, e))
+            continue
+        print('%-8s' % backend +
+              ''.join('%16.1f' % measure(f, args.count) for f in funcs))
+
+
+if __name__ == '__main__':
+    main()
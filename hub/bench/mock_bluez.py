@@ -0,0 +1,330 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Stand-in for the parts of org.bluez the hub talks to, built on dbus_next so
+it can run on a private bus next to the hub. Adapters expose GattManager1
+and LEAdvertisingManager1 under an ObjectManager at '/'. Registering an
+application or advertisement makes the mock call back into the hub the way
+bluetoothd does (GetManagedObjects / GetAll) before replying, and every
+registration is recorded with its timing. Adapters can come and go and
+centrals connect to the ones advertising, announced with the signals
+bluetoothd sends. PropertiesChanged of a registered advertisement updates
+its recorded properties, as bluetoothd reprograms the advertising data.
+Advertisements are laid out as bluetoothd does for legacy advertising,
+and one whose data or scan response passes LEGACY_MAX_BYTES is refused
+with InvalidLength, as controllers before Bluetooth 5 make it.
+
+"""
+
+import itertools
+import random
+import time
+
+from dbus_next import DBusError, Message, MessageType, Variant
+from dbus_next.service import ServiceInterface, method
+
+BLUEZ_SERVICE_NAME = 'org.bluez'
+DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
+GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
+LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+DEVICE_IFACE = 'org.bluez.Device1'
+
+LEGACY_MAX_BYTES = 31
+# Flags, which bluetoothd adds to every advertisement of a peripheral.
+FLAGS_BYTES = 3
+TX_POWER_BYTES = 3
+
+
+def uuid_bytes(uuid):
+    return {4: 2, 8: 4}.get(len(uuid), 16)
+
+
+def uuids_size(uuids):
+    """Bytes of the UUID list fields, one per UUID size."""
+    sizes = [uuid_bytes(uuid) for uuid in uuids]
+    return sum(2 + sizes.count(size) * size for size in set(sizes))
+
+
+def legacy_sizes(properties):
+    """
+    Bytes of the advertising data and of the scan response bluetoothd
+    builds from an advertisement's properties (values unwrapped).
+
+    """
+    data = FLAGS_BYTES + uuids_size(properties.get('ServiceUUIDs', ())) + \
+            uuids_size(properties.get('SolicitUUIDs', ()))
+    for value in properties.get('ManufacturerData', {}).values():
+        data += 4 + len(value)
+    for uuid, value in properties.get('ServiceData', {}).items():
+        data += 2 + uuid_bytes(uuid) + len(value)
+    for value in properties.get('Data', {}).values():
+        data += 2 + len(value)
+    if properties.get('IncludeTxPower'):
+        data += TX_POWER_BYTES
+    scan_response = uuids_size(
+            properties.get('ScanResponseServiceUUIDs', ()))
+    if properties.get('LocalName'):
+        scan_response += 2 + len(properties['LocalName'].encode('utf-8'))
+    return data, scan_response
+
+
+def unwrap(value):
+    if isinstance(value, Variant):
+        value = value.value
+    if isinstance(value, dict):
+        return dict((key, unwrap(item)) for key, item in value.items())
+    return value
+
+
+def check_legacy(properties):
+    """Raises InvalidLength if 'properties' do not fit legacy advertising."""
+    data, scan_response = legacy_sizes(unwrap(properties))
+    if data > LEGACY_MAX_BYTES or scan_response > LEGACY_MAX_BYTES:
+        raise DBusError('org.bluez.Error.InvalidLength',
+                        'advertising data %d bytes, scan response %d; at '
+                        'most %d each' % (data, scan_response,
+                                          LEGACY_MAX_BYTES))
+
+
+class Registration(object):
+
+    def __init__(self, kind, adapter, sender, path):
+        self.kind = kind
+        self.adapter = adapter
+        self.sender = sender
+        self.path = path
+        self.requested = time.monotonic()
+        self.completed = None
+        self.objects = None
+        # monotonic() of each PropertiesChanged of an advertisement.
+        self.updates = []
+        # PropertiesChanged that made the advertisement too long, and
+        # were not applied.
+        self.rejected = []
+
+
+class ObjectManager(ServiceInterface):
+
+    def __init__(self, mock):
+        ServiceInterface.__init__(self, DBUS_OM_IFACE)
+        self.mock = mock
+
+    @method()
+    def GetManagedObjects(self) -> 'a{oa{sa{sv}}}':
+        objects = {}
+        for adapter in self.mock.adapters:
+            objects[adapter.path] = adapter.interfaces_properties()
+            for device in adapter.devices:
+                objects[device] = device_properties(adapter)
+        return objects
+
+
+def device_properties(adapter):
+    return {DEVICE_IFACE: {'Adapter': Variant('o', adapter.path),
+                           'Connected': Variant('b', True)}}
+
+
+class GattManager(ServiceInterface):
+
+    def __init__(self, adapter):
+        ServiceInterface.__init__(self, GATT_MANAGER_IFACE)
+        self.adapter = adapter
+
+    @method()
+    async def RegisterApplication(self, application: 'o', options: 'a{sv}'):
+        mock = self.adapter.mock
+        reg = Registration('application', self.adapter.path,
+                           mock.sender_of('RegisterApplication',
+                                          self.adapter.path, application),
+                           application)
+        reply = await mock.bus.call(Message(
+                destination=reg.sender, path=application,
+                interface=DBUS_OM_IFACE, member='GetManagedObjects'))
+        reg.completed = time.monotonic()
+        if reply.message_type != MessageType.METHOD_RETURN:
+            raise DBusError('org.bluez.Error.Failed', reply.error_name)
+        reg.objects = reply.body[0]
+        self.adapter.applications.append(reg)
+        mock.registered(reg)
+
+    @method()
+    def UnregisterApplication(self, application: 'o'):
+        self.adapter.applications = [
+                r for r in self.adapter.applications if r.path != application]
+
+
+class AdvertisingManager(ServiceInterface):
+
+    def __init__(self, adapter):
+        ServiceInterface.__init__(self, LE_ADVERTISING_MANAGER_IFACE)
+        self.adapter = adapter
+
+    @method()
+    async def RegisterAdvertisement(self, advertisement: 'o',
+                                    options: 'a{sv}'):
+        mock = self.adapter.mock
+        reg = Registration('advertisement', self.adapter.path,
+                           mock.sender_of('RegisterAdvertisement',
+                                          self.adapter.path, advertisement),
+                           advertisement)
+        reply = await mock.bus.call(Message(
+                destination=reg.sender, path=advertisement,
+                interface=DBUS_PROP_IFACE, member='GetAll', signature='s',
+                body=[LE_ADVERTISEMENT_IFACE]))
+        reg.completed = time.monotonic()
+        if reply.message_type != MessageType.METHOD_RETURN:
+            raise DBusError('org.bluez.Error.Failed', reply.error_name)
+        check_legacy(reply.body[0])
+        reg.objects = reply.body[0]
+        self.adapter.advertisements.append(reg)
+        mock.registered(reg)
+
+    @method()
+    def UnregisterAdvertisement(self, advertisement: 'o'):
+        self.adapter.advertisements = [
+                r for r in self.adapter.advertisements
+                if r.path != advertisement]
+
+
+class Adapter(object):
+
+    def __init__(self, mock, index):
+        self.mock = mock
+        self.path = '/org/bluez/hci%d' % index
+        self.address = '00:00:00:00:00:%02X' % index
+        self.applications = []
+        self.advertisements = []
+        self.devices = []
+        self.interfaces = [GattManager(self), AdvertisingManager(self)]
+
+    def interfaces_properties(self):
+        return {
+                ADAPTER_IFACE: {
+                        'Address': Variant('s', self.address),
+                        'Powered': Variant('b', True),
+                },
+                GATT_MANAGER_IFACE: {},
+                LE_ADVERTISING_MANAGER_IFACE: {
+                        'ActiveInstances': Variant(
+                                'y', len(self.advertisements)),
+                },
+        }
+
+
+class MockBluez(object):
+    """
+    Owns org.bluez on 'bus' and serves 'adapters' fake controllers.
+    'on_registered' is called with every completed Registration.
+
+    """
+    def __init__(self, bus, adapters=1, on_registered=None):
+        self.bus = bus
+        self.adapters = []
+        self.senders = {}
+        self.on_registered = on_registered
+        self.indices = itertools.count()
+        self.devices = itertools.count(1)
+        self.bus.add_message_handler(self._track_sender)
+        self.bus.add_message_handler(self._track_changes)
+        self.bus.export('/', ObjectManager(self))
+        for index in range(adapters):
+            self.add_adapter()
+
+    async def start(self):
+        await self.bus.request_name(BLUEZ_SERVICE_NAME)
+        await self.bus.call(Message(
+                destination='org.freedesktop.DBus',
+                path='/org/freedesktop/DBus',
+                interface='org.freedesktop.DBus', member='AddMatch',
+                signature='s',
+                body=["type='signal',interface='%s',"
+                      "member='PropertiesChanged',arg0='%s'" % (
+                              DBUS_PROP_IFACE, LE_ADVERTISEMENT_IFACE)]))
+
+    def add_adapter(self):
+        adapter = Adapter(self, next(self.indices))
+        for interface in adapter.interfaces:
+            self.bus.export(adapter.path, interface)
+        self.adapters.append(adapter)
+        self._signal('/', DBUS_OM_IFACE, 'InterfacesAdded', 'oa{sa{sv}}',
+                     [adapter.path, adapter.interfaces_properties()])
+        return adapter
+
+    def remove_adapter(self, adapter):
+        for device in list(adapter.devices):
+            self.disconnect(device)
+        for interface in adapter.interfaces:
+            self.bus.unexport(adapter.path, interface)
+        self.adapters.remove(adapter)
+        self._signal('/', DBUS_OM_IFACE, 'InterfacesRemoved', 'oas',
+                     [adapter.path, list(adapter.interfaces_properties())])
+
+    def connect(self):
+        """
+        A new central connects to one of the adapters advertising, picked
+        at random as a scanning central would; returns its device path, or
+        None if nothing advertises.
+
+        """
+        advertising = [a for a in self.adapters if a.advertisements]
+        if not advertising:
+            return None
+        adapter = random.choice(advertising)
+        device = '%s/dev_00_00_00_00_%02X_%02X' % (
+                adapter.path, *divmod(next(self.devices), 256))
+        adapter.devices.append(device)
+        self._signal('/', DBUS_OM_IFACE, 'InterfacesAdded', 'oa{sa{sv}}',
+                     [device, device_properties(adapter)])
+        return device
+
+    def disconnect(self, device):
+        for adapter in self.adapters:
+            if device in adapter.devices:
+                adapter.devices.remove(device)
+                self._signal(device, DBUS_PROP_IFACE, 'PropertiesChanged',
+                             'sa{sv}as', [DEVICE_IFACE,
+                                          {'Connected': Variant('b', False)},
+                                          []])
+                self._signal('/', DBUS_OM_IFACE, 'InterfacesRemoved', 'oas',
+                             [device, [DEVICE_IFACE]])
+
+    def _signal(self, path, interface, member, signature, body):
+        self.bus.send(Message.new_signal(path, interface, member, signature,
+                                         body))
+
+    def registered(self, reg):
+        if self.on_registered is not None:
+            self.on_registered(reg)
+
+    def sender_of(self, member, path, obj):
+        return self.senders.pop((member, path, obj))
+
+    def _track_sender(self, msg):
+        # Method handlers do not see the message, so remember who is
+        # registering before dispatch; the callbacks need the hub's unique
+        # name.
+        if msg.message_type == MessageType.METHOD_CALL and \
+                msg.member in ('RegisterApplication', 'RegisterAdvertisement'):
+            self.senders[(msg.member, msg.path, msg.body[0])] = msg.sender
+        return None
+
+    def _track_changes(self, msg):
+        if msg.message_type != MessageType.SIGNAL or \
+                msg.member != 'PropertiesChanged' or \
+                msg.body[0] != LE_ADVERTISEMENT_IFACE:
+            return None
+        for adapter in self.adapters:
+            for reg in adapter.advertisements:
+                if reg.path == msg.path and reg.sender == msg.sender:
+                    objects = dict(reg.objects, **msg.body[1])
+                    try:
+                        check_legacy(objects)
+                    except DBusError as e:
+                        # bluetoothd keeps advertising the old data.
+                        reg.rejected.append(e.text)
+                        continue
+                    reg.objects = objects
+                    reg.updates.append(time.monotonic())
+        return None
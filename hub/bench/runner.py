@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Play to first statement latency of the program runner: time from
+ProgramRunner.run() until the worker starts executing the program, over
+a warm pool, against starting a fresh interpreter for each run as the
+hub would without one. Also checks that the CPU and memory limits end a
+run without losing the worker.
+
+    python3 bench/runner.py [--runs N] [--workers N]
+
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import eventloop
+import runner
+from backend_aio import AsyncioLoop
+
+PROGRAM = '''
+import math
+total = 0
+for i in range(1000):
+    total += math.sqrt(i)
+print(total)
+'''
+
+
+async def wait_for(predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise RuntimeError('timed out')
+        await asyncio.sleep(0.001)
+
+
+async def bench(args):
+    eventloop.use(AsyncioLoop(asyncio.get_running_loop()))
+    pool = runner.ProgramRunner(size=args.workers, cpu_limit_s=1,
+                                memory_limit=256 * 1024 * 1024)
+    start = time.perf_counter()
+    pool.start()
+    await wait_for(lambda: all(w.ready for w in pool.workers))
+    print('pool of %d ready in %.0f ms' % (
+            args.workers, (time.perf_counter() - start) * 1000))
+
+    for i in range(args.runs):
+        # A new source every other run, so both compile paths are taken.
+        run = pool.run(PROGRAM + '# %d\n' % (i // 2))
+        await wait_for(lambda: run.state in ('done', 'failed'))
+    stats = pool.stats()
+    print('warm pool: p50 %.2f ms, p99 %.2f ms, max %.2f ms '
+          '(%d compiles, %d cached)' % (
+                  stats['latency_p50_ms'], stats['latency_p99_ms'],
+                  stats['latency_max_ms'], stats['compiles'],
+                  stats['compile_hits']))
+
+    cold = []
+    for _ in range(min(args.runs, 10)):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c',
+                        'import math, random, time, json, re, collections'])
+        cold.append(time.perf_counter() - start)
+    cold.sort()
+    print('fresh interpreter: p50 %.2f ms' % (cold[len(cold) // 2] * 1000))
+
+    for name, source in (('cpu', 'while True: pass'),
+                         ('memory', 'x = bytearray(1 << 30)'),
+                         ('stop', 'import time\ntime.sleep(60)')):
+        run = pool.run(source, name)
+        if name == 'stop':
+            await wait_for(lambda: run.latency is not None)
+            pool.stop(run.id)
+        await wait_for(lambda: run.state not in ('queued', 'running'))
+        print('%-8s%-10s%-30s workers %d' % (name, run.state, run.error,
+                                             len(pool.workers)))
+    pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=runner.POOL_SIZE)
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Notifications and bytes per sample of the heart rate sampling pipeline,
+per-sample against batched at the default and a large ATT MTU, for a
+source sampling every --interval-ms over --seconds of simulated time.
+Also the CPU time the ring and packer cost per sample.
+
+    python3 bench/sampling.py [--seconds S] [--interval-ms MS]
+
+"""
+
+import argparse
+import os
+import sys
+import time
+from random import randint
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import eventloop
+import sampling
+import transfer
+
+# Heart Rate Measurement flags, bpm, and energy expended every tenth.
+PER_SAMPLE_BYTES = 2.2
+
+
+class NoLoop(object):
+    """Timers are never due: the bench drives flush() with its own clock."""
+
+    def timeout_add(self, interval_ms, callback):
+        return 1
+
+    def source_remove(self, source_id):
+        pass
+
+    def monotonic_ms(self):
+        return 0
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.notifications = 0
+        self.bytes = 0
+
+    def notify_value(self, value):
+        self.notifications += 1
+        self.bytes += len(value) + transfer.ATT_NOTIFY_OVERHEAD
+
+
+def batched(samples, interval_ms, mtu):
+    ring = sampling.SampleRing('B')
+    chrc = Counter()
+    packer = sampling.BatchPacker(ring, chrc, mtu)
+    start = time.process_time()
+    for i in range(samples):
+        now = i * interval_ms
+        ring.append(now, randint(90, 130))
+        packer.flush(now)
+    packer.flush(samples * interval_ms, force=True)
+    cpu = time.process_time() - start
+    assert packer.samples == samples and not ring.overruns
+    return chrc, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=600)
+    parser.add_argument('--interval-ms', type=int, default=10)
+    args = parser.parse_args()
+    eventloop.use(NoLoop())
+
+    samples = int(args.seconds * 1000 / args.interval_ms)
+    print('%d samples, one every %d ms' % (samples, args.interval_ms))
+    print('%-22s%12s%16s%14s' % ('mode', 'notify/s', 'bytes/sample',
+                                 'us/sample'))
+    print('%-22s%12.1f%16.2f%14s' % (
+            'per-sample', samples / args.seconds,
+            PER_SAMPLE_BYTES + transfer.ATT_NOTIFY_OVERHEAD, '-'))
+    for mtu in (transfer.DEFAULT_MTU, 247):
+        chrc, cpu = batched(samples, args.interval_ms, mtu)
+        print('%-22s%12.1f%16.2f%14.2f' % (
+                'batched, MTU %d' % mtu, chrc.notifications / args.seconds,
+                chrc.bytes / float(samples), cpu * 1e6 / samples))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Per-client state over a day of centrals. Runs the hub against the mock
+org.bluez of harness.py; two centrals connected at once write the test
+characteristics and must each read back their own values. Then --devices
+centrals connect one after the other, each filling the three test
+characteristics before disconnecting, and the RSS of the hub is printed
+every --every devices: with idle sessions evicted (see sessions.py) it
+levels off instead of growing with the number of devices seen. Finally,
+the most recent device must still find its values and the first must
+not.
+
+    python3 bench/sessions.py [--backend glib|aio] [--devices N]
+                              [--every N]
+
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from dbus_next import Variant
+from dbus_next.aio import MessageBus
+
+from harness import (DBUS_OM_IFACE, GATT_CHRC_IFACE, SRC, TEST_SVC_UUID,
+                     Central, find_chrc, process_rss, start_bus,
+                     wait_registered)
+from mock_bluez import MockBluez
+
+import transfer
+
+TEST_UUIDS = ('12345678-1234-5678-1234-56789abcdef1',
+              '12345678-1234-5678-1234-56789abcdef3',
+              '12345678-1234-5678-1234-56789abcdef5')
+# Time the hub gets to see a disconnection.
+SETTLE_S = 0.01
+
+
+def value_for(device, uuid):
+    tag = ('%s %s ' % (device, uuid)).encode()
+    return (tag * (transfer.MAX_ATTR_LEN // len(tag) + 1))[
+            :transfer.MAX_ATTR_LEN]
+
+
+async def read(central, chrc, device):
+    reply = await central.call(chrc, GATT_CHRC_IFACE, 'ReadValue', 'a{sv}',
+                               [{'device': Variant('o', device)}])
+    return reply.body[0]
+
+
+async def fill(central, chrcs, device):
+    for uuid, chrc in chrcs.items():
+        await central.long_write(chrc, value_for(device, uuid), 247,
+                                 device=device)
+
+
+async def run(args, address):
+    bus = await MessageBus(bus_address=address).connect()
+    ready = asyncio.get_running_loop().create_future()
+    registrations = {}
+
+    def on_registered(reg):
+        registrations.setdefault(reg.kind, reg)
+        if len(registrations) == 2 and not ready.done():
+            ready.set_result(None)
+
+    mock = MockBluez(bus, on_registered=on_registered)
+    await mock.start()
+    env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS=address,
+               HUB_LOG_LEVEL='WARNING')
+    hub = subprocess.Popen([sys.executable, os.path.join(SRC, 'main.py'),
+                            '--backend', args.backend,
+                            '--wifi-backend', 'stub'], env=env)
+    try:
+        await wait_registered(hub, ready, 30)
+        app = registrations['application']
+        central = Central(bus, app.sender)
+        objects = (await central.call(app.path, DBUS_OM_IFACE,
+                                      'GetManagedObjects')).body[0]
+        chrcs = dict((uuid, find_chrc(objects, TEST_SVC_UUID, uuid))
+                     for uuid in TEST_UUIDS)
+
+        first = mock.connect()
+        second = mock.connect()
+        await fill(central, chrcs, first)
+        await fill(central, chrcs, second)
+        for device in (first, second):
+            for uuid, chrc in chrcs.items():
+                if await read(central, chrc, device) != \
+                        value_for(device, uuid):
+                    raise RuntimeError('%s did not read its own value' %
+                                       device)
+        print('two centrals at once: each read back its own values')
+        mock.disconnect(first)
+        mock.disconnect(second)
+
+        start = time.perf_counter()
+        last = None
+        for i in range(1, args.devices + 1):
+            device = mock.connect()
+            await fill(central, chrcs, device)
+            mock.disconnect(device)
+            await asyncio.sleep(SETTLE_S)
+            last = device
+            if i % args.every == 0:
+                print('%5d devices  rss %6d kB  %.0f s' % (
+                        i, process_rss(hub.pid)['rss_kb'],
+                        time.perf_counter() - start))
+
+        uuid = TEST_UUIDS[0]
+        kept = await read(central, chrcs[uuid], last) == \
+                value_for(last, uuid)
+        evicted = await read(central, chrcs[uuid], first) == b''
+        print('last device found its values: %s, first device evicted: %s' %
+              (kept, evicted))
+    finally:
+        hub.send_signal(signal.SIGINT)
+        try:
+            hub.wait(5)
+        except subprocess.TimeoutExpired:
+            hub.kill()
+        bus.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=('glib', 'aio'), default='aio')
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--every', type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        daemon, address = start_bus(tmpdir)
+        try:
+            asyncio.run(run(args, address))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Time to advertise. Starts the hub --runs times against the mock org.bluez
+of harness.py, with and without --fast-startup (alternately, so both see
+the same machine), and prints the medians of the time from launching it
+until the advertisement and the application are registered, as seen
+from the mock, and of when the hub itself saw each of its startup phases
+end (see startup.py).
+
+    python3 bench/startup.py [--backend glib|aio] [--runs N]
+
+"""
+
+import argparse
+import asyncio
+import collections
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from dbus_next.aio import MessageBus
+
+from harness import (DBUS_OM_IFACE, HUB_SVC_UUID, SRC, STARTUP_UUID,
+                     Central, find_chrc, start_bus, wait_registered)
+from mock_bluez import MockBluez
+
+# Lets the workers of the last hub exit before the next one starts.
+SETTLE_S = 1.0
+
+
+def median(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2]
+
+
+async def start_once(args, address, fast):
+    bus = await MessageBus(bus_address=address).connect()
+    ready = asyncio.get_running_loop().create_future()
+    registrations = {}
+
+    def on_registered(reg):
+        registrations.setdefault(reg.kind, reg)
+        if len(registrations) == 2 and not ready.done():
+            ready.set_result(None)
+
+    mock = MockBluez(bus, on_registered=on_registered)
+    await mock.start()
+    env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS=address,
+               HUB_LOG_LEVEL='WARNING')
+    launched = time.monotonic()
+    hub = subprocess.Popen([sys.executable, os.path.join(SRC, 'main.py'),
+                            '--backend', args.backend,
+                            '--wifi-backend', 'stub'] +
+                           (['--fast-startup'] if fast else []), env=env)
+    try:
+        await wait_registered(hub, ready, 30)
+        app = registrations['application']
+        adv = registrations['advertisement']
+        central = Central(bus, app.sender)
+        objects = (await central.call(app.path, DBUS_OM_IFACE,
+                                      'GetManagedObjects')).body[0]
+        breakdown = await central.read_json(
+                find_chrc(objects, HUB_SVC_UUID, STARTUP_UUID))
+        return (adv.completed - launched, app.completed - launched,
+                breakdown['phases'])
+    finally:
+        hub.send_signal(signal.SIGINT)
+        try:
+            hub.wait(5)
+        except subprocess.TimeoutExpired:
+            hub.kill()
+        bus.disconnect()
+
+
+async def run(args, address):
+    modes = (False, True)
+    advertised = dict((fast, []) for fast in modes)
+    registered = dict((fast, []) for fast in modes)
+    phases = dict((fast, collections.OrderedDict()) for fast in modes)
+    for _ in range(args.runs):
+        for fast in modes:
+            await asyncio.sleep(SETTLE_S)
+            adv, app, breakdown = await start_once(args, address, fast)
+            advertised[fast].append(adv)
+            registered[fast].append(app)
+            for phase in breakdown:
+                phases[fast].setdefault(phase['phase'], []) \
+                        .append(phase['at_ms'])
+    for fast in modes:
+        print('%s: advertised after %.1f ms, application registered after '
+              '%.1f ms (medians of %d)' % (
+                      'fast startup' if fast else 'default',
+                      median(advertised[fast]) * 1000,
+                      median(registered[fast]) * 1000, args.runs))
+        for name, samples in phases[fast].items():
+            print('    %-26s %8.1f ms' % (name, median(samples)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=('glib', 'aio'), default='aio')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        daemon, address = start_bus(tmpdir)
+        try:
+            asyncio.run(run(args, address))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+
+if __name__ == '__main__':
+    main()
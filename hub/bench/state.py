@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Cost of the state kept across restarts (see state.py). --writes values
+are set over --keys keys from a 1 ms timer, the way characteristics do
+from the main loop, first writing each through to disk and syncing it on
+the spot, then through a StateStore for each durability window given.
+For each, prints how long set() takes, the longest the main loop goes
+without running its timer, and the bytes written to disk for every byte
+set. Finally times loading the log back, as at the next start, with
+--keys keys and with --keys times 100.
+
+    python3 bench/state.py [--writes N] [--keys N] [--value-len N]
+                           [--windows MS,...]
+
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import eventloop
+import state
+from backend_aio import AsyncioLoop
+
+
+class WriteThrough(object):
+    """Appends each value set to the log and syncs it before returning."""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                          0o644)
+        self.bytes_set = 0
+        self.bytes_written = 0
+
+    def set(self, key, value):
+        record = state.encode_record(key, value)
+        os.write(self.fd, record)
+        os.fdatasync(self.fd)
+        self.bytes_set += len(key) + len(value)
+        self.bytes_written += len(record)
+
+    def close(self):
+        os.close(self.fd)
+
+
+async def drive(store, args):
+    """Sets the values, one per tick; returns set() times and worst lag."""
+    done = asyncio.get_running_loop().create_future()
+    times = []
+    lag = [0.0]
+    last = [time.perf_counter()]
+
+    def tick():
+        now = time.perf_counter()
+        lag[0] = max(lag[0], now - last[0])
+        last[0] = now
+        i = len(times)
+        if i == args.writes:
+            if not done.done():
+                done.set_result(None)
+            return False
+        value = (b'%08d' % i) * (args.value_len // 8)
+        start = time.perf_counter()
+        store.set('key%d' % (i % args.keys), value)
+        times.append(time.perf_counter() - start)
+        return True
+    eventloop.timeout_add(1, tick)
+    await done
+    return sorted(times), lag[0]
+
+
+def report(name, times, lag, amplification):
+    print('%-18s set() p50 %7.3f ms  p99 %7.3f ms  max %7.3f ms  '
+          'stall %7.2f ms  amplification %.2f' % (
+                  name, times[len(times) // 2] * 1000,
+                  times[len(times) * 99 // 100] * 1000, times[-1] * 1000,
+                  lag * 1000, amplification))
+
+
+def time_load(path):
+    store = state.StateStore(path)
+    store.load()
+    keys = len(store.values)
+    store.close()
+    return keys, os.path.getsize(path), store.load_ms
+
+
+async def bench(args, tmpdir):
+    eventloop.use(AsyncioLoop(asyncio.get_running_loop()))
+
+    through = WriteThrough(os.path.join(tmpdir, 'through.log'))
+    times, lag = await drive(through, args)
+    through.close()
+    report('write-through', times, lag,
+           float(through.bytes_written) / through.bytes_set)
+
+    for window in args.windows:
+        path = os.path.join(tmpdir, 'state-%d.log' % window)
+        store = state.StateStore(path, interval_ms=window)
+        times, lag = await drive(store, args)
+        store.close()
+        stats = store.stats()
+        report('window %d ms' % window, times, lag,
+               stats['write_amplification'])
+        print('%18s %d flushes, %d compactions, log %d bytes' % (
+                '', stats['flushes'], stats['compactions'],
+                stats['log_bytes']))
+
+    print('loaded %d keys (%d byte log) in %.2f ms' % time_load(path))
+    big = os.path.join(tmpdir, 'big.log')
+    store = state.StateStore(big)
+    value = b'x' * args.value_len
+    for i in range(args.keys * 100):
+        store.set('key%d' % i, value)
+    store.close()
+    print('loaded %d keys (%d byte log) in %.2f ms' % time_load(big))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writes', type=int, default=2000)
+    parser.add_argument('--keys', type=int, default=100)
+    parser.add_argument('--value-len', type=int, default=64)
+    parser.add_argument('--windows', default='0,100,1000',
+                        type=lambda s: [int(ms) for ms in s.split(',')])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        asyncio.run(bench(args, tmpdir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Cost of a WriteValue followed by ReadValue calls for one characteristic
+value, comparing the old representation (the 'ay' argument demarshalled
+into a list of dbus.Byte and handed back as is) with values.Value fed by
+byte_arrays=True. Values go through real D-Bus messages, which is what
+dbus-python does with the call and its reply, so no bus is needed.
+Requires dbus-python.
+
+For each case it prints the time per operation and the peak memory
+traced while doing it, which is what a single call allocates.
+
+    python3 bench/value_read.py [--size BYTES] [--reads N]
+
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import dbus
+import dbus.lowlevel
+
+import values
+from values import Value
+
+# As set up by the glib backend.
+values.marshal = dbus.ByteArray
+
+
+def message(payload):
+    msg = dbus.lowlevel.SignalMessage('/bench', 'org.example.Bench', 'Write')
+    msg.append(payload, signature='ay')
+    return msg
+
+
+def write_list(msg):
+    return msg.get_args_list()[0]
+
+
+def read_list(stored):
+    return stored
+
+
+def write_value(msg):
+    return Value(msg.get_args_list(byte_arrays=True)[0])
+
+
+def read_value(stored):
+    return stored.get()
+
+
+def measure(func, arg, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(count):
+        result = func(arg)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed * 1e6 / count, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=4096)
+    parser.add_argument('--reads', type=int, default=1000)
+    args = parser.parse_args()
+
+    msg = message(os.urandom(args.size))
+    reply = lambda read: lambda stored: message(read(stored))
+
+    print('size=%d reads=%d' % (args.size, args.reads))
+    for name, write, read in (('list', write_list, read_list),
+                              ('value', write_value, read_value)):
+        stored, write_us, write_peak = measure(write, msg, 100)
+        _, read_us, read_peak = measure(reply(read), stored, args.reads)
+        print('%-6s write %8.1f us %7d B peak | read %8.1f us %7d B peak' %
+              (name, write_us, write_peak, read_us, read_peak))
+
+
+if __name__ == '__main__':
+    main()
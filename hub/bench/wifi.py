@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Responsiveness of the Wi-Fi service with commands as slow as real ones
+(the stub backend sleeping --delay-ms each): the longest the main loop
+goes without running a 1 ms timer while scans and a connect run, and
+how long scan reads take to be answered, the first against those served
+from the cache.
+
+    python3 bench/wifi.py [--delay-ms MS] [--reads N]
+
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import eventloop
+import wifi
+from backend_aio import AsyncioLoop
+
+
+async def wait_for(predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise RuntimeError('timed out')
+        await asyncio.sleep(0.001)
+
+
+async def scan(manager):
+    future = asyncio.get_running_loop().create_future()
+    start = time.perf_counter()
+    manager.scan(lambda networks, error: future.done() or
+                 future.set_result(networks))
+    await future
+    return (time.perf_counter() - start) * 1000
+
+
+async def bench(args):
+    eventloop.use(AsyncioLoop(asyncio.get_running_loop()))
+    statuses = []
+    manager = wifi.WifiManager(wifi.StubBackend(args.delay_ms / 1000.0),
+                               on_status=statuses.append)
+
+    lag = [0.0]
+    last = [time.perf_counter()]
+
+    def tick():
+        now = time.perf_counter()
+        lag[0] = max(lag[0], now - last[0])
+        last[0] = now
+        return True
+    eventloop.timeout_add(1, tick)
+
+    first = await scan(manager)
+    cached = sorted([await scan(manager) for _ in range(args.reads)])
+    print('first scan read  %8.2f ms' % first)
+    print('cached scan read p50 %.3f ms, max %.3f ms' % (
+            cached[len(cached) // 2], cached[-1]))
+
+    manager.scan_ttl_ms = 0
+    stale = await scan(manager)
+    await wait_for(lambda: not manager.scanning())
+    print('stale scan read  %8.3f ms (refreshed in the background)' % stale)
+
+    manager.connect('hub-lab', 'password123')
+    await wait_for(lambda: statuses[-1]['state'] == wifi.STATE_CONNECTED)
+    manager.connect('nowhere', None)
+    await wait_for(lambda: statuses[-1]['error'] is not None)
+    print('statuses notified: %s' % ', '.join(
+            status['state'] for status in statuses))
+    print('longest main loop stall %.2f ms, commands %s' % (
+            lag[0] * 1000, dict(manager.backend.commands)))
+    manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delay-ms', type=float, default=2000)
+    parser.add_argument('--reads', type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Adapters the hub serves on. The application is registered on every
+adapter exposing GattManager1 and LEAdvertisingManager1, and the
+advertisement only on the ones with the fewest connections and room for
+more, so new centrals land on the least loaded controller: once an
+adapter gets ahead it stops advertising until the others catch up.
+
+Backends feed an AdapterPool bluetoothd's view, from GetManagedObjects
+at startup and then from ObjectManager InterfacesAdded/InterfacesRemoved
+and Device1 PropertiesChanged signals, with properties as plain Python
+values. They register and unregister through a binding object:
+
+    register_application(adapter, callback)
+    register_advertisement(adapter, callback)
+    unregister_advertisement(adapter)
+
+the callbacks taking the error of the call or None. Devices connecting
+and disconnecting are passed on to sessions.store.
+
+With advertise_first, an adapter advertises as soon as it is found, and
+the application is only registered once the advertisement is: the hub
+shows up sooner, and services built when BlueZ first asks for the
+application (see gatt.Application.add_lazy_service) are built while the
+advertisement is already out instead of holding it up.
+
+"""
+
+import log
+import metrics
+import sessions
+import startup
+from gatt import GATT_MANAGER_IFACE, LE_ADVERTISING_MANAGER_IFACE
+
+DEVICE_IFACE = 'org.bluez.Device1'
+MANAGER_IFACES = (GATT_MANAGER_IFACE, LE_ADVERTISING_MANAGER_IFACE)
+
+# Connections a controller is trusted with; a full adapter stops
+# advertising whatever the others' load.
+MAX_CONNECTIONS = 8
+
+logger = log.get_logger('adapters')
+
+
+class Adapter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.devices = set()
+        self.registered = False
+        self.failed = False
+        # Application waiting for the advertisement, see advertise_first.
+        self.deferred = False
+        self.advertising = False
+        self.connections = 0
+
+
+class AdapterPool(object):
+
+    def __init__(self, binding, max_connections=MAX_CONNECTIONS,
+                 advertise_first=False):
+        self.binding = binding
+        self.max_connections = max_connections
+        self.advertise_first = advertise_first
+        self.adapters = {}
+        # Connected device: its adapter.
+        self.devices = {}
+        metrics.add_gauge('hub_adapter_connections', self._connections)
+        metrics.add_gauge('hub_adapter_advertising', self._advertising)
+
+    def load(self, objects):
+        """Takes in a GetManagedObjects reply, {path: {interface: props}}."""
+        for path, interfaces in sorted(objects.items()):
+            self.interfaces_added(path, interfaces)
+
+    def interfaces_added(self, path, interfaces):
+        if all(iface in interfaces for iface in MANAGER_IFACES):
+            self._add_adapter(path)
+        device = interfaces.get(DEVICE_IFACE)
+        if device is not None:
+            self.properties_changed(path, DEVICE_IFACE, device)
+
+    def interfaces_removed(self, path, interfaces):
+        if DEVICE_IFACE in interfaces:
+            self._disconnected(path)
+        if any(iface in interfaces for iface in MANAGER_IFACES):
+            self._remove_adapter(path)
+
+    def properties_changed(self, path, interface, changed):
+        if interface != DEVICE_IFACE or 'Connected' not in changed:
+            return
+        if changed['Connected']:
+            adapter = changed.get('Adapter') or path.rsplit('/', 1)[0]
+            self._connected(path, adapter)
+        else:
+            self._disconnected(path)
+
+    def stats(self):
+        return dict((path, {'connections': len(adapter.devices),
+                            'registered': adapter.registered,
+                            'advertising': adapter.advertising,
+                            'total_connections': adapter.connections})
+                    for path, adapter in self.adapters.items())
+
+    def _add_adapter(self, path):
+        if path in self.adapters:
+            return
+        adapter = self.adapters[path] = Adapter(path)
+        # Devices reported before their adapter.
+        adapter.devices.update(device for device, owner in self.devices.items()
+                               if owner == path)
+        logger.info('Adapter %s added', path)
+        if self.advertise_first:
+            self._balance()
+            adapter.deferred = adapter.advertising
+        if not adapter.deferred:
+            self._register(adapter)
+
+    def _remove_adapter(self, path):
+        # bluetoothd drops the registrations along with the adapter.
+        if self.adapters.pop(path, None) is not None:
+            logger.info('Adapter %s removed', path)
+            self._balance()
+
+    def _register(self, adapter):
+        logger.info('Registering application on %s', adapter.path)
+        self.binding.register_application(
+                adapter.path,
+                lambda error: self._on_registered(adapter, error))
+
+    def _on_registered(self, adapter, error):
+        if self.adapters.get(adapter.path) is not adapter:
+            return
+        if error is not None:
+            logger.error('Failed to register application on %s: %s',
+                         adapter.path, error)
+            adapter.failed = True
+            self._balance()
+            return
+        logger.info('GATT application registered on %s', adapter.path)
+        adapter.registered = True
+        if startup.mark('application_registered'):
+            logger.info('Started: %s', startup.summary())
+        self._balance()
+
+    def _connected(self, device, path):
+        if self.devices.get(device) == path:
+            return
+        self._disconnected(device)
+        sessions.store.connected(device)
+        self.devices[device] = path
+        adapter = self.adapters.get(path)
+        if adapter is not None:
+            adapter.devices.add(device)
+            adapter.connections += 1
+            logger.debug('%s connected to %s (%d)', device, path,
+                         len(adapter.devices))
+        self._balance()
+
+    def _disconnected(self, device):
+        path = self.devices.pop(device, None)
+        if path is None:
+            return
+        sessions.store.disconnected(device)
+        adapter = self.adapters.get(path)
+        if adapter is not None:
+            adapter.devices.discard(device)
+        self._balance()
+
+    def _balance(self):
+        ready = [adapter for adapter in self.adapters.values()
+                 if (adapter.registered or
+                     (self.advertise_first and not adapter.failed)) and
+                 len(adapter.devices) < self.max_connections]
+        least = min([len(adapter.devices) for adapter in ready] or [0])
+        for adapter in self.adapters.values():
+            wanted = adapter in ready and len(adapter.devices) == least
+            if wanted and not adapter.advertising:
+                adapter.advertising = True
+                self.binding.register_advertisement(
+                        adapter.path,
+                        lambda error, adapter=adapter:
+                                self._on_advertising(adapter, error))
+            elif not wanted and adapter.advertising:
+                adapter.advertising = False
+                logger.debug('Stopped advertising on %s', adapter.path)
+                self.binding.unregister_advertisement(adapter.path)
+        if self.adapters and not ready:
+            logger.warning('No adapter can take more connections')
+
+    def _on_advertising(self, adapter, error):
+        if self.adapters.get(adapter.path) is not adapter:
+            return
+        if adapter.deferred:
+            adapter.deferred = False
+            self._register(adapter)
+        if error is None:
+            logger.debug('Advertising on %s', adapter.path)
+            startup.mark('advertisement_registered')
+            if not adapter.advertising:
+                # Withdrawn while the registration was in flight.
+                self.binding.unregister_advertisement(adapter.path)
+            return
+        logger.error('Failed to register advertisement on %s: %s',
+                     adapter.path, error)
+        adapter.advertising = False
+
+    def _connections(self):
+        return dict(('adapter="%s"' % path, len(adapter.devices))
+                    for path, adapter in self.adapters.items())
+
+    def _advertising(self):
+        return dict(('adapter="%s"' % path, int(adapter.advertising))
+                    for path, adapter in self.adapters.items())
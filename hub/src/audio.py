@@ -0,0 +1,447 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Sound playback for the clips under hub/storage/audios.
+
+Clips are decoded ahead of time by a worker thread into 16-bit mono PCM
+at SAMPLE_RATE and kept in a least recently used cache of at most
+MAX_CACHE_BYTES, so playing a cached clip costs no decoding. WAV files
+in that format are read directly; anything else (MP3) goes through
+ffmpeg or mpg123, whichever is installed.
+
+A mixer thread sums the clips playing, scaled by the volume, and writes
+PERIOD_FRAMES frames at a time to a sink: aplay, a WAV file or nothing.
+It stays at most LEAD_PERIODS ahead of real time, and sleeps while
+nothing plays, so a triggered clip reaches the sink within a period.
+
+"""
+
+import collections
+import os
+import shutil
+import subprocess
+import threading
+import time
+import wave
+from array import array
+
+import log
+
+SAMPLE_RATE = 22050
+SAMPLE_WIDTH = 2
+PERIOD_FRAMES = 256
+LEAD_PERIODS = 2
+MAX_CACHE_BYTES = 32 * 1024 * 1024
+AUDIO_DIR = 'audios'
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.ogg', '.flac')
+# Scratch-like volume, in percent.
+DEFAULT_VOLUME = 100
+MAX_VOLUME = 100
+# Trigger latencies kept for the percentiles in stats().
+LATENCY_SAMPLES = 256
+
+# External decoders, tried in order, writing raw s16le mono PCM at
+# SAMPLE_RATE to stdout; {path} is the clip.
+DECODERS = (
+    ('ffmpeg', '-v', 'error', '-i', '{path}', '-f', 's16le', '-ac', '1',
+     '-ar', str(SAMPLE_RATE), '-'),
+    ('mpg123', '-q', '-s', '-m', '-r', str(SAMPLE_RATE), '{path}'),
+)
+
+logger = log.get_logger('audio')
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def decode(full):
+    """The PCM of the clip at 'full', as bytes."""
+    try:
+        with wave.open(full, 'rb') as f:
+            if f.getsampwidth() == SAMPLE_WIDTH and \
+                    f.getframerate() == SAMPLE_RATE:
+                return to_mono(f.readframes(f.getnframes()),
+                               f.getnchannels())
+    except (wave.Error, EOFError):
+        pass
+    for command in DECODERS:
+        if shutil.which(command[0]) is None:
+            continue
+        args = [arg.format(path=full) for arg in command]
+        result = subprocess.run(args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise DecodeError('%s: %s' % (command[0],
+                              result.stderr.decode('utf-8', 'replace')
+                              .strip()))
+        return result.stdout
+    raise DecodeError('no decoder for %s (install ffmpeg or mpg123)' % full)
+
+
+def to_mono(data, channels):
+    if channels == 1:
+        return data
+    samples = array('h', data)
+    return array('h', [sum(samples[i:i + channels]) // channels
+                       for i in range(0, len(samples), channels)]).tobytes()
+
+
+def mix(voices, frames, gain):
+    """The next 'frames' frames of 'voices', advancing each of them."""
+    size = frames * SAMPLE_WIDTH
+    if len(voices) == 1 and gain == 1.0:
+        # One clip at full volume: no arithmetic.
+        voice = voices[0]
+        out = voice.data[voice.pos:voice.pos + size]
+        voice.pos += len(out)
+        return out + bytes(size - len(out))
+    acc = [0] * frames
+    for voice in voices:
+        samples = memoryview(voice.data[voice.pos:voice.pos + size]) \
+                .cast('h')
+        voice.pos += len(samples) * SAMPLE_WIDTH
+        acc[:len(samples)] = map(int.__add__, acc, samples)
+    if gain != 1.0:
+        acc = [int(s * gain) for s in acc]
+    return array('h', [32767 if s > 32767 else -32768 if s < -32768 else s
+                       for s in acc]).tobytes()
+
+
+class Voice(object):
+    """One play of a clip. 'finished' is set once it played or stopped."""
+
+    def __init__(self, path, triggered):
+        self.path = path
+        self.triggered = triggered
+        self.data = None
+        self.cached = False
+        self.pos = 0
+        self.finished = threading.Event()
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+
+class PcmCache(object):
+    """
+    Decoded clips by full path, the least recently used dropped first once
+    they add up to more than 'max_bytes'. An entry is only used while the
+    file keeps the size and mtime it was decoded from.
+
+    """
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, full, stamp):
+        with self.lock:
+            entry = self.entries.get(full)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(full)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, full, stamp, data):
+        with self.lock:
+            old = self.entries.pop(full, None)
+            if old is not None:
+                self.size -= len(old[1])
+            if len(data) > self.max_bytes:
+                return
+            self.entries[full] = (stamp, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def has(self, full, stamp):
+        with self.lock:
+            entry = self.entries.get(full)
+            return entry is not None and entry[0] == stamp
+
+
+class NullSink(object):
+    """Discards audio; paced like a device so timing stays realistic."""
+    realtime = True
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+    """Writes everything played to a WAV file, as fast as it is mixed."""
+    realtime = False
+
+    def __init__(self, path):
+        self.file = wave.open(path, 'wb')
+        self.file.setnchannels(1)
+        self.file.setsampwidth(SAMPLE_WIDTH)
+        self.file.setframerate(SAMPLE_RATE)
+
+    def write(self, data):
+        self.file.writeframes(data)
+
+    def close(self):
+        self.file.close()
+
+
+class AplaySink(object):
+    """Plays through ALSA by piping PCM into aplay."""
+    realtime = True
+
+    def __init__(self, device=None):
+        args = ['aplay', '-q', '-t', 'raw', '-f', 'S16_LE', '-c', '1',
+                '-r', str(SAMPLE_RATE), '--buffer-time=40000']
+        if device:
+            args += ['-D', device]
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def open_sink(spec):
+    """
+    A sink from a --audio-sink value: "null", "file:PATH", "aplay" or
+    "aplay:DEVICE", or "auto" for aplay when installed and null otherwise.
+
+    """
+    name, _, arg = spec.partition(':')
+    if name == 'auto':
+        name = 'aplay' if shutil.which('aplay') else 'null'
+    if name == 'null':
+        return NullSink()
+    if name == 'file':
+        return FileSink(arg)
+    if name == 'aplay':
+        return AplaySink(arg or None)
+    raise ValueError('unknown audio sink %r' % spec)
+
+
+class AudioEngine(object):
+    """
+    Plays clips of 'storage' through 'sink'. Methods are called from the
+    main loop; decoding and mixing run on threads of their own, started by
+    start().
+
+    """
+    def __init__(self, storage, sink, max_bytes=MAX_CACHE_BYTES):
+        self.storage = storage
+        self.sink = sink
+        self.cache = PcmCache(max_bytes)
+        self.volume = DEFAULT_VOLUME
+        self.voices = []
+        # Voices waiting for their clip to be decoded, by full path.
+        self.waiting = {}
+        self.decode_queue = collections.deque()
+        self.decodes = 0
+        self.decode_s = 0.0
+        self.last_decode_s = 0.0
+        # Trigger to first period written, of plays of cached clips.
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.cond = threading.Condition()
+        self.threads = []
+        self.closed = False
+
+    def start(self):
+        if self.threads:
+            return
+        for target, name in ((self._decode_worker, 'audio-decode'),
+                             (self._mixer, 'audio-mixer')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.preload()
+
+    def preload(self, root=AUDIO_DIR):
+        """Queues the clips under 'root' for decoding, if they fit."""
+        try:
+            top = self.storage.resolve(root)
+        except ValueError:
+            return
+        for dirpath, _, names in os.walk(top):
+            for name in sorted(names):
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    self._queue_decode(os.path.join(dirpath, name))
+
+    def play(self, path):
+        """Starts the clip at storage path 'path' and returns its Voice."""
+        full = self.storage.resolve(path)
+        stamp = self._stamp(full)
+        voice = Voice(path, time.perf_counter())
+        data = self.cache.get(full, stamp)
+        with self.cond:
+            if data is None:
+                self.waiting.setdefault(full, []).append(voice)
+                self._queue_decode(full, first=True)
+            else:
+                voice.data = data
+                voice.cached = True
+                self.voices.append(voice)
+            self.cond.notify_all()
+        return voice
+
+    def stop_all(self):
+        with self.cond:
+            voices = self.voices + [voice for voices in self.waiting.values()
+                                    for voice in voices]
+            self.voices = []
+            self.waiting.clear()
+        for voice in voices:
+            voice.finished.set()
+
+    def set_volume(self, volume):
+        self.volume = max(0, min(MAX_VOLUME, volume))
+
+    def change_volume(self, delta):
+        self.set_volume(self.volume + delta)
+
+    def stats(self):
+        with self.cond:
+            latencies = sorted(self.latencies)
+            playing = len(self.voices)
+        lookups = self.cache.hits + self.cache.misses
+
+        def percentile(q):
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1,
+                                       int(q * len(latencies)))] * 1000, 2)
+
+        return {
+                'playing': playing,
+                'volume': self.volume,
+                'cached_clips': len(self.cache.entries),
+                'cached_bytes': self.cache.size,
+                'hits': self.cache.hits,
+                'misses': self.cache.misses,
+                'hit_rate': round(self.cache.hits / float(lookups), 3)
+                if lookups else 0.0,
+                'decodes': self.decodes,
+                'decode_ms': round(self.decode_s * 1000 / self.decodes, 1)
+                if self.decodes else 0.0,
+                'last_decode_ms': round(self.last_decode_s * 1000, 1),
+                'latency_p50_ms': percentile(0.5),
+                'latency_p99_ms': percentile(0.99),
+                'latency_max_ms': round(latencies[-1] * 1000, 2)
+                if latencies else 0.0,
+        }
+
+    def close(self):
+        self.stop_all()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.sink.close()
+
+    def _stamp(self, full):
+        st = os.stat(full)
+        return st.st_size, st.st_mtime_ns
+
+    def _queue_decode(self, full, first=False):
+        with self.cond:
+            if full in self.decode_queue:
+                if not first:
+                    return
+                self.decode_queue.remove(full)
+            if first:
+                self.decode_queue.appendleft(full)
+            else:
+                self.decode_queue.append(full)
+            self.cond.notify_all()
+
+    def _decode_worker(self):
+        while True:
+            with self.cond:
+                while not self.decode_queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                full = self.decode_queue.popleft()
+            try:
+                stamp = self._stamp(full)
+                if self.cache.has(full, stamp):
+                    data = self.cache.get(full, stamp)
+                else:
+                    start = time.perf_counter()
+                    data = decode(full)
+                    elapsed = time.perf_counter() - start
+                    self.decodes += 1
+                    self.decode_s += elapsed
+                    self.last_decode_s = elapsed
+                    self.cache.put(full, stamp, data)
+                    logger.info('Decoded %s in %.0f ms (%d bytes)', full,
+                                elapsed * 1000, len(data))
+            except (OSError, ValueError) as e:
+                logger.warning('Decoding %s failed: %s', full, e)
+                data = None
+            with self.cond:
+                voices = self.waiting.pop(full, [])
+                for voice in voices:
+                    if data is None:
+                        voice.finished.set()
+                    else:
+                        voice.data = data
+                        self.voices.append(voice)
+                self.cond.notify_all()
+
+    def _mixer(self):
+        clock = None
+        frames = 0
+        period_s = PERIOD_FRAMES / float(SAMPLE_RATE)
+        while True:
+            with self.cond:
+                while not self.voices and not self.closed:
+                    clock = None
+                    self.cond.wait()
+                if self.closed:
+                    return
+            now = time.perf_counter()
+            if clock is None:
+                clock = now
+                frames = 0
+            elif self.sink.realtime:
+                ahead = clock + frames / float(SAMPLE_RATE) - now
+                if ahead > LEAD_PERIODS * period_s:
+                    time.sleep(ahead - LEAD_PERIODS * period_s)
+            # Taken after pacing, so a clip started meanwhile is in the
+            # very next period.
+            with self.cond:
+                voices = list(self.voices)
+            if not voices:
+                continue
+            started = [voice for voice in voices if voice.pos == 0]
+            data = mix(voices, PERIOD_FRAMES, self.volume / float(MAX_VOLUME))
+            try:
+                self.sink.write(data)
+            except (OSError, ValueError) as e:
+                logger.warning('Audio sink failed: %s', e)
+            frames += PERIOD_FRAMES
+            written = time.perf_counter()
+            done = [voice for voice in voices
+                    if voice.pos >= len(voice.data)]
+            with self.cond:
+                for voice in started:
+                    if voice.cached:
+                        self.latencies.append(written - voice.triggered)
+                for voice in done:
+                    if voice in self.voices:
+                        self.voices.remove(voice)
+            for voice in done:
+                voice.finished.set()
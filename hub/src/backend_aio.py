@@ -0,0 +1,432 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+asyncio + dbus_next backend: exports the objects of gatt.py as dbus_next
+ServiceInterfaces on an asyncio event loop, without dbus-python or GLib.
+
+Attribute methods run as tasks, so a handler that is a coroutine, or
+that returns a gatt.Deferred, only holds up its own caller while it
+waits; ReadValue and WriteValue go through dispatch.dispatcher, which
+may queue them. Byte arrays are plain bytes in both directions.
+GetManagedObjects and Properties.GetAll are answered from the
+attributes' cached properties, marshalled once, rather than by
+dbus_next's generic handlers.
+
+"""
+
+import asyncio
+import inspect
+import itertools
+
+from dbus_next import BusType, DBusError, Message, MessageType, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.service import ServiceInterface, method
+
+import adapters
+from dispatch import dispatcher
+import eventloop
+import gatt
+import log
+import startup
+from gatt import (BLUEZ_SERVICE_NAME, DBUS_OM_IFACE, DBUS_PROP_IFACE,
+                  GATT_CHRC_IFACE, GATT_DESC_IFACE, GATT_MANAGER_IFACE,
+                  GATT_SERVICE_IFACE, LE_ADVERTISEMENT_IFACE,
+                  LE_ADVERTISING_MANAGER_IFACE)
+
+logger = log.get_logger('gatt')
+adv_logger = log.get_logger('adv')
+
+
+class AsyncioLoop(object):
+    """GLib style timeout and idle sources on an asyncio loop."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.handles = {}
+        self.ids = itertools.count(1)
+
+    def timeout_add(self, interval_ms, callback):
+        source_id = next(self.ids)
+        self._schedule(source_id, interval_ms / 1000.0, callback)
+        return source_id
+
+    def timeout_add_seconds(self, interval, callback):
+        return self.timeout_add(interval * 1000, callback)
+
+    def idle_add(self, callback):
+        return self.timeout_add(0, callback)
+
+    def io_add_watch(self, fd, callback):
+        source_id = next(self.ids)
+        self.loop.add_reader(fd, self._dispatch_io, source_id, callback)
+        self.handles[source_id] = Reader(self.loop, fd)
+        return source_id
+
+    def source_remove(self, source_id):
+        handle = self.handles.pop(source_id, None)
+        if handle is not None:
+            handle.cancel()
+
+    def _schedule(self, source_id, delay, callback):
+        if delay:
+            handle = self.loop.call_later(delay, self._dispatch, source_id,
+                                          delay, callback)
+        else:
+            handle = self.loop.call_soon(self._dispatch, source_id, delay,
+                                         callback)
+        self.handles[source_id] = handle
+
+    def _dispatch(self, source_id, delay, callback):
+        if callback() and source_id in self.handles:
+            self._schedule(source_id, delay, callback)
+        else:
+            self.handles.pop(source_id, None)
+
+    def _dispatch_io(self, source_id, callback):
+        if not callback():
+            self.source_remove(source_id)
+
+
+class Reader(object):
+    """An add_reader() registration, cancelled like a timer handle."""
+
+    def __init__(self, loop, fd):
+        self.loop = loop
+        self.fd = fd
+
+    def cancel(self):
+        self.loop.remove_reader(self.fd)
+
+
+def to_variant(signature, value):
+    if signature.startswith('a{'):
+        # a{qv}, a{sv}, a{yv} of byte arrays
+        value = dict((k, Variant('ay', v)) for k, v in value.items())
+    return Variant(signature, value)
+
+
+def marshal_properties(properties):
+    """gatt.py's {interface: {name: value}} with every value a Variant."""
+    result = {}
+    for interface, props in properties.items():
+        signatures = gatt.SIGNATURES[interface]
+        result[interface] = dict((name, to_variant(signatures[name], value))
+                                 for name, value in props.items())
+    return result
+
+
+def unwrap(options):
+    return dict((key, variant.value) for key, variant in options.items())
+
+
+async def call(handler, *args):
+    try:
+        result = handler(*args)
+        if isinstance(result, gatt.Deferred):
+            result = await wait(result)
+        # Also what a handler queued by dispatch.py may settle with.
+        if inspect.isawaitable(result):
+            result = await result
+    except gatt.Error as e:
+        raise DBusError(e.name, str(e))
+    return result
+
+
+def wait(deferred):
+    """A future of the loop settled along with 'deferred'."""
+    future = asyncio.get_running_loop().create_future()
+
+    def settle(result, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    deferred.add_callback(settle)
+    return future
+
+
+class GattServiceInterface(ServiceInterface):
+
+    def __init__(self, service):
+        ServiceInterface.__init__(self, GATT_SERVICE_IFACE)
+        self.service = service
+
+
+class GattCharacteristicInterface(ServiceInterface):
+
+    def __init__(self, bus, chrc):
+        ServiceInterface.__init__(self, GATT_CHRC_IFACE)
+        self.bus = bus
+        self.chrc = chrc
+        chrc.emit_value = self.emit_value
+
+    @method()
+    async def ReadValue(self, options: 'a{sv}') -> 'ay':
+        return await call(dispatcher.submit, self.chrc.ReadValue,
+                          unwrap(options))
+
+    @method()
+    async def WriteValue(self, value: 'ay', options: 'a{sv}'):
+        await call(dispatcher.submit, self.chrc.WriteValue, value,
+                   unwrap(options))
+
+    @method()
+    async def StartNotify(self):
+        await call(self.chrc.StartNotify)
+
+    @method()
+    async def StopNotify(self):
+        await call(self.chrc.StopNotify)
+
+    def emit_value(self, value):
+        self.bus.send(Message.new_signal(
+                self.chrc.path, DBUS_PROP_IFACE, 'PropertiesChanged',
+                'sa{sv}as',
+                [GATT_CHRC_IFACE, {'Value': Variant('ay', value)}, []]))
+
+
+class GattDescriptorInterface(ServiceInterface):
+
+    def __init__(self, desc):
+        ServiceInterface.__init__(self, GATT_DESC_IFACE)
+        self.desc = desc
+
+    @method()
+    async def ReadValue(self, options: 'a{sv}') -> 'ay':
+        return await call(dispatcher.submit, self.desc.ReadValue,
+                          unwrap(options))
+
+    @method()
+    async def WriteValue(self, value: 'ay', options: 'a{sv}'):
+        await call(dispatcher.submit, self.desc.WriteValue, value,
+                   unwrap(options))
+
+
+class AdvertisementInterface(ServiceInterface):
+
+    def __init__(self, bus, advertisement):
+        ServiceInterface.__init__(self, LE_ADVERTISEMENT_IFACE)
+        self.bus = bus
+        self.advertisement = advertisement
+        advertisement.emit_properties = self.emit_properties
+
+    @method()
+    def Release(self):
+        self.advertisement.Release()
+
+    def emit_properties(self, changed):
+        changed = marshal_properties({LE_ADVERTISEMENT_IFACE: changed})
+        self.bus.send(Message.new_signal(
+                self.advertisement.path, DBUS_PROP_IFACE, 'PropertiesChanged',
+                'sa{sv}as', [LE_ADVERTISEMENT_IFACE,
+                             changed[LE_ADVERTISEMENT_IFACE], []]))
+
+
+class Objects(object):
+    """
+    Answers GetManagedObjects on the application and Properties.GetAll on
+    every exported object ahead of dbus_next's own dispatch.
+
+    """
+    def __init__(self, bus, app, advertisement):
+        self.bus = bus
+        self.app = app
+        self.advertisement = advertisement
+        self.attributes = {}
+        self.tree = None
+        self.managed_objects = None
+        self.properties = {}
+        self.export_attributes()
+
+    def export_attributes(self):
+        """Exports the attributes of the application not exported yet."""
+        for attribute in self.app.get_attributes():
+            if attribute.path in self.attributes:
+                continue
+            if isinstance(attribute, gatt.Service):
+                interface = GattServiceInterface(attribute)
+            elif isinstance(attribute, gatt.Characteristic):
+                interface = GattCharacteristicInterface(self.bus, attribute)
+            else:
+                interface = GattDescriptorInterface(attribute)
+            self.bus.export(attribute.path, interface)
+            self.attributes[attribute.path] = attribute
+
+    def get_managed_objects(self):
+        # Marshalled again only when the application rebuilt its tree,
+        # which may hold services built just now (see
+        # gatt.Application.add_lazy_service()).
+        tree = self.app.get_managed_objects()
+        if tree is not self.tree:
+            self.export_attributes()
+            self.managed_objects = dict(
+                    (path, marshal_properties(properties))
+                    for path, properties in tree.items())
+            self.tree = tree
+        return self.managed_objects
+
+    def get_properties(self, path):
+        if path == self.advertisement.path:
+            adv_logger.debug('GetAll')
+            return marshal_properties(self.advertisement.get_properties())
+        attribute = self.attributes.get(path)
+        if attribute is None:
+            return None
+        properties = attribute.get_properties()
+        cached = self.properties.get(path)
+        if cached is None or cached[0] is not properties:
+            cached = self.properties[path] = \
+                    (properties, marshal_properties(properties))
+        return cached[1]
+
+    def on_message(self, msg):
+        if msg.message_type != MessageType.METHOD_CALL:
+            return None
+
+        if msg.interface == DBUS_OM_IFACE and \
+                msg.member == 'GetManagedObjects' and msg.path == self.app.path:
+            logger.debug('GetManagedObjects')
+            return Message.new_method_return(msg, 'a{oa{sa{sv}}}',
+                                             [self.get_managed_objects()])
+
+        if msg.interface == DBUS_PROP_IFACE and msg.member == 'GetAll':
+            properties = self.get_properties(msg.path)
+            if properties is None:
+                return None
+            interface = msg.body[0]
+            if interface not in properties:
+                raise DBusError(gatt.InvalidArgsException.name, interface)
+            return Message.new_method_return(msg, 'a{sv}',
+                                             [properties[interface]])
+
+        return None
+
+
+def export(bus, app, advertisement):
+    objects = Objects(bus, app, advertisement)
+    bus.export(advertisement.path, AdvertisementInterface(bus, advertisement))
+    bus.add_message_handler(objects.on_message)
+    return objects
+
+
+def plain(value):
+    """A dbus_next body with its Variants unwrapped."""
+    if isinstance(value, Variant):
+        return plain(value.value)
+    if isinstance(value, dict):
+        return dict((k, plain(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [plain(v) for v in value]
+    return value
+
+
+class Binding(object):
+    """Registrations on behalf of adapters.AdapterPool."""
+
+    def __init__(self, bus, app_path, ad_path):
+        self.bus = bus
+        self.app_path = app_path
+        self.ad_path = ad_path
+
+    def call(self, adapter, interface, member, signature, body, callback):
+        def done(task):
+            if not task.cancelled():
+                callback(task.exception())
+        asyncio.ensure_future(self.bus_call(adapter, interface, member,
+                                            signature, body)) \
+                .add_done_callback(done)
+
+    async def bus_call(self, adapter, interface, member, signature, body):
+        reply = await self.bus.call(Message(destination=BLUEZ_SERVICE_NAME,
+                                            path=adapter, interface=interface,
+                                            member=member,
+                                            signature=signature, body=body))
+        if reply.message_type == MessageType.ERROR:
+            raise DBusError(reply.error_name, ' '.join(map(str, reply.body)))
+
+    def register_application(self, adapter, callback):
+        self.call(adapter, GATT_MANAGER_IFACE, 'RegisterApplication',
+                  'oa{sv}', [self.app_path, {}], callback)
+
+    def register_advertisement(self, adapter, callback):
+        self.call(adapter, LE_ADVERTISING_MANAGER_IFACE,
+                  'RegisterAdvertisement', 'oa{sv}', [self.ad_path, {}],
+                  callback)
+
+    def unregister_advertisement(self, adapter):
+        def done(error):
+            if error is not None:
+                adv_logger.debug('UnregisterAdvertisement: %s', error)
+        self.call(adapter, LE_ADVERTISING_MANAGER_IFACE,
+                  'UnregisterAdvertisement', 'o', [self.ad_path], done)
+
+
+async def watch_adapters(bus, pool):
+    """Keeps 'pool' in step with bluetoothd's objects."""
+    def on_signal(msg):
+        if msg.message_type != MessageType.SIGNAL:
+            return None
+        if msg.interface == DBUS_OM_IFACE:
+            if msg.member == 'InterfacesAdded':
+                pool.interfaces_added(msg.body[0], plain(msg.body[1]))
+            elif msg.member == 'InterfacesRemoved':
+                pool.interfaces_removed(msg.body[0], msg.body[1])
+        elif msg.interface == DBUS_PROP_IFACE and \
+                msg.member == 'PropertiesChanged':
+            pool.properties_changed(msg.path, msg.body[0],
+                                    plain(msg.body[1]))
+        return None
+
+    bus.add_message_handler(on_signal)
+    for rule in ("type='signal',sender='%s',interface='%s'" % (
+                         BLUEZ_SERVICE_NAME, DBUS_OM_IFACE),
+                 "type='signal',sender='%s',interface='%s',"
+                 "member='PropertiesChanged',arg0='%s'" % (
+                         BLUEZ_SERVICE_NAME, DBUS_PROP_IFACE,
+                         adapters.DEVICE_IFACE)):
+        await bus.call(Message(destination='org.freedesktop.DBus',
+                               path='/org/freedesktop/DBus',
+                               interface='org.freedesktop.DBus',
+                               member='AddMatch', signature='s',
+                               body=[rule]))
+    reply = await bus.call(Message(destination=BLUEZ_SERVICE_NAME, path='/',
+                                   interface=DBUS_OM_IFACE,
+                                   member='GetManagedObjects'))
+    startup.mark('adapter_lookup')
+    if reply.message_type != MessageType.ERROR:
+        pool.load(plain(reply.body[0]))
+
+
+async def serve(setup, advertise_first=False):
+    eventloop.use(AsyncioLoop(asyncio.get_running_loop()))
+
+    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+    startup.mark('bus_connect')
+
+    app, advertisement = setup(bus)
+    startup.mark('setup')
+    export(bus, app, advertisement)
+    startup.mark('export')
+
+    pool = adapters.AdapterPool(Binding(bus, app.get_path(),
+                                        advertisement.get_path()),
+                                advertise_first=advertise_first)
+    await watch_adapters(bus, pool)
+    if not pool.adapters:
+        logger.warning('GattManager1 interface not found, waiting for an '
+                       'adapter')
+
+    await bus.wait_for_disconnect()
+
+
+def run(setup, advertise_first=False):
+    """
+    Connects to the system bus, exports the application and advertisement
+    returned by setup(bus), registers them with every adapter through an
+    adapters.AdapterPool and runs the asyncio event loop until the bus
+    goes away. With 'advertise_first' the advertisement goes out without
+    waiting for the application's registration.
+
+    """
+    asyncio.run(serve(setup, advertise_first))
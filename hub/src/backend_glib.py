@@ -0,0 +1,383 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+dbus-python + GLib backend: exports the objects of gatt.py as
+dbus.service.Object instances on a GLib main loop. ReadValue and
+WriteValue reply asynchronously, as dispatch.dispatcher may queue them.
+
+"""
+
+import dbus
+import dbus.exceptions
+import dbus.mainloop.glib
+import dbus.service
+
+import inspect
+from gi.repository import GLib
+
+import adapters
+from dispatch import dispatcher
+import eventloop
+import gatt
+import log
+import startup
+import values
+from gatt import (BLUEZ_SERVICE_NAME, DBUS_OM_IFACE, DBUS_PROP_IFACE,
+                  GATT_CHRC_IFACE, GATT_DESC_IFACE, GATT_MANAGER_IFACE,
+                  GATT_SERVICE_IFACE, LE_ADVERTISEMENT_IFACE,
+                  LE_ADVERTISING_MANAGER_IFACE)
+
+mainloop = None
+
+logger = log.get_logger('gatt')
+adv_logger = log.get_logger('adv')
+
+
+class GLibLoop(object):
+
+    def timeout_add(self, interval_ms, callback):
+        return GLib.timeout_add(interval_ms, callback)
+
+    def timeout_add_seconds(self, interval, callback):
+        return GLib.timeout_add_seconds(interval, callback)
+
+    def idle_add(self, callback):
+        return GLib.idle_add(callback)
+
+    def io_add_watch(self, fd, callback):
+        return GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT, GLib.IO_IN,
+                                 lambda fd, condition: callback())
+
+    def source_remove(self, source_id):
+        GLib.source_remove(source_id)
+
+
+def to_dbus(signature, value):
+    if signature == 's':
+        return dbus.String(value)
+    if signature == 'b':
+        return dbus.Boolean(value)
+    if signature == 'o':
+        return dbus.ObjectPath(value)
+    if signature in ('as', 'ao'):
+        return dbus.Array(value, signature=signature[1])
+    # a{qv}, a{sv}, a{yv} of byte arrays
+    return dbus.Dictionary(
+            dict((k, dbus.Array(v, signature='y')) for k, v in value.items()),
+            signature=signature[2] + 'v')
+
+
+def marshal_properties(properties):
+    """gatt.py's {interface: {name: value}} as typed dbus-python values."""
+    result = dbus.Dictionary({}, signature='sa{sv}')
+    for interface, props in properties.items():
+        signatures = gatt.SIGNATURES[interface]
+        result[interface] = dbus.Dictionary(
+                dict((name, to_dbus(signatures[name], value))
+                     for name, value in props.items()),
+                signature='sv')
+    return result
+
+
+def to_dbus_error(e):
+    return dbus.exceptions.DBusException(*e.args, name=e.name)
+
+
+def call(handler, *args):
+    try:
+        result = handler(*args)
+    except gatt.Error as e:
+        raise to_dbus_error(e)
+    if inspect.isawaitable(result):
+        result.close()
+        raise dbus.exceptions.DBusException(
+                'coroutine handlers need the aio backend',
+                name=gatt.FailedException.name)
+    return result
+
+
+def call_async(reply, error, handler, *args):
+    """
+    call() for methods exported with async_callbacks: the reply is sent
+    when the handler returns, or when the gatt.Deferred it returned is
+    settled.
+
+    """
+    result = call(handler, *args)
+    if not isinstance(result, gatt.Deferred):
+        reply(result)
+        return
+
+    def settle(result, e):
+        if e is None and inspect.isawaitable(result):
+            # Settled by a handler queued by dispatch.py.
+            result.close()
+            e = gatt.FailedException('coroutine handlers need the aio '
+                                     'backend')
+        if e is not None:
+            error(to_dbus_error(e))
+        else:
+            reply(result)
+    result.add_callback(settle)
+
+
+class AdvertisementObject(dbus.service.Object):
+
+    def __init__(self, bus, advertisement):
+        self.advertisement = advertisement
+        dbus.service.Object.__init__(self, bus, advertisement.path)
+        advertisement.emit_properties = self.emit_properties
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        adv_logger.debug('GetAll')
+        if interface != LE_ADVERTISEMENT_IFACE:
+            raise dbus.exceptions.DBusException(
+                    name=gatt.InvalidArgsException.name)
+        adv_logger.debug('returning props')
+        return marshal_properties(
+                self.advertisement.get_properties())[LE_ADVERTISEMENT_IFACE]
+
+    @dbus.service.method(LE_ADVERTISEMENT_IFACE,
+                         in_signature='',
+                         out_signature='')
+    def Release(self):
+        self.advertisement.Release()
+
+    @dbus.service.signal(DBUS_PROP_IFACE,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    def emit_properties(self, changed):
+        changed = marshal_properties({LE_ADVERTISEMENT_IFACE: changed})
+        self.PropertiesChanged(LE_ADVERTISEMENT_IFACE,
+                               changed[LE_ADVERTISEMENT_IFACE], [])
+
+
+class ApplicationObject(dbus.service.Object):
+
+    def __init__(self, bus, app):
+        self.bus = bus
+        self.app = app
+        self.tree = None
+        self.managed_objects = None
+        # Path: exported object, of every attribute.
+        self.attributes = {}
+        dbus.service.Object.__init__(self, bus, app.path)
+        self.export_attributes()
+
+    def export_attributes(self):
+        """Exports the attributes of the application not exported yet."""
+        for attribute in self.app.get_attributes():
+            if attribute.path in self.attributes:
+                continue
+            if isinstance(attribute, gatt.Service):
+                obj = ServiceObject(self.bus, attribute)
+            elif isinstance(attribute, gatt.Characteristic):
+                obj = CharacteristicObject(self.bus, attribute)
+            else:
+                obj = DescriptorObject(self.bus, attribute)
+            self.attributes[attribute.path] = obj
+
+    def get_managed_objects(self):
+        # Marshalled again only when the application rebuilt its tree,
+        # which may hold services built just now (see
+        # gatt.Application.add_lazy_service()).
+        tree = self.app.get_managed_objects()
+        if tree is not self.tree:
+            self.export_attributes()
+            response = dbus.Dictionary({}, signature='oa{sa{sv}}')
+            for path, properties in tree.items():
+                response[dbus.ObjectPath(path)] = \
+                        marshal_properties(properties)
+            self.tree = tree
+            self.managed_objects = response
+        return self.managed_objects
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        logger.debug('GetManagedObjects')
+        return self.get_managed_objects()
+
+
+class AttributeObject(dbus.service.Object):
+    INTERFACE = None
+
+    def __init__(self, bus, attribute):
+        self.attribute = attribute
+        self.properties = None
+        dbus.service.Object.__init__(self, bus, attribute.path)
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != self.INTERFACE:
+            raise dbus.exceptions.DBusException(
+                    name=gatt.InvalidArgsException.name)
+
+        if self.properties is None:
+            self.properties = marshal_properties(
+                    self.attribute.get_properties())[interface]
+        return self.properties
+
+
+class ServiceObject(AttributeObject):
+    INTERFACE = GATT_SERVICE_IFACE
+
+
+class CharacteristicObject(AttributeObject):
+    INTERFACE = GATT_CHRC_IFACE
+
+    def __init__(self, bus, chrc):
+        AttributeObject.__init__(self, bus, chrc)
+        chrc.emit_value = self.emit_value
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                        in_signature='a{sv}',
+                        out_signature='ay',
+                        async_callbacks=('reply', 'error'))
+    def ReadValue(self, options, reply, error):
+        call_async(reply, error, dispatcher.submit, self.attribute.ReadValue,
+                   options)
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}',
+                         byte_arrays=True,
+                         async_callbacks=('reply', 'error'))
+    def WriteValue(self, value, options, reply, error):
+        call_async(lambda result: reply(), error, dispatcher.submit,
+                   self.attribute.WriteValue, value, options)
+
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def StartNotify(self):
+        call(self.attribute.StartNotify)
+
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def StopNotify(self):
+        call(self.attribute.StopNotify)
+
+    @dbus.service.signal(DBUS_PROP_IFACE,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    def emit_value(self, value):
+        self.PropertiesChanged(GATT_CHRC_IFACE,
+                               { 'Value': dbus.ByteArray(value) }, [])
+
+
+class DescriptorObject(AttributeObject):
+    INTERFACE = GATT_DESC_IFACE
+
+    @dbus.service.method(GATT_DESC_IFACE,
+                        in_signature='a{sv}',
+                        out_signature='ay',
+                        async_callbacks=('reply', 'error'))
+    def ReadValue(self, options, reply, error):
+        call_async(reply, error, dispatcher.submit, self.attribute.ReadValue,
+                   options)
+
+    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}',
+                         byte_arrays=True,
+                         async_callbacks=('reply', 'error'))
+    def WriteValue(self, value, options, reply, error):
+        call_async(lambda result: reply(), error, dispatcher.submit,
+                   self.attribute.WriteValue, value, options)
+
+
+class Binding(object):
+    """Registrations on behalf of adapters.AdapterPool."""
+
+    def __init__(self, bus, app_path, ad_path):
+        self.bus = bus
+        self.app_path = dbus.ObjectPath(app_path)
+        self.ad_path = dbus.ObjectPath(ad_path)
+
+    def manager(self, adapter, interface):
+        return dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, adapter),
+                              interface)
+
+    def register_application(self, adapter, callback):
+        self.manager(adapter, GATT_MANAGER_IFACE).RegisterApplication(
+                self.app_path, {},
+                reply_handler=lambda: callback(None),
+                error_handler=callback)
+
+    def register_advertisement(self, adapter, callback):
+        self.manager(adapter, LE_ADVERTISING_MANAGER_IFACE) \
+                .RegisterAdvertisement(self.ad_path, {},
+                                       reply_handler=lambda: callback(None),
+                                       error_handler=callback)
+
+    def unregister_advertisement(self, adapter):
+        self.manager(adapter, LE_ADVERTISING_MANAGER_IFACE) \
+                .UnregisterAdvertisement(
+                        self.ad_path,
+                        reply_handler=lambda: None,
+                        error_handler=lambda error: adv_logger.debug(
+                                'UnregisterAdvertisement: %s', error))
+
+
+def watch_adapters(bus, pool):
+    """Keeps 'pool' in step with bluetoothd's objects."""
+    bus.add_signal_receiver(pool.interfaces_added,
+                            signal_name='InterfacesAdded',
+                            dbus_interface=DBUS_OM_IFACE,
+                            bus_name=BLUEZ_SERVICE_NAME)
+    bus.add_signal_receiver(pool.interfaces_removed,
+                            signal_name='InterfacesRemoved',
+                            dbus_interface=DBUS_OM_IFACE,
+                            bus_name=BLUEZ_SERVICE_NAME)
+    bus.add_signal_receiver(
+            lambda interface, changed, invalidated, path:
+                    pool.properties_changed(path, interface, changed),
+            signal_name='PropertiesChanged',
+            dbus_interface=DBUS_PROP_IFACE,
+            bus_name=BLUEZ_SERVICE_NAME,
+            arg0=adapters.DEVICE_IFACE,
+            path_keyword='path')
+    remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, '/'),
+                               DBUS_OM_IFACE)
+    objects = remote_om.GetManagedObjects()
+    startup.mark('adapter_lookup')
+    pool.load(objects)
+
+
+def run(setup, advertise_first=False):
+    """
+    Connects to the system bus, exports the application and advertisement
+    returned by setup(bus), registers them with every adapter through an
+    adapters.AdapterPool and runs the GLib main loop. With
+    'advertise_first' the advertisement goes out without waiting for the
+    application's registration.
+
+    """
+    global mainloop
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    eventloop.use(GLibLoop())
+    values.marshal = dbus.ByteArray
+
+    bus = dbus.SystemBus()
+    startup.mark('bus_connect')
+
+    app, advertisement = setup(bus)
+    startup.mark('setup')
+    # Kept alive by the connection, which holds their handlers.
+    ApplicationObject(bus, app)
+    AdvertisementObject(bus, advertisement)
+    startup.mark('export')
+
+    mainloop = GLib.MainLoop()
+
+    pool = adapters.AdapterPool(Binding(bus, app.get_path(),
+                                        advertisement.get_path()),
+                                advertise_first=advertise_first)
+    watch_adapters(bus, pool)
+    if not pool.adapters:
+        logger.warning('GattManager1 interface not found, waiting for an '
+                       'adapter')
+
+    mainloop.run()
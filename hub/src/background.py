@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Work too slow for the main loop: compressing a file, chunking it, syncing
+a journal, running a Wi-Fi command. A Worker runs the functions submitted
+to it on a thread of its own, one at a time and in order. Each one's
+callback is called on the main loop as callback(result, error), 'error'
+being None or the exception the function raised; results come back
+through a pipe the loop watches.
+
+"""
+
+import collections
+import os
+import queue
+import threading
+
+import eventloop
+
+
+class Worker(object):
+
+    def __init__(self, name, logger):
+        self.name = name
+        self.logger = logger
+        self.jobs = queue.Queue()
+        # (callback, result, error) of finished jobs.
+        self.finished = collections.deque()
+        self.read_fd = self.write_fd = None
+        self.watch_id = None
+        self.thread = None
+
+    def submit(self, func, args=(), callback=None):
+        """Runs func(*args) on the thread, started the first time."""
+        if self.thread is None:
+            self._start()
+        self.jobs.put((func, args, callback))
+
+    def close(self):
+        """
+        Waits for the jobs submitted so far to finish; their callbacks are
+        not called.
+
+        """
+        if self.thread is None:
+            return
+        self.jobs.put(None)
+        self.thread.join()
+        self.thread = None
+        eventloop.source_remove(self.watch_id)
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+        self.read_fd = self.write_fd = self.watch_id = None
+
+    def _start(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        self.watch_id = eventloop.io_add_watch(self.read_fd,
+                                               self._on_finished)
+        self.thread = threading.Thread(target=self._work, name=self.name,
+                                       daemon=True)
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            func, args, callback = job
+            try:
+                result, error = func(*args), None
+            except Exception as e:
+                if callback is None:
+                    self.logger.exception('%s failed', func.__qualname__)
+                result, error = None, e
+            if callback is not None:
+                self.finished.append((callback, result, error))
+                os.write(self.write_fd, b'\0')
+
+    def _on_finished(self):
+        try:
+            os.read(self.read_fd, 4096)
+        except BlockingIOError:
+            pass
+        while self.finished:
+            callback, result, error = self.finished.popleft()
+            try:
+                callback(result, error)
+            except Exception:
+                self.logger.exception('%s callback failed', self.name)
+        return True
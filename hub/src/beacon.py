@@ -0,0 +1,130 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Hub status carried in the advertisement, so scanners can fill in their
+device list from passive scans without connecting.
+
+ManufacturerData under COMPANY_ID holds STATUS: the format VERSION, the
+battery level in percent (BATTERY_UNKNOWN if not known), FLAG_* bits,
+the number of programs running and the low 16 bits of the storage
+generation, which changes whenever a file does. With its 4 bytes of
+header that is 10 of the 31 bytes of legacy advertising data, so the
+battery level is not repeated as Battery Service data.
+
+Values change far more often than the controller should be reprogrammed,
+so updates are coalesced and reach bluetoothd, as a PropertiesChanged of
+the advertisement, at most once every MIN_INTERVAL_MS.
+
+"""
+
+import struct
+
+import eventloop
+import log
+
+VERSION = 1
+# Reserved by the Bluetooth SIG for testing; not assigned to a company.
+COMPANY_ID = 0xffff
+STATUS = struct.Struct('<BBBBH')
+BATTERY_UNKNOWN = 0xff
+
+FLAG_PROGRAMS = 0x01
+FLAG_WIFI = 0x02
+
+MIN_INTERVAL_MS = 2000
+# How often values without a push of their own are looked at.
+POLL_INTERVAL_MS = 5000
+
+logger = log.get_logger('adv')
+
+
+class StatusBeacon(object):
+
+    def __init__(self, min_interval_ms=MIN_INTERVAL_MS,
+                 poll_interval_ms=POLL_INTERVAL_MS):
+        self.min_interval_ms = min_interval_ms
+        self.poll_interval_ms = poll_interval_ms
+        self.advertisement = None
+        self.values = {'battery': None, 'programs': 0, 'wifi': False,
+                       'generation': 0}
+        self.sources = {}
+        self.sent = None
+        self.sent_ms = None
+        self.timeout_id = None
+        self.poll_id = None
+        self.updates = 0
+        self.coalesced = 0
+
+    def attach(self, advertisement):
+        """Puts the current status in 'advertisement' and keeps it there."""
+        self.advertisement = advertisement
+        self._poll()
+        self._apply()
+        self._start_polling()
+
+    def add_source(self, name, getter):
+        """Polls getter() for value 'name' every POLL_INTERVAL_MS."""
+        self.sources[name] = getter
+        # Services built after the advertisement, see --fast-startup.
+        if self.advertisement is not None:
+            self.set(name, getter())
+            self._start_polling()
+
+    def set(self, name, value):
+        if self.values[name] == value:
+            return
+        self.values[name] = value
+        if self.advertisement is None:
+            return
+        if self.timeout_id is not None:
+            self.coalesced += 1
+            return
+        delay = 0
+        if self.sent_ms is not None:
+            delay = max(0, self.sent_ms + self.min_interval_ms -
+                        eventloop.monotonic_ms())
+        self.timeout_id = eventloop.timeout_add(delay, self._on_timeout)
+
+    def encode(self):
+        values = self.values
+        battery = values['battery']
+        if battery is None:
+            battery = BATTERY_UNKNOWN
+        flags = 0
+        if values['programs']:
+            flags |= FLAG_PROGRAMS
+        if values['wifi']:
+            flags |= FLAG_WIFI
+        return STATUS.pack(VERSION, battery, flags,
+                           min(values['programs'], 0xff),
+                           values['generation'] & 0xffff)
+
+    def stats(self):
+        return {'updates': self.updates, 'coalesced': self.coalesced}
+
+    def _apply(self):
+        """Puts the encoded status in the advertisement; True if it changed."""
+        status = self.encode()
+        if status == self.sent:
+            return False
+        self.advertisement.add_manufacturer_data(COMPANY_ID, status)
+        self.sent = status
+        return True
+
+    def _start_polling(self):
+        if self.sources and self.poll_id is None:
+            self.poll_id = eventloop.timeout_add(self.poll_interval_ms,
+                                                 self._poll)
+
+    def _on_timeout(self):
+        self.timeout_id = None
+        if self._apply():
+            self.sent_ms = eventloop.monotonic_ms()
+            self.updates += 1
+            logger.debug('Advertised status %s', self.sent.hex())
+            self.advertisement.properties_changed(('ManufacturerData',))
+        return False
+
+    def _poll(self):
+        for name, getter in self.sources.items():
+            self.set(name, getter())
+        return True
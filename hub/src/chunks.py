@@ -0,0 +1,456 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Content-defined chunks of storage files, so uploads can skip what the hub
+already has.
+
+Files are cut after the first byte at which a gear hash of the bytes
+before it has its top CHUNK_BITS bits clear, keeping every chunk between
+MIN_CHUNK and MAX_CHUNK bytes; the hash is h = (2 * h + GEAR[byte]) mod
+2**32, restarted at each chunk once MIN_CHUNK bytes are in it. Since cuts
+depend on content alone, an edit only moves the boundaries next to it.
+GEAR[i] is the first four bytes of SHA-256(bytes([i])), big endian, and a
+chunk is named by its SHA-256, so a client computes the same chunks.
+
+The hub keeps each file's list of chunks, a manifest, recomputed when its
+size or mtime changes and saved under hub/cache. Cutting is a loop over
+every byte, so the hub does it on a worker thread (refresh_later() and
+have_later()) and answers once the manifests have caught up. A client
+asks which of its chunks the hub has and uploads a file as a stream of
+references to those and literal bytes for the rest (ChunkDecoder). Files
+stay whole at their paths, so reads and downloads do not change;
+identical files are stored once, as hard links to a blob under
+hub/storage/.store named by the SHA-256 of the whole file.
+
+"""
+
+import hashlib
+import json
+import os
+import struct
+
+import background
+import eventloop
+import log
+from storage import CACHE_ROOT, PartialFile, map_file, replace_file
+
+MIN_CHUNK = 1024
+MAX_CHUNK = 32 * 1024
+CHUNK_BITS = 12
+CHUNK_MASK = ((1 << CHUNK_BITS) - 1) << (32 - CHUNK_BITS)
+GEAR = tuple(int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big')
+             for i in range(256))
+HASH_SIZE = 32
+
+MANIFESTS_PATH = os.path.join(CACHE_ROOT, 'chunks.json')
+MANIFESTS_VERSION = 1
+SAVE_DELAY_S = 5
+
+# Records of an upload stream. CHUNK and END are followed by a SHA-256,
+# of a chunk the hub has and of the whole file respectively; LITERAL by a
+# 32-bit little endian length and that many bytes of the file.
+REC_END = 0x00
+REC_CHUNK = 0x01
+REC_LITERAL = 0x02
+LITERAL_HEADER = struct.Struct('<BI')
+
+logger = log.get_logger('storage')
+
+
+class MissingChunk(ValueError):
+    pass
+
+
+def file_identity(st):
+    """What tells a file from the one that replaced it at the same path."""
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def cut(data):
+    """(offset, length) of each chunk of 'data'."""
+    chunks = []
+    start = 0
+    size = len(data)
+    # Locals: this loop runs once per byte.
+    gear = GEAR
+    mask = CHUNK_MASK
+    while start < size:
+        end = min(start + MAX_CHUNK, size)
+        pos = start + MIN_CHUNK
+        if pos < end:
+            h = 0
+            for pos, b in enumerate(data[pos:end], pos + 1):
+                h = ((h << 1) + gear[b]) & 0xffffffff
+                if not h & mask:
+                    break
+        else:
+            pos = end
+        chunks.append((start, pos - start))
+        start = pos
+    return chunks
+
+
+def encode(data, known):
+    """
+    The upload stream of 'data' as a client builds it, referencing the
+    chunks whose SHA-256 is in 'known' and sending the rest literally.
+
+    """
+    stream = bytearray()
+    for offset, length in cut(data):
+        piece = data[offset:offset + length]
+        digest = hashlib.sha256(piece).digest()
+        if digest in known:
+            stream.append(REC_CHUNK)
+            stream += digest
+        else:
+            stream += LITERAL_HEADER.pack(REC_LITERAL, length)
+            stream += piece
+    stream.append(REC_END)
+    stream += hashlib.sha256(data).digest()
+    return bytes(stream)
+
+
+class ChunkStore(object):
+    """
+    Chunks of every file in 'index', by hash, with the blob store under
+    'storage'.
+
+    """
+    def __init__(self, storage, index, path=MANIFESTS_PATH):
+        self.storage = storage
+        self.index = index
+        self.path = path
+        self.blobs = os.path.join(storage.store, 'blobs')
+        # Path: [size, mtime_ns, sha256 of the file, [chunk sha256, ...],
+        # [chunk length, ...]], hashes in hex.
+        self.manifests = None
+        # Chunk sha256: [(path, offset, length), ...], one per file.
+        self.chunks = {}
+        self.save_id = None
+        self.worker = background.Worker('chunks', logger)
+        # Paths being chunked by the worker, and callbacks waiting for it.
+        self.pending = set()
+        self.waiters = []
+        # Path: (size, mtime_ns) the worker failed to chunk it at.
+        self.failed = {}
+
+    def have(self, hashes):
+        """
+        One bit per SHA-256 in 'hashes' (concatenated), least significant
+        first, set if the hub has that chunk.
+
+        """
+        self.refresh()
+        return self._bitmap(hashes)
+
+    def have_later(self, hashes, callback):
+        """
+        Calls callback(bitmap) on the main loop with what have() returns,
+        once the worker has chunked the files that changed.
+
+        """
+        self.refresh_later(lambda: callback(self._bitmap(hashes)))
+
+    def _bitmap(self, hashes):
+        count = len(hashes) // HASH_SIZE
+        bitmap = bytearray((count + 7) // 8)
+        for i in range(count):
+            digest = bytes(hashes[i * HASH_SIZE:(i + 1) * HASH_SIZE])
+            if digest in self.chunks:
+                bitmap[i >> 3] |= 1 << (i & 7)
+        return bytes(bitmap)
+
+    def read_chunk(self, digest):
+        locations = self.chunks.get(digest)
+        if not locations:
+            raise MissingChunk('no chunk ' + digest.hex())
+        path, offset, length = locations[0]
+        try:
+            with open(self.storage.resolve(path), 'rb') as f:
+                data = os.pread(f.fileno(), length, offset)
+        except OSError:
+            data = b''
+        if hashlib.sha256(data).digest() != digest:
+            # The file changed under the manifest.
+            self.refresh_later()
+            raise MissingChunk('chunk %s is gone' % digest.hex())
+        return data
+
+    def decoder(self):
+        return ChunkDecoder(self)
+
+    def refresh(self):
+        """Brings manifests up to date with the index, chunking here."""
+        for path, _ in self._stale():
+            try:
+                self._add_chunked(path, self._chunk(path))
+            except OSError as e:
+                logger.warning('Chunking %r failed: %s', path, e)
+        self._sweep_blobs()
+
+    def refresh_later(self, callback=None):
+        """
+        Brings manifests up to date with the index as refresh() does, but
+        chunking on the worker; callback() once they are.
+
+        """
+        if callback is not None:
+            self.waiters.append(callback)
+        for path, stamp in self._stale():
+            if path not in self.pending and self.failed.get(path) != stamp:
+                self.pending.add(path)
+                self.worker.submit(self._chunk, (path,),
+                                   lambda result, error, path=path,
+                                   stamp=stamp: self._on_chunked(
+                                           path, stamp, result, error))
+        if self.pending:
+            return
+        self.worker.submit(self._sweep_blobs)
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            waiter()
+
+    def _on_chunked(self, path, stamp, result, error):
+        self.pending.discard(path)
+        if error is None:
+            self.failed.pop(path, None)
+            self._add_chunked(path, result)
+        else:
+            # Tried again once the file changes.
+            self.failed[path] = stamp
+            logger.warning('Chunking %r failed: %s', path, error)
+        if not self.pending:
+            # Files may have changed again meanwhile.
+            self.refresh_later()
+
+    def _stale(self):
+        """
+        (path, (size, mtime_ns)) of the files whose manifest is out of
+        date; forgets those of files no longer there.
+
+        """
+        if self.manifests is None:
+            self._load()
+        present = set()
+        stale = []
+        for path, size, mtime_ns in self.index.files():
+            present.add(path)
+            manifest = self.manifests.get(path)
+            if manifest is None or manifest[0] != size or \
+                    manifest[1] != mtime_ns:
+                stale.append((path, (size, mtime_ns)))
+        for path in list(self.manifests):
+            if path not in present:
+                self._forget(path)
+        for path in list(self.failed):
+            if path not in present:
+                del self.failed[path]
+        return stale
+
+    def _chunk(self, path):
+        """
+        The manifest of 'path' as [size, mtime_ns, sha256, chunk sha256s,
+        chunk lengths], chunk hashes as bytes, and the (size, mtime_ns,
+        inode) of the file hashed, None if it changed meanwhile. Only reads
+        the file, so it may run on the worker.
+
+        """
+        full = self.storage.resolve(path)
+        st = os.stat(full)
+        data = map_file(full)
+        digest = hashlib.sha256(data).hexdigest()
+        chunks = []
+        lengths = []
+        for offset, length in cut(data):
+            chunks.append(hashlib.sha256(data[offset:offset + length])
+                          .digest())
+            lengths.append(length)
+        if hasattr(data, 'close'):
+            data.close()
+        identity = file_identity(st)
+        if file_identity(os.stat(full)) != identity:
+            identity = None
+        return [st.st_size, st.st_mtime_ns, digest, chunks, lengths], identity
+
+    def _add_chunked(self, path, result):
+        manifest, identity = result
+        if manifest[3] and identity is not None:
+            st = self._dedupe(path, manifest[2], identity)
+            if st is not None:
+                # Now the blob's inode, with the blob's mtime.
+                manifest[0], manifest[1] = st.st_size, st.st_mtime_ns
+        self._add(path, manifest)
+
+    def _add(self, path, manifest):
+        self._forget(path)
+        size, mtime_ns, digest, chunks, lengths = manifest
+        offset = 0
+        for chunk, length in zip(chunks, lengths):
+            self._locate(chunk, path, offset, length)
+            offset += length
+        self.manifests[path] = [size, mtime_ns, digest,
+                                [chunk.hex() for chunk in chunks], lengths]
+        self._schedule_save()
+
+    def _forget(self, path):
+        manifest = self.manifests.pop(path, None)
+        if manifest is None:
+            return
+        for chunk in manifest[3]:
+            chunk = bytes.fromhex(chunk)
+            locations = [location for location in self.chunks.get(chunk, ())
+                         if location[0] != path]
+            if locations:
+                self.chunks[chunk] = locations
+            else:
+                self.chunks.pop(chunk, None)
+        self._schedule_save()
+
+    def _locate(self, chunk, path, offset, length):
+        locations = self.chunks.setdefault(chunk, [])
+        if not locations or locations[-1][0] != path:
+            locations.append((path, offset, length))
+
+    def _dedupe(self, path, digest, identity):
+        """
+        Makes 'path' a hard link to the blob of its content 'digest', if it
+        is still the file of 'identity' that was hashed, and returns its
+        stat when it was replaced by the blob. Runs on the main loop, where
+        uploads commit, so none can replace the file between the check and
+        the swap.
+
+        """
+        full = self.storage.resolve(path)
+        blob = os.path.join(self.blobs, digest)
+        try:
+            st = os.stat(full)
+            if file_identity(st) != identity:
+                return None
+            try:
+                blob_st = os.stat(blob)
+            except FileNotFoundError:
+                os.makedirs(self.blobs, exist_ok=True)
+                os.link(full, blob)
+                return None
+            if (st.st_dev, st.st_ino) == (blob_st.st_dev, blob_st.st_ino):
+                return None
+            # Not a name of the file's own: writers open those with
+            # O_TRUNC, which would rewrite the blob and its every link.
+            tmp = os.path.join(self.storage.store, 'link.tmp')
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            os.link(blob, tmp)
+            os.replace(tmp, full)
+            logger.info('Storage %s: same content as %d other file(s)', full,
+                        blob_st.st_nlink - 1)
+            return os.stat(full)
+        except OSError as e:
+            logger.warning('Deduplicating %s failed: %s', full, e)
+            return None
+
+    def _sweep_blobs(self):
+        """Removes blobs no file links to anymore."""
+        try:
+            with os.scandir(self.blobs) as it:
+                for entry in it:
+                    if entry.stat(follow_symlinks=False).st_nlink == 1:
+                        os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    def _load(self):
+        self.manifests = {}
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        if saved.get('version') != MANIFESTS_VERSION or \
+                saved.get('root') != self.storage.root:
+            return
+        self.manifests = saved['manifests']
+        for path, manifest in self.manifests.items():
+            offset = 0
+            for chunk, length in zip(manifest[3], manifest[4]):
+                self._locate(bytes.fromhex(chunk), path, offset, length)
+                offset += length
+
+    def _schedule_save(self):
+        if self.save_id is None:
+            self.save_id = eventloop.timeout_add_seconds(SAVE_DELAY_S,
+                                                         self._save)
+
+    def _save(self):
+        self.save_id = None
+        saved = {
+                'version': MANIFESTS_VERSION,
+                'root': self.storage.root,
+                'manifests': self.manifests,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            replace_file(PartialFile(self.path),
+                         json.dumps(saved, separators=(',', ':'))
+                         .encode('utf-8'))
+        except OSError as e:
+            logger.warning('Saving chunk manifests failed: %s', e)
+        return False
+
+
+class ChunkDecoder(object):
+    """
+    Turns an upload stream of chunk references and literals back into the
+    file, with the interface of a decompression object: decompress()
+    takes the next bytes of the stream and returns file data, and 'eof'
+    is set once the END record matched what was produced.
+
+    """
+    def __init__(self, store):
+        self.store = store
+        self.pending = bytearray()
+        # Bytes of the current literal still to come.
+        self.literal = 0
+        self.sha = hashlib.sha256()
+        self.eof = False
+
+    def decompress(self, data):
+        pending = self.pending
+        pending += data
+        out = bytearray()
+        hashed = 0
+        pos = 0
+        while pos < len(pending):
+            if self.eof:
+                raise ValueError('data after the end record')
+            if self.literal:
+                piece = pending[pos:pos + self.literal]
+                out += piece
+                pos += len(piece)
+                self.literal -= len(piece)
+                continue
+            record = pending[pos]
+            if record == REC_LITERAL:
+                if len(pending) - pos < LITERAL_HEADER.size:
+                    break
+                self.literal = LITERAL_HEADER.unpack_from(pending, pos)[1]
+                pos += LITERAL_HEADER.size
+            elif record in (REC_CHUNK, REC_END):
+                if len(pending) - pos < 1 + HASH_SIZE:
+                    break
+                digest = bytes(pending[pos + 1:pos + 1 + HASH_SIZE])
+                pos += 1 + HASH_SIZE
+                if record == REC_CHUNK:
+                    out += self.store.read_chunk(digest)
+                    continue
+                self.sha.update(out)
+                hashed = len(out)
+                if self.sha.digest() != digest:
+                    raise ValueError('file does not match its SHA-256')
+                self.eof = True
+            else:
+                raise ValueError('bad record type %d' % record)
+        del pending[:pos]
+        self.sha.update(out[hashed:])
+        return bytes(out)
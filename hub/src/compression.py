@@ -0,0 +1,260 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Compression of storage transfers with the stdlib codecs.
+
+Clients name the codecs they accept; the hub picks the first one it has,
+unless the file is compressed already, which is told from its first
+bytes (MP3 frames and ID3 tags, images, archives) or, failing a known
+signature, from how well a small sample compresses.
+
+Downloads are served from compressed copies kept under
+hub/cache/compressed, apart from the hub's other state in hub/cache. A
+copy is named after the SHA-256 of the file content and the codec, and
+found through an index keyed by path, size and mtime, so a file is
+compressed once and hashed again only when it changes. Pruning only ever
+removes files named that way. Cache.open_later() does the hashing and
+compressing on a worker thread, so the main loop goes on serving other
+calls meanwhile.
+
+"""
+
+import hashlib
+import lzma
+import os
+import re
+import time
+import zlib
+
+import background
+import log
+from storage import CACHE_ROOT, PartialFile, map_file, replace_file
+
+COMPRESSED_ROOT = os.path.join(CACHE_ROOT, 'compressed')
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+IDENTITY = 'identity'
+
+# Smaller files are sent as they are.
+MIN_SIZE = 256
+# A compressed copy must save at least this fraction to be used.
+MIN_SAVING = 0.05
+# Bytes of an unknown file compressed to guess whether it compresses.
+SAMPLE_SIZE = 4096
+
+# Link throughput assumed when estimating the transfer time saved.
+LINK_RATE = 4 * 1024
+
+SIGNATURES = (
+    b'ID3',                         # MP3 with an ID3v2 tag
+    b'\x89PNG',
+    b'\xff\xd8\xff',                # JPEG
+    b'GIF8',
+    b'PK\x03\x04',                  # zip, and the formats built on it
+    b'\x1f\x8b',                    # gzip
+    b'BZh',
+    b'\xfd7zXZ\x00',
+    b'7z\xbc\xaf\x27\x1c',
+    b'\x28\xb5\x2f\xfd',            # zstd
+    b'OggS',
+    b'fLaC',
+)
+
+logger = log.get_logger('storage')
+
+
+def zlib_compress(data):
+    return zlib.compress(data, 9)
+
+
+def lzma_compress(data):
+    return lzma.compress(data)
+
+
+# Preferred first when a client accepts several.
+CODECS = {
+    'lzma': (lzma_compress, lzma.LZMADecompressor),
+    'zlib': (zlib_compress, zlib.decompressobj),
+}
+# Names of compressed copies: '<sha256 of the file>.<codec>'.
+SIDECAR_NAME = re.compile(r'[0-9a-f]{64}\.(%s)$' % '|'.join(CODECS))
+
+
+def is_compressed(head):
+    """Whether 'head', the start of a file, looks compressed already."""
+    head = bytes(head[:SAMPLE_SIZE])
+    if head.startswith(SIGNATURES):
+        return True
+    # MPEG audio (MP3 without a tag, ADTS AAC) starts on a frame sync.
+    if len(head) > 1 and head[0] == 0xff and head[1] & 0xe0 == 0xe0:
+        return True
+    if head[4:8] == b'ftyp' or \
+            (head.startswith(b'RIFF') and head[8:12] == b'WEBP'):
+        return True
+    return len(head) >= MIN_SIZE and \
+            len(zlib.compress(head, 1)) > len(head) * (1 - MIN_SAVING)
+
+
+def choose(accepted, head):
+    """
+    The codec to send a file starting with 'head' with, given the codec
+    names the client accepts, or None to send it as it is.
+
+    """
+    if len(head) < MIN_SIZE or is_compressed(head):
+        return None
+    for name in CODECS:
+        if name in accepted:
+            return name
+    return None
+
+
+def decompressor(codec):
+    """
+    A new decompression object for 'codec', or None for IDENTITY. Raises
+    ValueError for codecs the hub does not have.
+
+    """
+    if not codec or codec == IDENTITY:
+        return None
+    if codec not in CODECS:
+        raise ValueError('unknown encoding: ' + repr(codec))
+    return CODECS[codec][1]()
+
+
+def decompress(codec, data):
+    """Whole 'data' decoded; ValueError if it is not a complete stream."""
+    d = decompressor(codec)
+    if d is None:
+        return data
+    try:
+        result = d.decompress(data)
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ValueError(str(e))
+    if not d.eof:
+        raise ValueError('truncated %s stream' % codec)
+    return result
+
+
+def transfer_info(codec, size, encoded_size, compress_s, cached):
+    """What a client is told about a transfer, for reporting."""
+    saved_s = (size - encoded_size) / float(LINK_RATE) - compress_s
+    return {
+            'encoding': codec or IDENTITY,
+            'size': size,
+            'encoded_size': encoded_size,
+            'ratio': round(encoded_size / float(size), 3) if size else 1.0,
+            'compress_ms': int(compress_s * 1000),
+            'saved_ms': int(saved_s * 1000),
+            'cached': cached,
+    }
+
+
+class Cache(object):
+    """
+    Compressed copies of storage files under 'root', at most 'max_bytes'
+    of them; the least recently used go first.
+
+    """
+    def __init__(self, root=COMPRESSED_ROOT, max_bytes=MAX_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        # Path: ((size, mtime_ns), sha256), also written by the worker.
+        self.digests = {}
+        self.worker = background.Worker('compress', logger)
+
+    def open(self, full, accepted):
+        """
+        Maps 'full', compressed with one of the 'accepted' codecs when it
+        is worth it. Returns (data, info) with info as transfer_info().
+
+        """
+        return self._open(full, accepted, True)
+
+    def open_later(self, full, accepted, callback):
+        """
+        Calls callback((data, info), error) on the main loop with what
+        open() returns or raises: at once if the file is sent as it is or
+        its copy is at hand, else once the worker has made the copy.
+
+        """
+        try:
+            result = self._open(full, accepted, False)
+        except (OSError, ValueError) as e:
+            callback(None, e)
+            return
+        if result is None:
+            self.worker.submit(self.open, (full, accepted), callback)
+        else:
+            callback(result, None)
+
+    def _open(self, full, accepted, slow):
+        """
+        What open() returns, or None if that takes hashing or compressing
+        and 'slow' is not set.
+
+        """
+        data = map_file(full)
+        st = os.stat(full)
+        codec = choose(accepted, data[:SAMPLE_SIZE])
+        if codec is None:
+            return data, transfer_info(None, len(data), len(data), 0, False)
+
+        digest = self.digest(full, st, data if slow else None)
+        if digest is not None:
+            sidecar = os.path.join(self.root, '%s.%s' % (digest, codec))
+        cached = digest is not None and os.path.exists(sidecar)
+        if not cached and not slow:
+            if hasattr(data, 'close'):
+                data.close()
+            return None
+        compress_s = 0
+        if cached:
+            os.utime(sidecar)
+        else:
+            start = time.monotonic()
+            encoded = CODECS[codec][0](data)
+            compress_s = time.monotonic() - start
+            if len(encoded) > len(data) * (1 - MIN_SAVING):
+                # Not worth it after all; remember that as an empty copy.
+                encoded = b''
+            self.store(sidecar, encoded)
+
+        encoded = map_file(sidecar)
+        if not len(encoded):
+            return data, transfer_info(None, len(data), len(data),
+                                       compress_s, cached)
+        info = transfer_info(codec, len(data), len(encoded), compress_s,
+                             cached)
+        logger.info('Storage %s: %s %d -> %d bytes%s', full, codec,
+                    len(data), len(encoded), ' (cached)' if cached else '')
+        if hasattr(data, 'close'):
+            data.close()
+        return encoded, info
+
+    def digest(self, full, st, data):
+        """The SHA-256 of 'full', of 'data' if not known; None if neither."""
+        stamp = (st.st_size, st.st_mtime_ns)
+        entry = self.digests.get(full)
+        if entry is None or entry[0] != stamp:
+            if data is None:
+                return None
+            entry = self.digests[full] = \
+                    (stamp, hashlib.sha256(data).hexdigest())
+        return entry[1]
+
+    def store(self, sidecar, encoded):
+        os.makedirs(self.root, exist_ok=True)
+        replace_file(PartialFile(sidecar), encoded)
+        self.prune(sidecar)
+
+    def prune(self, keep):
+        with os.scandir(self.root) as it:
+            entries = [(e.stat().st_mtime, e.stat().st_size, e.path)
+                       for e in it
+                       if e.path != keep and SIDECAR_NAME.match(e.name)]
+        total = os.stat(keep).st_size + sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
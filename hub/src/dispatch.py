@@ -0,0 +1,257 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Order in which ReadValue and WriteValue calls are served. Every call
+runs on the one main loop, so without this a burst of storage writes
+from one client holds up a Heart Rate Control Point write queued behind
+it on the bus for as long as the burst takes.
+
+Attributes name their class in PRIORITY:
+
+    control      commands that must take effect at once
+    interactive  the default; small requests a user waits on
+    bulk         file data, charged against a token bucket per client
+
+Control calls run on arrival, even from a client with calls queued:
+control characteristics do not touch storage, so they never depend on
+the order of a client's other calls. Interactive and bulk calls are
+queued per client (the 'device' option) and answered through a
+gatt.Deferred once run, so the backends keep reading the bus meanwhile.
+A client's queued calls run in the order it made them: a storage ack
+must not overtake the upload frames before it, nor a commit the data.
+What a client's queue waits for is the class of the call at its head:
+queued calls are run from an idle callback for at most SLICE_MS at a
+time, clients whose next call is interactive before those whose next
+call is bulk, and clients of a class take turns one call each; as an ATT
+value is at most 512 bytes, that is fair in bytes too. A client whose
+next call is bulk also waits while its bucket, refilled at bulk_rate
+bytes per second up to BULK_BURST, is empty; a call costs the bytes
+written or read.
+
+With 'fair' off every call runs on arrival, the way it did before.
+
+"""
+
+import collections
+import inspect
+import time
+
+import eventloop
+import gatt
+import log
+import metrics
+import sessions
+
+CONTROL = 'control'
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+CLASSES = (CONTROL, INTERACTIVE, BULK)
+# In the order clients are served by the class of their next call.
+QUEUED = (INTERACTIVE, BULK)
+# Longest the queued calls keep the main loop from the bus in one go.
+SLICE_MS = 2
+BULK_RATE = 256 * 1024
+BULK_BURST = 64 * 1024
+
+logger = log.get_logger('dispatch')
+
+
+class Call(object):
+    __slots__ = ('cls', 'handler', 'args', 'reply', 'queued')
+
+    def __init__(self, cls, handler, args):
+        self.cls = cls
+        self.handler = handler
+        self.args = args
+        self.reply = gatt.Deferred()
+        self.queued = time.perf_counter()
+
+
+class Bucket(object):
+    """Token bucket in bytes; calls may take it below zero."""
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class Dispatcher(object):
+
+    def __init__(self, slice_ms=SLICE_MS, bulk_rate=BULK_RATE,
+                 bulk_burst=BULK_BURST):
+        self.fair = True
+        self.slice_ms = slice_ms
+        # Bytes per second per client, 0 for no limit.
+        self.bulk_rate = bulk_rate
+        self.bulk_burst = bulk_burst
+        # Device: deque of its Calls, in the order it made them.
+        self.queues = {}
+        # Class: {device: None} of the clients whose next call is of that
+        # class, in turn order.
+        self.ready = dict((cls, collections.OrderedDict())
+                          for cls in QUEUED)
+        self.buckets = {}
+        self.run_id = None
+        self.wake_id = None
+        # Time from arrival to run, per class.
+        self.waits = dict((cls, metrics.Stat(None, cls)) for cls in CLASSES)
+        self.throttled = 0
+
+    def submit(self, handler, *args):
+        """
+        Serves handler(*args), a ReadValue or WriteValue whose last
+        argument is its options: now, returning what the handler returns,
+        or later, returning a Deferred settled with it.
+
+        """
+        cls = getattr(handler.__self__, 'PRIORITY', INTERACTIVE)
+        if not self.fair or cls == CONTROL:
+            self.waits[cls].observe(0)
+            return handler(*args)
+        device = str(args[-1].get('device', sessions.ANONYMOUS))
+        call = Call(cls, handler, args)
+        queue = self.queues.get(device)
+        if queue is None:
+            queue = self.queues[device] = collections.deque()
+            self.ready[cls][device] = None
+            self._prune(time.monotonic())
+        queue.append(call)
+        if self.run_id is None:
+            self.run_id = eventloop.idle_add(self._run_slice)
+        return call.reply
+
+    def stats(self):
+        result = {'throttled': self.throttled}
+        for cls in CLASSES:
+            result['queued_' + cls] = 0
+        for queue in self.queues.values():
+            for call in queue:
+                result['queued_' + call.cls] += 1
+        return result
+
+    def _next(self, now):
+        """
+        The next call to run and None, or None and the seconds until a
+        throttled client may go on (None if no client is throttled).
+
+        """
+        for device in self.ready[INTERACTIVE]:
+            return self._take(INTERACTIVE, device), None
+        wait = None
+        for device in self.ready[BULK]:
+            bucket = self.buckets.get(device)
+            if self.bulk_rate and bucket is not None:
+                bucket.refill(self.bulk_rate, self.bulk_burst, now)
+                if bucket.tokens <= 0:
+                    after = -bucket.tokens / self.bulk_rate
+                    wait = after if wait is None else min(wait, after)
+                    continue
+            return self._take(BULK, device), None
+        return None, wait
+
+    def _take(self, cls, device):
+        """The next call of 'device', whose turn in 'cls' it was."""
+        queue = self.queues[device]
+        call = queue.popleft()
+        del self.ready[cls][device]
+        if queue:
+            # To the end of the turns of the class of its next call.
+            self.ready[queue[0].cls][device] = None
+        else:
+            del self.queues[device]
+        self.waits[cls].observe(time.perf_counter() - call.queued)
+        return call
+
+    def _run_slice(self):
+        self.run_id = None
+        deadline = time.perf_counter() + self.slice_ms / 1000.0
+        while True:
+            call, wait = self._next(time.monotonic())
+            if call is None:
+                break
+            self._run(call)
+            if time.perf_counter() >= deadline:
+                self.run_id = eventloop.idle_add(self._run_slice)
+                return False
+        if wait is not None and self.wake_id is None:
+            self.throttled += 1
+            self.wake_id = eventloop.timeout_add(int(wait * 1000) + 1,
+                                                 self._on_wake)
+        return False
+
+    def _on_wake(self):
+        self.wake_id = None
+        if self.run_id is None:
+            self.run_id = eventloop.idle_add(self._run_slice)
+        return False
+
+    def _run(self, call):
+        try:
+            result = call.handler(*call.args)
+        except gatt.Error as e:
+            self._charge(call, None)
+            call.reply.reject(e)
+            return
+        except Exception as e:
+            logger.exception('%s failed', call.handler.__qualname__)
+            call.reply.reject(e)
+            return
+        if isinstance(result, gatt.Deferred):
+            result.add_callback(lambda value, error: self._settle(
+                    call, value, error))
+        else:
+            if not inspect.isawaitable(result):
+                self._charge(call, result)
+            call.reply.resolve(result)
+
+    def _settle(self, call, result, error):
+        if error is not None:
+            self._charge(call, None)
+            call.reply.reject(error)
+        else:
+            self._charge(call, result)
+            call.reply.resolve(result)
+
+    def _charge(self, call, result):
+        if call.cls != BULK or not self.bulk_rate:
+            return
+        size = len(call.args[0]) if len(call.args) > 1 else 0
+        if result is not None:
+            size += len(result)
+        device = str(call.args[-1].get('device', sessions.ANONYMOUS))
+        now = time.monotonic()
+        bucket = self.buckets.get(device)
+        if bucket is None:
+            bucket = self.buckets[device] = Bucket(self.bulk_burst, now)
+        bucket.refill(self.bulk_rate, self.bulk_burst, now)
+        bucket.tokens -= size
+
+    def _prune(self, now):
+        """Forgets the buckets of clients with no calls queued, once full."""
+        for device, bucket in list(self.buckets.items()):
+            if device in self.queues:
+                continue
+            bucket.refill(self.bulk_rate, self.bulk_burst, now)
+            if bucket.tokens >= self.bulk_burst:
+                del self.buckets[device]
+
+
+dispatcher = Dispatcher()
+
+
+def wait_percentiles(q):
+    return dict(('class="%s"' % cls, stat.percentile(q) / 1e6)
+                for cls, stat in dispatcher.waits.items())
+
+
+metrics.add_gauge('hub_dispatch_wait_p50_seconds',
+                  lambda: wait_percentiles(0.5))
+metrics.add_gauge('hub_dispatch_wait_p99_seconds',
+                  lambda: wait_percentiles(0.99))
+metrics.add_gauge('hub_dispatch',
+                  lambda: dict(('stat="%s"' % name, value) for name, value
+                               in dispatcher.stats().items()))
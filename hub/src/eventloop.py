@@ -0,0 +1,43 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Timers and idle callbacks on whichever main loop the selected backend
+runs, with GLib's semantics: a callback returning True runs again, and
+sources are cancelled by the id they were added with. The backend installs
+its implementation with use() before any attribute handler runs.
+
+"""
+
+import time
+
+current = None
+
+
+def use(loop):
+    global current
+    current = loop
+
+
+def timeout_add(interval_ms, callback):
+    return current.timeout_add(interval_ms, callback)
+
+
+def timeout_add_seconds(interval, callback):
+    return current.timeout_add_seconds(interval, callback)
+
+
+def idle_add(callback):
+    return current.idle_add(callback)
+
+
+def io_add_watch(fd, callback):
+    """Calls callback() whenever 'fd' is readable."""
+    return current.io_add_watch(fd, callback)
+
+
+def source_remove(source_id):
+    current.source_remove(source_id)
+
+
+def monotonic_ms():
+    # CLOCK_MONOTONIC, the clock both GLib and asyncio time out against.
+    return int(time.monotonic() * 1000)
@@ -0,0 +1,246 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Event bus of the hub: sensor sources, GATT writes and timers publish
+events, (topic, key, value) tuples, and handlers subscribe to a topic and
+key, or to a topic with any key. Subscriptions are indexed by what they
+match, so publishing costs the same however many handlers listen to
+other events.
+
+The hub has one bus, 'bus'. The heart rate and battery services publish
+their samples to it on HEART_RATE_TOPIC and BATTERY_TOPIC with
+changed_only, so a reading equal to the last wakes no handler, and keep
+sampling while programs subscribe, as sources of those topics.
+
+Program workers get their events through a Ring each, a buffer in shared
+memory the hub writes and the worker reads, with a pipe as a doorbell
+rung only when the worker sleeps waiting for events.
+
+"""
+
+import marshal
+import mmap
+import os
+import struct
+import time
+
+import eventloop
+import log
+
+RING_SIZE = 64 * 1024
+# Ring header: bytes ever written, bytes ever read (both modulo 2**32),
+# data size, and whether the reader sleeps on the doorbell.
+RING_HEADER = struct.Struct('<IIII')
+RING_DATA = 64
+RECORD_HEADER = struct.Struct('<I')
+# Record length telling the reader to continue at the start of the data.
+RECORD_WRAP = 0xffffffff
+
+TIMER_TOPIC = 'timer'
+TIMER_INTERVAL_MS = 100
+# Keys 'bpm' and 'energy_expended'.
+HEART_RATE_TOPIC = 'heart_rate'
+# Key 'level', in percent.
+BATTERY_TOPIC = 'battery'
+
+logger = log.get_logger('events')
+
+
+class Ring(object):
+    """
+    Single producer, single consumer ring of records over 'fd', a shared
+    memory file both ends map; 'create' sizes and initializes it. Records
+    are padded to four bytes and never split: one that does not fit
+    before the end of the data starts over at its beginning.
+
+    """
+    def __init__(self, fd, size=RING_SIZE, create=False):
+        if create:
+            os.ftruncate(fd, RING_DATA + size)
+        self.map = mmap.mmap(fd, RING_DATA + size)
+        if create:
+            RING_HEADER.pack_into(self.map, 0, 0, 0, size, 0)
+        self.size = RING_HEADER.unpack_from(self.map, 0)[2]
+        self.dropped = 0
+
+    @classmethod
+    def create(cls, size=RING_SIZE):
+        """A new ring and the descriptor to hand to the reader."""
+        fd = os.memfd_create('hub-events', 0)
+        return cls(fd, size, create=True), fd
+
+    def push(self, data):
+        """Appends a record; False, and counted, if the ring is full."""
+        head, tail, size, _ = RING_HEADER.unpack_from(self.map, 0)
+        length = RECORD_HEADER.size + ((len(data) + 3) & ~3)
+        pos = head % size
+        skip = size - pos if size - pos < length else 0
+        if (head - tail) % 2 ** 32 + skip + length > size:
+            self.dropped += 1
+            return False
+        if skip:
+            if skip >= RECORD_HEADER.size:
+                RECORD_HEADER.pack_into(self.map, RING_DATA + pos,
+                                        RECORD_WRAP)
+            pos = 0
+        RECORD_HEADER.pack_into(self.map, RING_DATA + pos, len(data))
+        start = RING_DATA + pos + RECORD_HEADER.size
+        self.map[start:start + len(data)] = data
+        # Published last: the reader only looks up to the head.
+        struct.pack_into('<I', self.map, 0, (head + skip + length) % 2 ** 32)
+        return True
+
+    def pop_all(self):
+        """Every record written since the last call."""
+        head, tail, size, _ = RING_HEADER.unpack_from(self.map, 0)
+        records = []
+        while tail != head:
+            pos = tail % size
+            if size - pos < RECORD_HEADER.size:
+                tail = (tail + size - pos) % 2 ** 32
+                continue
+            length = RECORD_HEADER.unpack_from(self.map, RING_DATA + pos)[0]
+            if length == RECORD_WRAP:
+                tail = (tail + size - pos) % 2 ** 32
+                continue
+            start = RING_DATA + pos + RECORD_HEADER.size
+            records.append(self.map[start:start + length])
+            tail = (tail + RECORD_HEADER.size + ((length + 3) & ~3)) % 2 ** 32
+        struct.pack_into('<I', self.map, 4, tail)
+        return records
+
+    def pending(self):
+        head, tail = struct.unpack_from('<II', self.map, 0)
+        return head != tail
+
+    def set_waiting(self, waiting):
+        struct.pack_into('<I', self.map, 12, int(waiting))
+
+    def waiting(self):
+        return struct.unpack_from('<I', self.map, 12)[0] != 0
+
+    def close(self):
+        self.map.close()
+
+
+class EventBus(object):
+
+    def __init__(self):
+        # (topic, key or None): {token: handler}
+        self.index = {}
+        self.subscriptions = {}
+        self.topics = {}
+        self.next_token = 1
+        # Sources started while their topic has subscribers.
+        self.sources = {}
+        self.last = {}
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, topic, key, handler):
+        """
+        Calls handler(event) for each event of 'topic' and 'key', or of
+        'topic' with any key when 'key' is None. Returns a token for
+        unsubscribe().
+
+        """
+        token = self.next_token
+        self.next_token += 1
+        self.index.setdefault((topic, key), {})[token] = handler
+        self.subscriptions[token] = (topic, key)
+        self.topics[topic] = self.topics.get(topic, 0) + 1
+        if self.topics[topic] == 1 and topic in self.sources:
+            self.sources[topic][0]()
+        return token
+
+    def unsubscribe(self, token):
+        if token not in self.subscriptions:
+            return
+        topic, key = self.subscriptions.pop(token)
+        handlers = self.index[(topic, key)]
+        del handlers[token]
+        if not handlers:
+            del self.index[(topic, key)]
+        self.topics[topic] -= 1
+        if not self.topics[topic]:
+            del self.topics[topic]
+            if topic in self.sources:
+                self.sources[topic][1]()
+
+    def add_source(self, topic, start, stop):
+        """start() and stop() a source as 'topic' gains and loses interest."""
+        self.sources[topic] = (start, stop)
+        if topic in self.topics:
+            start()
+
+    def publish(self, topic, key, value, changed_only=False):
+        """
+        Delivers (topic, key, value, monotonic ns) to the matching handlers
+        and returns how many there were. With 'changed_only' nothing is
+        delivered if the value is the one last published for that key.
+
+        """
+        if changed_only:
+            if self.last.get((topic, key), self) == value:
+                return 0
+            self.last[(topic, key)] = value
+        self.published += 1
+        exact = self.index.get((topic, key))
+        wildcard = self.index.get((topic, None)) if key is not None else None
+        if not exact and not wildcard:
+            return 0
+        event = (topic, key, value, time.monotonic_ns())
+        count = 0
+        for handlers in (exact, wildcard):
+            if handlers:
+                for handler in list(handlers.values()):
+                    handler(event)
+                    count += 1
+        self.delivered += count
+        return count
+
+    def stats(self):
+        return {
+                'subscriptions': len(self.subscriptions),
+                'published': self.published,
+                'delivered': self.delivered,
+        }
+
+
+class TimerSource(object):
+    """
+    Publishes the seconds since the hub started on TIMER_TOPIC every
+    TIMER_INTERVAL_MS, while anything listens.
+
+    """
+    def __init__(self, bus, interval_ms=TIMER_INTERVAL_MS):
+        self.bus = bus
+        self.interval_ms = interval_ms
+        self.started = time.monotonic()
+        self.timeout_id = None
+        bus.add_source(TIMER_TOPIC, self.start, self.stop)
+
+    def start(self):
+        if self.timeout_id is None:
+            self.timeout_id = eventloop.timeout_add(self.interval_ms,
+                                                    self._on_timeout)
+
+    def stop(self):
+        if self.timeout_id is not None:
+            eventloop.source_remove(self.timeout_id)
+            self.timeout_id = None
+
+    def _on_timeout(self):
+        self.bus.publish(TIMER_TOPIC, None,
+                         round(time.monotonic() - self.started, 1))
+        return True
+
+
+bus = EventBus()
+
+
+def encode(event):
+    return marshal.dumps(event)
+
+
+def decode(record):
+    return marshal.loads(record)
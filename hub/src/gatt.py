@@ -0,0 +1,475 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+GATT object model of the hub, independent of the D-Bus binding. Services,
+characteristics, descriptors and advertisements are plain objects; a
+backend (backend_glib.py or backend_aio.py) exports them on the bus and
+marshals their properties with SIGNATURES.
+
+ReadValue, WriteValue, StartNotify and StopNotify are called with the
+method arguments as plain Python values ('options' as a dict). They may
+raise Error to return a D-Bus error, or return a Deferred to reply once
+work done elsewhere finishes; under the aio backend they may also be
+coroutines.
+
+"""
+
+import time
+
+import log
+import metrics
+import reassembly
+import startup
+
+BLUEZ_SERVICE_NAME = 'org.bluez'
+GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
+DBUS_OM_IFACE =      'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE =    'org.freedesktop.DBus.Properties'
+
+GATT_SERVICE_IFACE = 'org.bluez.GattService1'
+GATT_CHRC_IFACE =    'org.bluez.GattCharacteristic1'
+GATT_DESC_IFACE =    'org.bluez.GattDescriptor1'
+
+LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
+
+logger = log.get_logger('gatt')
+adv_logger = log.get_logger('adv')
+
+# D-Bus signatures of the properties of every interface. The variants in
+# the a{?v} dictionaries always hold byte arrays.
+SIGNATURES = {
+    GATT_SERVICE_IFACE: {
+        'UUID': 's',
+        'Primary': 'b',
+        'Characteristics': 'ao',
+    },
+    GATT_CHRC_IFACE: {
+        'Service': 'o',
+        'UUID': 's',
+        'Flags': 'as',
+        'Descriptors': 'ao',
+    },
+    GATT_DESC_IFACE: {
+        'Characteristic': 'o',
+        'UUID': 's',
+        'Flags': 'as',
+    },
+    LE_ADVERTISEMENT_IFACE: {
+        'Type': 's',
+        'ServiceUUIDs': 'as',
+        'ScanResponseServiceUUIDs': 'as',
+        'SolicitUUIDs': 'as',
+        'ManufacturerData': 'a{qv}',
+        'ServiceData': 'a{sv}',
+        'LocalName': 's',
+        'IncludeTxPower': 'b',
+        'Data': 'a{yv}',
+    },
+}
+
+
+class Error(Exception):
+    """
+    Returned to the caller as the D-Bus error 'name', with the exception's
+    argument as the message.
+
+    """
+    name = 'org.bluez.Error.Failed'
+
+class InvalidArgsException(Error):
+    name = 'org.freedesktop.DBus.Error.InvalidArgs'
+
+class NotSupportedException(Error):
+    name = 'org.bluez.Error.NotSupported'
+
+class NotPermittedException(Error):
+    name = 'org.bluez.Error.NotPermitted'
+
+class InvalidValueLengthException(Error):
+    name = 'org.bluez.Error.InvalidValueLength'
+
+class FailedException(Error):
+    name = 'org.bluez.Error.Failed'
+
+class InvalidOffsetException(Error):
+    name = 'org.bluez.Error.InvalidOffset'
+
+
+class Deferred(object):
+    """
+    Reply of a handler that answers later, on the main loop, by calling
+    resolve() with the result or reject() with an Error. The backend sends
+    the D-Bus reply then, and other calls are served in the meantime.
+
+    """
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        """Calls callback(result, error) once the reply is known."""
+        if self.done:
+            callback(self.result, self.error)
+        else:
+            self.callbacks.append(callback)
+
+    def resolve(self, result=None):
+        self._finish(result, None)
+
+    def reject(self, error):
+        if not isinstance(error, Error):
+            error = FailedException(str(error))
+        self._finish(None, error)
+
+    def _finish(self, result, error):
+        if self.done:
+            return
+        self.done = True
+        self.result = result
+        self.error = error
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(result, error)
+
+
+class Advertisement(object):
+    PATH_BASE = '/org/bluez/example/advertisement'
+
+    def __init__(self, bus, index, advertising_type):
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.ad_type = advertising_type
+        self.service_uuids = None
+        self.scan_response_service_uuids = None
+        self.manufacturer_data = None
+        self.solicit_uuids = None
+        self.service_data = None
+        self.local_name = None
+        self.include_tx_power = False
+        self.data = None
+        # Set by the backend: emit_properties({name: value}) sends
+        # PropertiesChanged for the advertisement.
+        self.emit_properties = None
+
+    def get_properties(self):
+        properties = dict()
+        properties['Type'] = self.ad_type
+        if self.service_uuids is not None:
+            properties['ServiceUUIDs'] = self.service_uuids
+        if self.scan_response_service_uuids is not None:
+            properties['ScanResponseServiceUUIDs'] = \
+                    self.scan_response_service_uuids
+        if self.solicit_uuids is not None:
+            properties['SolicitUUIDs'] = self.solicit_uuids
+        if self.manufacturer_data is not None:
+            properties['ManufacturerData'] = self.manufacturer_data
+        if self.service_data is not None:
+            properties['ServiceData'] = self.service_data
+        if self.local_name is not None:
+            properties['LocalName'] = self.local_name
+        if self.include_tx_power:
+            properties['IncludeTxPower'] = self.include_tx_power
+
+        if self.data is not None:
+            properties['Data'] = self.data
+        return {LE_ADVERTISEMENT_IFACE: properties}
+
+    def get_path(self):
+        return self.path
+
+    def add_service_uuid(self, uuid):
+        if not self.service_uuids:
+            self.service_uuids = []
+        self.service_uuids.append(uuid)
+
+    def add_scan_response_service_uuid(self, uuid):
+        if not self.scan_response_service_uuids:
+            self.scan_response_service_uuids = []
+        self.scan_response_service_uuids.append(uuid)
+
+    def add_solicit_uuid(self, uuid):
+        if not self.solicit_uuids:
+            self.solicit_uuids = []
+        self.solicit_uuids.append(uuid)
+
+    def add_manufacturer_data(self, manuf_code, data):
+        if not self.manufacturer_data:
+            self.manufacturer_data = {}
+        self.manufacturer_data[manuf_code] = bytes(bytearray(data))
+
+    def add_service_data(self, uuid, data):
+        if not self.service_data:
+            self.service_data = {}
+        self.service_data[uuid] = bytes(bytearray(data))
+
+    def add_local_name(self, name):
+        self.local_name = name
+
+    def add_data(self, ad_type, data):
+        if not self.data:
+            self.data = {}
+        self.data[ad_type] = bytes(bytearray(data))
+
+    def properties_changed(self, names):
+        """Tells bluetoothd that the properties in 'names' changed."""
+        if self.emit_properties is None:
+            return
+        properties = self.get_properties()[LE_ADVERTISEMENT_IFACE]
+        self.emit_properties(dict((name, properties[name]) for name in names
+                                  if name in properties))
+
+    def Release(self):
+        adv_logger.info('%s: Released!', self.path)
+
+
+class Application(object):
+    """
+    org.bluez.GattApplication1 interface implementation
+    """
+    def __init__(self, bus):
+        self.path = '/'
+        self.bus = bus
+        self.services = []
+        self.lazy_services = []
+        self.managed_objects = None
+
+    def get_path(self):
+        return self.path
+
+    def add_service(self, service):
+        self.services.append(service)
+        self.managed_objects = None
+
+    def add_lazy_service(self, build):
+        """
+        Adds the service build() returns once the tree is first asked for,
+        which is when BlueZ registers the application, rather than now.
+        Backends export the attributes of a tree they have not seen yet.
+
+        """
+        self.lazy_services.append(build)
+        self.managed_objects = None
+
+    def build_lazy_services(self):
+        builders, self.lazy_services = self.lazy_services, []
+        for build in builders:
+            self.add_service(build())
+        logger.debug('Built %d lazy services', len(builders))
+        startup.mark('services_built')
+
+    def remove_service(self, service):
+        self.services.remove(service)
+        self.managed_objects = None
+
+    def get_managed_objects(self):
+        """
+        The whole attribute tree, built once and then returned as the same
+        object until a service is added or removed, so backends can keep
+        its marshalled form around for as long as it is current. Callers
+        must not modify it.
+
+        """
+        if self.lazy_services:
+            self.build_lazy_services()
+        if self.managed_objects is not None:
+            return self.managed_objects
+
+        response = {}
+        for service in self.services:
+            response[service.get_path()] = service.get_properties()
+            for chrc in service.get_characteristics():
+                response[chrc.get_path()] = chrc.get_properties()
+                for desc in chrc.get_descriptors():
+                    response[desc.get_path()] = desc.get_properties()
+
+        self.managed_objects = response
+        return response
+
+    def get_attributes(self):
+        for service in self.services:
+            yield service
+            for chrc in service.get_characteristics():
+                yield chrc
+                for desc in chrc.get_descriptors():
+                    yield desc
+
+
+class Service(object):
+    """
+    org.bluez.GattService1 interface implementation
+    """
+    PATH_BASE = '/org/bluez/example/service'
+
+    def __init__(self, bus, index, uuid, primary):
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.primary = primary
+        self.characteristics = []
+        self.properties = None
+
+    def get_properties(self):
+        if self.properties is None:
+            self.properties = {
+                    GATT_SERVICE_IFACE: {
+                            'UUID': self.uuid,
+                            'Primary': self.primary,
+                            'Characteristics':
+                                    self.get_characteristic_paths(),
+                    }
+            }
+        return self.properties
+
+    def get_path(self):
+        return self.path
+
+    def add_characteristic(self, characteristic):
+        self.characteristics.append(characteristic)
+        self.properties = None
+
+    def get_characteristic_paths(self):
+        result = []
+        for chrc in self.characteristics:
+            result.append(chrc.get_path())
+        return result
+
+    def get_characteristics(self):
+        return self.characteristics
+
+
+class Characteristic(object):
+    """
+    org.bluez.GattCharacteristic1 interface implementation
+    """
+    INSTRUMENTED = ('ReadValue', 'WriteValue', 'StartNotify', 'StopNotify')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls.INSTRUMENTED:
+            if name in cls.__dict__:
+                setattr(cls, name, metrics.instrument(name, cls.__dict__[name]))
+
+    def __init__(self, bus, index, uuid, flags, service):
+        self.path = service.path + '/char' + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.service = service
+        self.flags = flags
+        self.descriptors = []
+        self.properties = None
+        # Set by the backend exporting this characteristic; emits
+        # PropertiesChanged for 'Value'.
+        self.emit_value = None
+
+    def get_properties(self):
+        if self.properties is None:
+            self.properties = {
+                    GATT_CHRC_IFACE: {
+                            'Service': self.service.get_path(),
+                            'UUID': self.uuid,
+                            'Flags': self.flags,
+                            'Descriptors': self.get_descriptor_paths(),
+                    }
+            }
+        return self.properties
+
+    def get_path(self):
+        return self.path
+
+    def add_descriptor(self, descriptor):
+        self.descriptors.append(descriptor)
+        self.properties = None
+
+    def get_descriptor_paths(self):
+        result = []
+        for desc in self.descriptors:
+            result.append(desc.get_path())
+        return result
+
+    def get_descriptors(self):
+        return self.descriptors
+
+    def reassemble(self, value, options):
+        """
+        Passes a WriteValue call through the long write reassembly (see
+        reassembly.py). Returns the complete value to apply, or None when
+        the call was one chunk of a long write still in progress.
+        Characteristics taking long writes need the 'authorize' flag.
+
+        """
+        try:
+            return reassembly.uploads.write(self.path, value, options)
+        except reassembly.OffsetError:
+            raise InvalidOffsetException()
+        except reassembly.BudgetError:
+            raise InvalidValueLengthException()
+
+    def ReadValue(self, options):
+        logger.debug('Default ReadValue called, returning error')
+        raise NotSupportedException()
+
+    def WriteValue(self, value, options):
+        logger.debug('Default WriteValue called, returning error')
+        raise NotSupportedException()
+
+    def StartNotify(self):
+        logger.debug('Default StartNotify called, returning error')
+        raise NotSupportedException()
+
+    def StopNotify(self):
+        logger.debug('Default StopNotify called, returning error')
+        raise NotSupportedException()
+
+    def notify_value(self, value):
+        if self.emit_value is None:
+            return
+        stat = metrics.get_stat(self.path, 'PropertiesChanged')
+        start = time.perf_counter()
+        self.emit_value(value)
+        stat.observe(time.perf_counter() - start)
+        stat.bytes_out += len(value)
+
+
+class Descriptor(object):
+    """
+    org.bluez.GattDescriptor1 interface implementation
+    """
+    INSTRUMENTED = ('ReadValue', 'WriteValue')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls.INSTRUMENTED:
+            if name in cls.__dict__:
+                setattr(cls, name, metrics.instrument(name, cls.__dict__[name]))
+
+    def __init__(self, bus, index, uuid, flags, characteristic):
+        self.path = characteristic.path + '/desc' + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.flags = flags
+        self.chrc = characteristic
+        self.properties = None
+
+    def get_properties(self):
+        if self.properties is None:
+            self.properties = {
+                    GATT_DESC_IFACE: {
+                            'Characteristic': self.chrc.get_path(),
+                            'UUID': self.uuid,
+                            'Flags': self.flags,
+                    }
+            }
+        return self.properties
+
+    def get_path(self):
+        return self.path
+
+    def ReadValue(self, options):
+        logger.debug('Default ReadValue called, returning error')
+        raise NotSupportedException()
+
+    def WriteValue(self, value, options):
+        logger.debug('Default WriteValue called, returning error')
+        raise NotSupportedException()
@@ -0,0 +1,452 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Index of hub/storage, for listings and change tracking.
+
+Every file and directory has an entry holding its type, size, mtime and
+the generation it last changed at; removing one leaves a tombstone with
+the generation of the removal. Generations come from one counter for the
+whole tree, bumped per change, so what changed since generation N is the
+entries and tombstones above N.
+
+The index is built on first use and kept current by inotify where the
+kernel has it. Without inotify every query first stats the indexed
+directories and rescans those whose mtime moved, which catches files
+created, removed or replaced by a rename, as Storage writes them, but not
+files modified in place.
+
+It is saved to hub/cache shortly after it changes. On start the saved
+index is reconciled with the tree by a full scan, and entries that did
+not change keep their generation, so generations stay valid across
+restarts.
+
+"""
+
+import bisect
+import ctypes
+import ctypes.util
+import json
+import os
+import stat
+import struct
+
+import eventloop
+import log
+from storage import CACHE_ROOT, STORE_DIR, PartialFile, replace_file
+
+INDEX_PATH = os.path.join(CACHE_ROOT, 'index.json')
+INDEX_VERSION = 1
+SAVE_DELAY_S = 5
+
+# Tombstones kept. Changes since a generation older than the oldest one
+# dropped cannot be told, and the client has to list again.
+MAX_TOMBSTONES = 1024
+
+# Storage writes files as '<name>.part' first; they are not indexed.
+PARTIAL_SUFFIX = '.part'
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+        IN_CREATE | IN_DELETE | IN_ONLYDIR
+INOTIFY_EVENT = struct.Struct('iIII')
+
+logger = log.get_logger('storage')
+
+
+class Inotify(object):
+    """inotify(7) through libc; OSError if the kernel or libc lack it."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        try:
+            init = self.libc.inotify_init1
+        except AttributeError:
+            raise OSError('no inotify in libc')
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch', path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """(wd, mask, name) of every event queued."""
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(buf, pos)
+                pos += INOTIFY_EVENT.size
+                name = buf[pos:pos + length].rstrip(b'\0')
+                pos += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+
+class Entry(object):
+    __slots__ = ('type', 'size', 'mtime_ns', 'generation')
+
+    def __init__(self, type, size, mtime_ns, generation):
+        self.type = type
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.generation = generation
+
+    def describe(self, name):
+        """As one item of Storage.list()."""
+        return {
+                'name': name,
+                'type': self.type,
+                'size': self.size,
+                'mtime': self.mtime_ns // 1000000000,
+        }
+
+
+def join(parent, name):
+    return parent + '/' + name if parent else name
+
+
+def split(path):
+    parent, _, name = path.rpartition('/')
+    return parent, name
+
+
+def fits(items, item, budget):
+    """Whether 'item' still fits in 'budget' bytes of JSON array."""
+    size = len(json.dumps(item, separators=(',', ':'))) + 1
+    if items and size > budget[0]:
+        return False
+    budget[0] -= size
+    return True
+
+
+class Index(object):
+    """
+    Entries of 'storage', by path relative to its root with '/' between
+    components; the root itself is ''.
+
+    """
+    def __init__(self, storage, path=INDEX_PATH):
+        self.storage = storage
+        self.path = path
+        self.entries = {}
+        # Sorted names in each indexed directory.
+        self.children = {}
+        self.dirs_mtime = {}
+        self.tombstones = {}
+        self.generation = 0
+        # Changes since anything below this are no longer known.
+        self.horizon = 0
+        self.inotify = None
+        # inotify watch descriptors by directory, and the reverse.
+        self.wds = {}
+        self.watches = {}
+        self.ready = False
+        self.save_id = None
+
+    def list(self, path):
+        """Every entry of directory 'path', as Storage.list() returns."""
+        directory = self._directory(path)
+        return [self.entries[join(directory, name)].describe(name)
+                for name in self.children[directory]]
+
+    def page(self, path, cursor=None, limit=None, max_bytes=None):
+        """
+        Entries of directory 'path' after the name 'cursor', at most
+        'limit' of them and as many as fit in 'max_bytes' of JSON. Returns
+        (entries, cursor for the next page or None at the end).
+
+        """
+        directory = self._directory(path)
+        names = self.children[directory]
+        start = bisect.bisect_right(names, cursor) if cursor else 0
+        budget = [max_bytes or float('inf')]
+        items = []
+        for name in names[start:]:
+            item = self.entries[join(directory, name)].describe(name)
+            if len(items) == limit or not fits(items, item, budget):
+                return items, items[-1]['name']
+            items.append(item)
+        return items, None
+
+    def changes(self, since, limit=None, max_bytes=None):
+        """
+        What changed after generation 'since', oldest first: entries as in
+        Storage.list() with the full path as 'path', removals as
+        {"path", "deleted": true}. Returns (changes, generation to ask
+        from next, whether more are left), or None when 'since' is too
+        old and the client has to list everything again.
+
+        """
+        self._ensure()
+        if since < self.horizon:
+            return None
+        changed = [(entry.generation, path)
+                   for path, entry in self.entries.items()
+                   if entry.generation > since]
+        changed.extend((generation, path)
+                       for path, generation in self.tombstones.items()
+                       if generation > since)
+        changed.sort()
+
+        budget = [max_bytes or float('inf')]
+        items = []
+        for generation, path in changed:
+            entry = self.entries.get(path)
+            if entry is None:
+                item = {'path': path, 'deleted': True}
+            else:
+                item = entry.describe(path)
+                item['path'] = item.pop('name')
+            if len(items) == limit or not fits(items, item, budget):
+                return items, since, True
+            items.append(item)
+            since = generation
+        return items, self.generation, False
+
+    def files(self):
+        """(path, size, mtime_ns) of every file."""
+        self._ensure()
+        return [(path, entry.size, entry.mtime_ns)
+                for path, entry in self.entries.items()
+                if entry.type == 'file']
+
+    def _directory(self, path):
+        self._ensure()
+        full = self.storage.resolve(path)
+        directory = os.path.relpath(full, self.storage.root)
+        directory = '' if directory == '.' else \
+                directory.replace(os.sep, '/')
+        if directory not in self.children:
+            if directory in self.entries:
+                raise NotADirectoryError(path)
+            raise FileNotFoundError(path)
+        return directory
+
+    def _ensure(self):
+        if not self.ready:
+            self.ready = True
+            self._load()
+            self._start_inotify()
+            self._scan('')
+            logger.info('Storage index: %d entries, generation %d%s',
+                        len(self.entries), self.generation,
+                        '' if self.inotify else ' (no inotify)')
+        elif self.inotify is not None:
+            # Events not dispatched yet, such as those of a write the
+            # client made just before asking.
+            self._on_inotify()
+        else:
+            for directory, mtime_ns in list(self.dirs_mtime.items()):
+                try:
+                    st = os.stat(self._full(directory))
+                except OSError:
+                    continue
+                if st.st_mtime_ns != mtime_ns:
+                    self._scan(directory)
+
+    def _full(self, path):
+        return os.path.join(self.storage.root, *path.split('/')) \
+                if path else self.storage.root
+
+    def _scan(self, directory):
+        """Brings 'directory' and everything below it up to date."""
+        full = self._full(directory)
+        try:
+            st = os.stat(full)
+            with os.scandir(full) as it:
+                found = dict((entry.name, entry) for entry in it
+                             if not entry.name.endswith(PARTIAL_SUFFIX) and
+                             entry.path != self.storage.store)
+        except OSError:
+            self._remove(directory)
+            return
+        self.dirs_mtime[directory] = st.st_mtime_ns
+        self.children.setdefault(directory, [])
+        self._watch(directory)
+
+        for name in list(self.children[directory]):
+            if name not in found:
+                self._remove(join(directory, name))
+        for name, entry in sorted(found.items()):
+            path = join(directory, name)
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                self._remove(path)
+                continue
+            is_dir = entry.is_dir(follow_symlinks=False)
+            self._update(path, 'dir' if is_dir else 'file', st)
+            if is_dir:
+                self._scan(path)
+
+    def _refresh(self, path):
+        """Brings the single entry 'path' up to date."""
+        try:
+            st = os.lstat(self._full(path))
+        except OSError:
+            self._remove(path)
+            return
+        is_dir = stat.S_ISDIR(st.st_mode)
+        self._update(path, 'dir' if is_dir else 'file', st)
+        if is_dir and path not in self.children:
+            self._scan(path)
+
+    def _update(self, path, type, st):
+        entry = self.entries.get(path)
+        if entry is not None and entry.type == type and \
+                entry.size == st.st_size and entry.mtime_ns == st.st_mtime_ns:
+            return
+        if entry is not None and entry.type != type:
+            self._remove(path)
+            entry = None
+        self.generation += 1
+        if entry is None:
+            self.entries[path] = Entry(type, st.st_size, st.st_mtime_ns,
+                                       self.generation)
+            parent, name = split(path)
+            bisect.insort(self.children[parent], name)
+            self.tombstones.pop(path, None)
+        else:
+            entry.size = st.st_size
+            entry.mtime_ns = st.st_mtime_ns
+            entry.generation = self.generation
+        self._schedule_save()
+
+    def _remove(self, path):
+        if path == '':
+            return
+        for name in self.children.pop(path, []):
+            self._remove(join(path, name))
+        self.dirs_mtime.pop(path, None)
+        self._unwatch(path)
+        if self.entries.pop(path, None) is None:
+            return
+        parent, name = split(path)
+        names = self.children.get(parent)
+        if names is not None:
+            i = bisect.bisect_left(names, name)
+            if i < len(names) and names[i] == name:
+                del names[i]
+        self.generation += 1
+        self.tombstones[path] = self.generation
+        if len(self.tombstones) > MAX_TOMBSTONES:
+            oldest = min(self.tombstones, key=self.tombstones.get)
+            self.horizon = self.tombstones.pop(oldest)
+        self._schedule_save()
+
+    def _start_inotify(self):
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            logger.info('Storage index falls back to mtime scans: %s', e)
+            return
+        eventloop.io_add_watch(self.inotify.fd, self._on_inotify)
+
+    def _watch(self, directory):
+        if self.inotify is None or directory in self.wds:
+            return
+        try:
+            wd = self.inotify.add_watch(self._full(directory))
+        except OSError as e:
+            logger.warning('Storage index cannot watch %r: %s',
+                           directory, e)
+            return
+        self.wds[directory] = wd
+        self.watches[wd] = directory
+
+    def _unwatch(self, directory):
+        wd = self.wds.pop(directory, None)
+        if wd is not None:
+            del self.watches[wd]
+            self.inotify.rm_watch(wd)
+
+    def _on_inotify(self):
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self._scan('')
+                continue
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                if directory is not None:
+                    del self.watches[wd]
+                    del self.wds[directory]
+                continue
+            if directory is None or not name or \
+                    name.endswith(PARTIAL_SUFFIX) or \
+                    (not directory and name == STORE_DIR):
+                continue
+            self._refresh(join(directory, name))
+            # The directory's own mtime moved with it.
+            if directory:
+                self._refresh(directory)
+        return True
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        if saved.get('version') != INDEX_VERSION or \
+                saved.get('root') != self.storage.root:
+            return
+        self.generation = saved['generation']
+        self.horizon = saved['horizon']
+        self.tombstones = saved['tombstones']
+        for path, (type, size, mtime_ns, generation) in \
+                sorted(saved['entries'].items()):
+            self.entries[path] = Entry(type, size, mtime_ns, generation)
+        # Directories are listed again by the scan that follows.
+        for path, entry in self.entries.items():
+            if entry.type == 'dir':
+                self.children.setdefault(path, [])
+        self.children.setdefault('', [])
+        for path in sorted(self.entries):
+            parent, name = split(path)
+            if parent in self.children:
+                self.children[parent].append(name)
+
+    def _schedule_save(self):
+        if self.save_id is None:
+            self.save_id = eventloop.timeout_add_seconds(SAVE_DELAY_S,
+                                                         self._save)
+
+    def _save(self):
+        self.save_id = None
+        saved = {
+                'version': INDEX_VERSION,
+                'root': self.storage.root,
+                'generation': self.generation,
+                'horizon': self.horizon,
+                'tombstones': self.tombstones,
+                'entries': dict((path, [e.type, e.size, e.mtime_ns,
+                                        e.generation])
+                                for path, e in self.entries.items()),
+        }
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            replace_file(PartialFile(self.path),
+                         json.dumps(saved, separators=(',', ':'))
+                         .encode('utf-8'))
+        except OSError as e:
+            logger.warning('Saving storage index failed: %s', e)
+        return False
@@ -0,0 +1,173 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+On-disk journal of uploads in progress, so an upload can be resumed after
+the link drops or the hub restarts.
+
+For each upload it records the path, the bytes committed so far and the
+CRC-32 of those bytes. Writes are batched: at most every FLUSH_INTERVAL_MS
+the partial files that moved are synced, then the whole journal is
+written to a new file, synced and renamed over the old one. A journaled
+offset is therefore always backed by data on disk, and it trails the
+upload by at most one interval. Removals wait for the same flush, and
+the syncing and writing are done by a worker thread, so the main loop
+never waits for the disk.
+
+"""
+
+import json
+import os
+import time
+
+import background
+import eventloop
+import log
+from storage import CACHE_ROOT, PartialFile
+
+JOURNAL_PATH = os.path.join(CACHE_ROOT, 'uploads.json')
+JOURNAL_VERSION = 1
+FLUSH_INTERVAL_MS = 1000
+# Uploads not resumed for this long are given up, with their partial file.
+EXPIRE_S = 24 * 3600
+
+logger = log.get_logger('storage')
+
+
+def journal_key(device, tid):
+    return '%s#%d' % (device, tid)
+
+
+class Journal(object):
+
+    def __init__(self, path=JOURNAL_PATH, interval_ms=FLUSH_INTERVAL_MS):
+        self.path = path
+        self.interval_ms = interval_ms
+        self.entries = None
+        # Uploads written to since the last flush, by key.
+        self.dirty = {}
+        # Whether entries were removed since the last flush.
+        self.removed = False
+        self.flush_id = None
+        self.worker = background.Worker('journal', logger)
+
+    def get(self, device, tid):
+        """The entry of an upload: {"path", "tmp", "offset", "crc", ...}."""
+        self._load()
+        return self.entries.get(journal_key(device, tid))
+
+    def update(self, device, tid, upload):
+        """Records 'upload' (a transfer.FileUpload) at the next flush."""
+        self._load()
+        self.dirty[journal_key(device, tid)] = upload
+        self._schedule_flush()
+
+    def remove(self, device, tid):
+        """Forgets an upload at the next flush."""
+        self._load()
+        key = journal_key(device, tid)
+        self.dirty.pop(key, None)
+        if self.entries.pop(key, None) is not None:
+            self.removed = True
+            self._schedule_flush()
+
+    def flush(self):
+        """
+        Hands what is pending to the worker now, as before closing an
+        upload.
+
+        """
+        if self.flush_id is not None:
+            eventloop.source_remove(self.flush_id)
+            self.flush_id = None
+        self._flush()
+
+    def expire(self, now):
+        """Drops entries last touched before now - EXPIRE_S."""
+        self._load()
+        expired = [key for key, entry in self.entries.items()
+                   if entry['updated'] < now - EXPIRE_S]
+        for key in expired:
+            entry = self.entries.pop(key)
+            logger.info('Storage upload %s expired: %r', key, entry['path'])
+            try:
+                os.remove(entry['tmp'])
+            except OSError:
+                pass
+        if expired:
+            self.removed = True
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.flush_id is None:
+            self.flush_id = eventloop.timeout_add(self.interval_ms,
+                                                  self._on_flush)
+
+    def _on_flush(self):
+        self.flush_id = None
+        self._flush()
+        return False
+
+    def _flush(self):
+        if not self.dirty and not self.removed:
+            return
+        now = time.time()
+        # (fd, key, entry before) of each partial file to sync first; the
+        # fd is a copy, as the upload may close its own meanwhile.
+        syncs = []
+        for key, upload in self.dirty.items():
+            if upload.file.fd is None:
+                # Closed meanwhile; the entry keeps its last offset.
+                continue
+            syncs.append((os.dup(upload.file.fd), key,
+                          self.entries.get(key)))
+            self.entries[key] = {
+                    'path': upload.path,
+                    'tmp': upload.file.tmp,
+                    'offset': upload.offset,
+                    'crc': upload.crc,
+                    'updated': now,
+            }
+        self.dirty.clear()
+        self.removed = False
+        self.worker.submit(self._write, (syncs, dict(self.entries)))
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        if saved.get('version') == JOURNAL_VERSION:
+            self.entries = saved['uploads']
+
+    def _write(self, syncs, entries):
+        """Syncs the partial files, then writes 'entries'; on the worker."""
+        for fd, key, before in syncs:
+            try:
+                os.fdatasync(fd)
+            except OSError as e:
+                logger.warning('Syncing %s failed: %s', entries[key]['tmp'],
+                               e)
+                if before is None:
+                    del entries[key]
+                else:
+                    entries[key] = before
+            finally:
+                os.close(fd)
+        data = json.dumps({'version': JOURNAL_VERSION,
+                           'uploads': entries},
+                          separators=(',', ':')).encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            f = PartialFile(self.path)
+            try:
+                f.write(data, 0)
+                f.sync()
+            except OSError:
+                f.abort()
+                raise
+            f.commit()
+        except OSError as e:
+            logger.warning('Writing upload journal failed: %s', e)
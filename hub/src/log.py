@@ -0,0 +1,155 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+# Records waiting for the writer thread. When it is full new records are
+# dropped and counted rather than blocking the main loop.
+DEFAULT_QUEUE_SIZE = 1024
+# Per call site, at most SAMPLE_BURST records every SAMPLE_INTERVAL seconds
+# go through; the rest are only counted.
+SAMPLE_INTERVAL = 5.0
+SAMPLE_BURST = 1
+
+ROOT = 'hub'
+
+listener = None
+
+
+def get_logger(subsystem):
+    return logging.getLogger(ROOT + '.' + subsystem)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Rate limits records per call site. Records at WARNING and above always
+    pass. The first record let through after some were held back carries
+    their count in its 'suppressed' attribute.
+
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL, burst=SAMPLE_BURST):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self.sites = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        key = (record.pathname, record.lineno)
+        site = self.sites.get(key)
+        now = record.created
+        if site is None or now - site[0] >= self.interval:
+            suppressed = site[2] if site is not None else 0
+            self.sites[key] = [now, 1, 0]
+            if suppressed:
+                record.suppressed = suppressed
+            return True
+        if site[1] < self.burst:
+            site[1] += 1
+            return True
+        site[2] += 1
+        return False
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread without formatting them, so the
+    message and the repr() of its arguments are only computed there.
+    Arguments must therefore not be mutated after the call.
+
+    """
+    def __init__(self, q):
+        logging.handlers.QueueHandler.__init__(self, q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self.dropped:
+            record.dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.dropped = 0
+
+
+class Formatter(logging.Formatter):
+
+    def format(self, record):
+        text = logging.Formatter.format(self, record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += ' [%d similar suppressed]' % suppressed
+        dropped = getattr(record, 'dropped', 0)
+        if dropped:
+            text += ' [%d records dropped]' % dropped
+        return text
+
+
+def parse_levels(spec):
+    """
+    Parses 'subsystem=LEVEL,...' as found in HUB_LOG, e.g.
+    'gatt=DEBUG,storage=WARNING'.
+
+    """
+    levels = {}
+    for item in (spec or '').split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup(level=None, levels=None, stream=None,
+          queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    Routes every hub logger through a bounded queue to a background writer
+    thread. The default level comes from HUB_LOG_LEVEL and per subsystem
+    overrides from HUB_LOG unless given here.
+
+    """
+    global listener
+
+    if listener is not None:
+        return
+
+    if level is None:
+        level = os.environ.get('HUB_LOG_LEVEL', 'INFO').upper()
+    if levels is None:
+        levels = parse_levels(os.environ.get('HUB_LOG'))
+
+    root = logging.getLogger(ROOT)
+    root.setLevel(level)
+    root.propagate = False
+    for name, subsystem_level in levels.items():
+        get_logger(name).setLevel(subsystem_level)
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(Formatter('%(asctime)s %(name)s %(levelname)s '
+                                  '%(message)s'))
+
+    handler = QueueHandler(queue.Queue(queue_size))
+    handler.addFilter(SamplingFilter())
+    root.addHandler(handler)
+
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+
+
+def shutdown():
+    """Flushes what is still queued and stops the writer thread."""
+    global listener
+
+    if listener is None:
+        return
+    listener.stop()
+    listener = None
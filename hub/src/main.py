@@ -1,782 +1,1621 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: LGPL-2.1-or-later
 
-import dbus
-import dbus.exceptions
-import dbus.mainloop.glib
-import dbus.service
-
-import array
-from gi.repository import GLib
-import sys
+import argparse
+import base64
+import importlib
+import json
+import os
+import struct
+import zlib
 
 from random import randint
 
-mainloop = None
-
-BLUEZ_SERVICE_NAME = 'org.bluez'
-GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
-DBUS_OM_IFACE =      'org.freedesktop.DBus.ObjectManager'
-DBUS_PROP_IFACE =    'org.freedesktop.DBus.Properties'
-
-GATT_SERVICE_IFACE = 'org.bluez.GattService1'
-GATT_CHRC_IFACE =    'org.bluez.GattCharacteristic1'
-GATT_DESC_IFACE =    'org.bluez.GattDescriptor1'
-
-LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
-LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
-
-class InvalidArgsException(dbus.exceptions.DBusException):
-    _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
-
-class NotSupportedException(dbus.exceptions.DBusException):
-    _dbus_error_name = 'org.bluez.Error.NotSupported'
-
-class NotPermittedException(dbus.exceptions.DBusException):
-    _dbus_error_name = 'org.bluez.Error.NotPermitted'
-
-class InvalidValueLengthException(dbus.exceptions.DBusException):
-    _dbus_error_name = 'org.bluez.Error.InvalidValueLength'
-
-class FailedException(dbus.exceptions.DBusException):
-    _dbus_error_name = 'org.bluez.Error.Failed'
-
-
-class Advertisement(dbus.service.Object):
-    PATH_BASE = '/org/bluez/example/advertisement'
-
-    def __init__(self, bus, index, advertising_type):
-        self.path = self.PATH_BASE + str(index)
-        self.bus = bus
-        self.ad_type = advertising_type
-        self.service_uuids = None
-        self.manufacturer_data = None
-        self.solicit_uuids = None
-        self.service_data = None
-        self.local_name = None
-        self.include_tx_power = False
-        self.data = None
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_properties(self):
-        properties = dict()
-        properties['Type'] = self.ad_type
-        if self.service_uuids is not None:
-            properties['ServiceUUIDs'] = dbus.Array(self.service_uuids,
-                                                    signature='s')
-        if self.solicit_uuids is not None:
-            properties['SolicitUUIDs'] = dbus.Array(self.solicit_uuids,
-                                                    signature='s')
-        if self.manufacturer_data is not None:
-            properties['ManufacturerData'] = dbus.Dictionary(
-                self.manufacturer_data, signature='qv')
-        if self.service_data is not None:
-            properties['ServiceData'] = dbus.Dictionary(self.service_data,
-                                                        signature='sv')
-        if self.local_name is not None:
-            properties['LocalName'] = dbus.String(self.local_name)
-        if self.include_tx_power:
-            properties['IncludeTxPower'] = dbus.Boolean(self.include_tx_power)
-
-        if self.data is not None:
-            properties['Data'] = dbus.Dictionary(
-                self.data, signature='yv')
-        return {LE_ADVERTISEMENT_IFACE: properties}
-
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    def add_service_uuid(self, uuid):
-        if not self.service_uuids:
-            self.service_uuids = []
-        self.service_uuids.append(uuid)
-
-    def add_solicit_uuid(self, uuid):
-        if not self.solicit_uuids:
-            self.solicit_uuids = []
-        self.solicit_uuids.append(uuid)
-
-    def add_manufacturer_data(self, manuf_code, data):
-        if not self.manufacturer_data:
-            self.manufacturer_data = dbus.Dictionary({}, signature='qv')
-        self.manufacturer_data[manuf_code] = dbus.Array(data, signature='y')
-
-    def add_service_data(self, uuid, data):
-        if not self.service_data:
-            self.service_data = dbus.Dictionary({}, signature='sv')
-        self.service_data[uuid] = dbus.Array(data, signature='y')
-
-    def add_local_name(self, name):
-        self.local_name = name
-
-    def add_data(self, ad_type, data):
-        if not self.data:
-            self.data = dbus.Dictionary({}, signature='yv')
-        self.data[ad_type] = dbus.Array(data, signature='y')
-
-    @dbus.service.method(DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        print('GetAll')
-        if interface != LE_ADVERTISEMENT_IFACE:
-            raise InvalidArgsException()
-        print('returning props')
-        return self.get_properties()[LE_ADVERTISEMENT_IFACE]
-
-    @dbus.service.method(LE_ADVERTISEMENT_IFACE,
-                         in_signature='',
-                         out_signature='')
-    def Release(self):
-        print('%s: Released!' % self.path)
+from beacon import StatusBeacon
+import eventloop
+import events
+import dispatch
+import gatt
+import log
+import metrics
+import sampling
+import sessions
+import startup
+import state
+from gatt import (Advertisement, Characteristic, Deferred, Descriptor,
+                  Service, InvalidArgsException, NotPermittedException,
+                  InvalidValueLengthException, FailedException,
+                  InvalidOffsetException)
+from scheduler import NotificationScheduler
+import values
+from values import Value
+
+# Only the services built lazily use these, so they are imported when
+# first used (see startup.lazy_import()) and, with --fast-startup, only
+# once BlueZ asks for the application.
+audio = startup.lazy_import('audio')
+chunks = startup.lazy_import('chunks')
+compression = startup.lazy_import('compression')
+journal = startup.lazy_import('journal')
+runner = startup.lazy_import('runner')
+storage = startup.lazy_import('storage')
+transfer = startup.lazy_import('transfer')
+wifi = startup.lazy_import('wifi')
+
+# Selected with --backend.
+BACKENDS = {
+    'glib': 'backend_glib',
+    'aio': 'backend_aio',
+}
+DEFAULT_BACKEND = 'glib'
+# Where the hub plays sounds, see audio.open_sink(); set with --audio-sink.
+AUDIO_SINK = 'auto'
+# Commands behind the Wi-Fi service, see wifi.open_backend(); set with
+# --wifi-backend.
+WIFI_BACKEND = 'auto'
+# Services marked 'lazy' in GATT_SCHEMA are built when BlueZ first asks
+# for the application, and the advertisement goes out first; set with
+# --fast-startup.
+FAST_STARTUP = False
+
+scheduler = NotificationScheduler()
+# Status carried in the advertisement, fed by the services.
+beacon = StatusBeacon()
+
+logger = log.get_logger('gatt')
+adv_logger = log.get_logger('adv')
+storage_logger = log.get_logger('storage')
 
 
 class TestAdvertisement(Advertisement):
+    """
+    Legacy advertising data holds 31 bytes: the flags bluetoothd adds (3),
+    the Storage Service UUID (18) and the beacon's ManufacturerData (10).
+    The 16-bit service UUIDs go in the scan response, where bluetoothd
+    also puts the local name.
 
+    """
     def __init__(self, bus, index):
         Advertisement.__init__(self, bus, index, 'peripheral')
-        self.add_service_uuid('180D')  # Heart Rate Service
-        self.add_service_uuid('180F')  # Battery Service  
-        self.add_service_uuid('12345678-1234-5678-1234-56789abcdef0')  # Test Service
+        self.add_service_uuid('12345678-1234-5678-1234-56789abcdef0')  # Storage Service
+        self.add_scan_response_service_uuid('180D')  # Heart Rate Service
+        self.add_scan_response_service_uuid('180F')  # Battery Service
         self.add_local_name('TCC-Hub-Device')
-        self.include_tx_power = True
 
 
-class Application(dbus.service.Object):
+class Application(gatt.Application):
     """
-    org.bluez.GattApplication1 interface implementation
-    """
-    def __init__(self, bus):
-        self.path = '/'
-        self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
-        self.add_service(HeartRateService(bus, 0))
-        self.add_service(BatteryService(bus, 1))
-        self.add_service(TestService(bus, 2))
-
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    def add_service(self, service):
-        self.services.append(service)
-
-    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
-    def GetManagedObjects(self):
-        response = {}
-        print('GetManagedObjects')
+    The hub's attribute tree, built from GATT_SCHEMA unless another schema
+    is given. With 'lazy', entries marked 'lazy' are only built once the
+    tree is first asked for.
 
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
-
-        return response
-
-
-class Service(dbus.service.Object):
     """
-    org.bluez.GattService1 interface implementation
-    """
-    PATH_BASE = '/org/bluez/example/service'
+    def __init__(self, bus, schema=None, lazy=False):
+        gatt.Application.__init__(self, bus)
+        if schema is None:
+            schema = GATT_SCHEMA
+        for index, entry in enumerate(schema):
+            if lazy and entry.get('lazy'):
+                self.add_lazy_service(
+                        lambda index=index, entry=entry:
+                                build_service(bus, index, entry))
+            else:
+                self.add_service(build_service(bus, index, entry))
+        if not self.lazy_services:
+            self.get_managed_objects()
 
-    def __init__(self, bus, index, uuid, primary):
-        self.path = self.PATH_BASE + str(index)
-        self.bus = bus
-        self.uuid = uuid
-        self.primary = primary
-        self.characteristics = []
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_properties(self):
-        return {
-                GATT_SERVICE_IFACE: {
-                        'UUID': self.uuid,
-                        'Primary': self.primary,
-                        'Characteristics': dbus.Array(
-                                self.get_characteristic_paths(),
-                                signature='o')
-                }
-        }
-
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    def add_characteristic(self, characteristic):
-        self.characteristics.append(characteristic)
-
-    def get_characteristic_paths(self):
-        result = []
-        for chrc in self.characteristics:
-            result.append(chrc.get_path())
-        return result
-
-    def get_characteristics(self):
-        return self.characteristics
-
-    @dbus.service.method(DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != GATT_SERVICE_IFACE:
-            raise InvalidArgsException()
-
-        return self.get_properties()[GATT_SERVICE_IFACE]
 
-
-class Characteristic(dbus.service.Object):
-    """
-    org.bluez.GattCharacteristic1 interface implementation
+class HeartRateService(Service):
     """
-    def __init__(self, bus, index, uuid, flags, service):
-        self.path = service.path + '/char' + str(index)
-        self.bus = bus
-        self.uuid = uuid
-        self.service = service
-        self.flags = flags
-        self.descriptors = []
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_properties(self):
-        return {
-                GATT_CHRC_IFACE: {
-                        'Service': self.service.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                        'Descriptors': dbus.Array(
-                                self.get_descriptor_paths(),
-                                signature='o')
-                }
-        }
-
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    def add_descriptor(self, descriptor):
-        self.descriptors.append(descriptor)
-
-    def get_descriptor_paths(self):
-        result = []
-        for desc in self.descriptors:
-            result.append(desc.get_path())
-        return result
-
-    def get_descriptors(self):
-        return self.descriptors
-
-    @dbus.service.method(DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != GATT_CHRC_IFACE:
-            raise InvalidArgsException()
-
-        return self.get_properties()[GATT_CHRC_IFACE]
-
-    @dbus.service.method(GATT_CHRC_IFACE,
-                        in_signature='a{sv}',
-                        out_signature='ay')
-    def ReadValue(self, options):
-        print('Default ReadValue called, returning error')
-        raise NotSupportedException()
-
-    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
-    def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
-        raise NotSupportedException()
-
-    @dbus.service.method(GATT_CHRC_IFACE)
-    def StartNotify(self):
-        print('Default StartNotify called, returning error')
-        raise NotSupportedException()
-
-    @dbus.service.method(GATT_CHRC_IFACE)
-    def StopNotify(self):
-        print('Default StopNotify called, returning error')
-        raise NotSupportedException()
-
-    @dbus.service.signal(DBUS_PROP_IFACE,
-                         signature='sa{sv}as')
-    def PropertiesChanged(self, interface, changed, invalidated):
-        pass
-
+    Fake Heart Rate Service that simulates a fake heart beat and control point
+    behavior. Energy expended is kept across restarts.
 
-class Descriptor(dbus.service.Object):
-    """
-    org.bluez.GattDescriptor1 interface implementation
     """
-    def __init__(self, bus, index, uuid, flags, characteristic):
-        self.path = characteristic.path + '/desc' + str(index)
-        self.bus = bus
-        self.uuid = uuid
-        self.flags = flags
-        self.chrc = characteristic
-        dbus.service.Object.__init__(self, bus, self.path)
+    ENERGY = struct.Struct('<H')
 
-    def get_properties(self):
-        return {
-                GATT_DESC_IFACE: {
-                        'Characteristic': self.chrc.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                }
-        }
-
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    @dbus.service.method(DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != GATT_DESC_IFACE:
-            raise InvalidArgsException()
-
-        return self.get_properties()[GATT_DESC_IFACE]
-
-    @dbus.service.method(GATT_DESC_IFACE,
-                        in_signature='a{sv}',
-                        out_signature='ay')
-    def ReadValue(self, options):
-        print ('Default ReadValue called, returning error')
-        raise NotSupportedException()
+    def __init__(self, bus, index, uuid, primary):
+        Service.__init__(self, bus, index, uuid, primary)
+        self.energy_expended = self.ENERGY.unpack(
+                state.store.get('energy_expended', self.ENERGY.pack(0)))[0]
 
-    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
-    def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
-        raise NotSupportedException()
+    def set_energy_expended(self, energy):
+        self.energy_expended = energy
+        state.store.set('energy_expended', self.ENERGY.pack(energy))
 
 
-class HeartRateService(Service):
-    """
-    Fake Heart Rate Service that simulates a fake heart beat and control point
-    behavior.
-
+class HeartRateMeasurementChrc(Characteristic):
     """
-    HR_UUID = '0000180d-0000-1000-8000-00805f9b34fb'
+    Simulated heart rate. In per-sample mode, the default, each reading is
+    notified as a Heart Rate Measurement. In batched mode the beats per
+    minute go to a sampling.SampleRing of bytes and are notified packed by
+    a sampling.BatchPacker; energy expended is only sent per sample. The
+    Sampling Mode descriptor switches between them.
 
-    def __init__(self, bus, index):
-        Service.__init__(self, bus, index, self.HR_UUID, True)
-        self.add_characteristic(HeartRateMeasurementChrc(bus, 0, self))
-        self.add_characteristic(BodySensorLocationChrc(bus, 1, self))
-        self.add_characteristic(HeartRateControlPointChrc(bus, 2, self))
-        self.energy_expended = 0
+    Every sample is also published on events.HEART_RATE_TOPIC. While
+    programs subscribe and no client is notified, samples are taken
+    every SAMPLE_INTERVAL_MS for them alone.
 
+    """
+    SAMPLE_INTERVAL_MS = 1000
 
-class HeartRateMeasurementChrc(Characteristic):
-    HR_MSRMT_UUID = '00002a37-0000-1000-8000-00805f9b34fb'
-
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-                self, bus, index,
-                self.HR_MSRMT_UUID,
-                ['notify'],
-                service)
+    def __init__(self, bus, index, uuid, flags, service):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
         self.notifying = False
         self.hr_ee_count = 0
+        self.mode = sampling.MODE_SAMPLE
+        self.interval_ms = self.SAMPLE_INTERVAL_MS
+        self.ring = sampling.SampleRing('B')
+        self.packer = sampling.BatchPacker(self.ring, self)
+        self.sample_id = None
+        self.events_id = None
+        events.bus.add_source(events.HEART_RATE_TOPIC, self._start_events,
+                              self._stop_events)
+
+    def take_sample(self):
+        bpm = randint(90, 130)
+        energy = self.service.energy_expended
+        self.service.set_energy_expended(min(0xffff, energy + 1))
+        events.bus.publish(events.HEART_RATE_TOPIC, 'bpm', bpm,
+                           changed_only=True)
+        events.bus.publish(events.HEART_RATE_TOPIC, 'energy_expended',
+                           energy, changed_only=True)
+        return bpm, energy
 
     def hr_msrmt_cb(self):
-        value = []
-        value.append(dbus.Byte(0x06))
+        bpm, energy = self.take_sample()
+        value = bytearray()
+        value.append(0x06)
 
-        value.append(dbus.Byte(randint(90, 130)))
+        value.append(bpm)
 
         if self.hr_ee_count % 10 == 0:
-            value[0] = dbus.Byte(value[0] | 0x08)
-            value.append(dbus.Byte(self.service.energy_expended & 0xff))
-            value.append(dbus.Byte((self.service.energy_expended >> 8) & 0xff))
+            value[0] = value[0] | 0x08
+            value.append(energy & 0xff)
+            value.append((energy >> 8) & 0xff)
 
-        self.service.energy_expended = \
-                min(0xffff, self.service.energy_expended + 1)
         self.hr_ee_count += 1
 
-        print('Updating value: ' + repr(value))
+        logger.debug('Updating value: %r', value)
 
-        self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': value }, [])
+        return value
 
-        return self.notifying
+    def set_sampling(self, mode, interval_ms, mtu):
+        self.mode = mode
+        self.interval_ms = interval_ms
+        self.packer.set_mtu(mtu)
+        if self.notifying:
+            self._stop_sampling()
+            self._start_sampling()
+
+    def _start_sampling(self):
+        if self.mode == sampling.MODE_SAMPLE:
+            scheduler.add(self, self.interval_ms, self.hr_msrmt_cb)
+        else:
+            self.sample_id = eventloop.timeout_add(self.interval_ms,
+                                                   self._on_sample)
+
+    def _stop_sampling(self):
+        scheduler.remove(self)
+        if self.sample_id is not None:
+            eventloop.source_remove(self.sample_id)
+            self.sample_id = None
+        self.packer.flush(eventloop.monotonic_ms(), force=True)
+
+    def _on_sample(self):
+        now = eventloop.monotonic_ms()
+        self.ring.append(now, self.take_sample()[0])
+        self.packer.flush(now)
+        return True
 
-    def _update_hr_msrmt_simulation(self):
-        print('Update HR Measurement Simulation')
+    def _start_events(self):
+        if self.events_id is None:
+            self.events_id = eventloop.timeout_add(self.SAMPLE_INTERVAL_MS,
+                                                   self._on_events_sample)
 
-        if not self.notifying:
-            return
+    def _stop_events(self):
+        if self.events_id is not None:
+            eventloop.source_remove(self.events_id)
+            self.events_id = None
 
-        GLib.timeout_add(1000, self.hr_msrmt_cb)
+    def _on_events_sample(self):
+        # Notified clients take samples already.
+        if not self.notifying:
+            self.take_sample()
+        return True
 
     def StartNotify(self):
         if self.notifying:
-            print('Already notifying, nothing to do')
+            logger.debug('Already notifying, nothing to do')
             return
 
         self.notifying = True
-        self._update_hr_msrmt_simulation()
+        self._start_sampling()
 
     def StopNotify(self):
         if not self.notifying:
-            print('Not notifying, nothing to do')
+            logger.debug('Not notifying, nothing to do')
             return
 
         self.notifying = False
-        self._update_hr_msrmt_simulation()
-
+        self._stop_sampling()
 
-class BodySensorLocationChrc(Characteristic):
-    BODY_SNSR_LOC_UUID = '00002a38-0000-1000-8000-00805f9b34fb'
-
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-                self, bus, index,
-                self.BODY_SNSR_LOC_UUID,
-                ['read'],
-                service)
-
-    def ReadValue(self, options):
-        # Return 'Chest' as the sensor location.
-        return [ 0x01 ]
 
 class HeartRateControlPointChrc(Characteristic):
-    HR_CTRL_PT_UUID = '00002a39-0000-1000-8000-00805f9b34fb'
-
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-                self, bus, index,
-                self.HR_CTRL_PT_UUID,
-                ['write'],
-                service)
+    PRIORITY = dispatch.CONTROL
 
     def WriteValue(self, value, options):
-        print('Heart Rate Control Point WriteValue called')
+        logger.debug('Heart Rate Control Point WriteValue called')
 
         if len(value) != 1:
             raise InvalidValueLengthException()
 
         byte = value[0]
-        print('Control Point value: ' + repr(byte))
+        logger.debug('Control Point value: %r', byte)
 
         if byte != 1:
             raise FailedException("0x80")
 
-        print('Energy Expended field reset!')
-        self.service.energy_expended = 0
-
-
-class BatteryService(Service):
-    """
-    Fake Battery service that emulates a draining battery.
-
-    """
-    BATTERY_UUID = '180f'
-
-    def __init__(self, bus, index):
-        Service.__init__(self, bus, index, self.BATTERY_UUID, True)
-        self.add_characteristic(BatteryLevelCharacteristic(bus, 0, self))
+        logger.info('Energy Expended field reset!')
+        self.service.set_energy_expended(0)
 
 
 class BatteryLevelCharacteristic(Characteristic):
     """
     Fake Battery Level characteristic. The battery level is drained by 2 points
-    every 5 seconds.
+    every 5 seconds while a client is subscribed, and kept across restarts.
+    Levels are published on events.BATTERY_TOPIC, and programs subscribing
+    there drain the battery too, with no client.
 
     """
-    BATTERY_LVL_UUID = '2a19'
+    DRAIN_INTERVAL_MS = 5000
 
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-                self, bus, index,
-                self.BATTERY_LVL_UUID,
-                ['read', 'notify'],
-                service)
+    def __init__(self, bus, index, uuid, flags, service):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
         self.notifying = False
-        self.battery_lvl = 100
-        GLib.timeout_add(5000, self.drain_battery)
-
-    def notify_battery_level(self):
-        if not self.notifying:
-            return
-        self.PropertiesChanged(
-                GATT_CHRC_IFACE,
-                { 'Value': [dbus.Byte(self.battery_lvl)] }, [])
+        self.battery_lvl = state.store.get('battery', b'\x64')[0]
+        self.value = Value(bytes([self.battery_lvl]))
+        beacon.set('battery', self.battery_lvl)
+        self.events_id = None
+        events.bus.add_source(events.BATTERY_TOPIC, self._start_events,
+                              self._stop_events)
 
     def drain_battery(self):
-        if not self.notifying:
-            return True
         if self.battery_lvl > 0:
             self.battery_lvl -= 2
             if self.battery_lvl < 0:
                 self.battery_lvl = 0
-        print('Battery Level drained: ' + repr(self.battery_lvl))
-        self.notify_battery_level()
-        return True
+        logger.debug('Battery Level drained: %r', self.battery_lvl)
+        self.value.set(bytes([self.battery_lvl]))
+        state.store.set('battery', self.value.data)
+        beacon.set('battery', self.battery_lvl)
+        events.bus.publish(events.BATTERY_TOPIC, 'level', self.battery_lvl,
+                           changed_only=True)
+        return self.value
 
     def ReadValue(self, options):
-        print('Battery Level read: ' + repr(self.battery_lvl))
-        return [dbus.Byte(self.battery_lvl)]
+        logger.debug('Battery Level read: %r', self.battery_lvl)
+        return self.value.get()
 
     def StartNotify(self):
         if self.notifying:
-            print('Already notifying, nothing to do')
+            logger.debug('Already notifying, nothing to do')
             return
 
         self.notifying = True
-        self.notify_battery_level()
+        scheduler.add(self, self.DRAIN_INTERVAL_MS, self.drain_battery)
+        scheduler.forget(self)
+        scheduler.notify(self, self.value)
 
     def StopNotify(self):
         if not self.notifying:
-            print('Not notifying, nothing to do')
+            logger.debug('Not notifying, nothing to do')
             return
 
         self.notifying = False
+        scheduler.remove(self)
+
+    def _start_events(self):
+        # The level now, for the programs that just subscribed.
+        events.bus.publish(events.BATTERY_TOPIC, 'level', self.battery_lvl)
+        if self.events_id is None:
+            self.events_id = eventloop.timeout_add(self.DRAIN_INTERVAL_MS,
+                                                   self._on_events_drain)
+
+    def _stop_events(self):
+        if self.events_id is not None:
+            eventloop.source_remove(self.events_id)
+            self.events_id = None
+
+    def _on_events_drain(self):
+        # Notified clients drain it already.
+        if not self.notifying:
+            self.drain_battery()
+        return True
 
 
-class TestService(Service):
+class TestCharacteristic(Characteristic):
     """
-    Dummy test service that provides characteristics and descriptors that
-    exercise various API functionality.
+    Dummy test characteristic. Allows writing arbitrary bytes to its value,
+    which each client has its own of (see sessions.py) and finds again
+    after a restart (see restore_sessions()). The encrypted and secure
+    variants only differ in their flags.
 
     """
-    TEST_SVC_UUID = '12345678-1234-5678-1234-56789abcdef0'
+    EMPTY = Value()
 
-    def __init__(self, bus, index):
-        Service.__init__(self, bus, index, self.TEST_SVC_UUID, True)
-        self.add_characteristic(TestCharacteristic(bus, 0, self))
-        self.add_characteristic(TestEncryptCharacteristic(bus, 1, self))
-        self.add_characteristic(TestSecureCharacteristic(bus, 2, self))
+    def ReadValue(self, options):
+        value = sessions.store.get(options).get(self.path, self.EMPTY)
+        logger.debug('TestCharacteristic %s Read: %r', self.uuid, value.data)
+        return read_value(value, options)
 
-class TestCharacteristic(Characteristic):
+    def WriteValue(self, value, options):
+        value = self.reassemble(value, options)
+        if value is None:
+            return
+        logger.debug('TestCharacteristic %s Write: %r', self.uuid, value)
+        keep(options, self.path, Value(value), len(value))
+        state.store.set(session_key(options.get('device', sessions.ANONYMOUS),
+                                    self.path), value)
+
+
+class StaticCharacteristic(Characteristic):
     """
-    Dummy test characteristic. Allows writing arbitrary bytes to its value, and
-    contains "extended properties", as well as a test descriptor.
+    Read-only characteristic serving the constant 'value' of its schema entry.
 
     """
-    TEST_CHRC_UUID = '12345678-1234-5678-1234-56789abcdef1'
+    def __init__(self, bus, index, uuid, flags, service, value):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.value = Value(value)
+
+    def ReadValue(self, options):
+        return read_value(self.value, options)
 
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-                self, bus, index,
-                self.TEST_CHRC_UUID,
-                ['read', 'write', 'writable-auxiliaries'],
-                service)
-        self.value = []
-        self.add_descriptor(TestDescriptor(bus, 0, self))
-        self.add_descriptor(
-                CharacteristicUserDescriptionDescriptor(bus, 1, self))
+
+class StaticDescriptor(Descriptor):
+    """
+    Descriptor serving the constant 'value' of its schema entry.
+
+    """
+    def __init__(self, bus, index, uuid, flags, characteristic, value):
+        Descriptor.__init__(self, bus, index, uuid, flags, characteristic)
+        self.value = Value(value)
 
     def ReadValue(self, options):
-        print('TestCharacteristic Read: ' + repr(self.value))
-        return self.value
+        return read_value(self.value, options)
+
+
+class CharacteristicUserDescriptionDescriptor(Descriptor):
+    """
+    Writable CUD descriptor. What clients write is kept across restarts.
+
+    """
+    def __init__(self, bus, index, uuid, flags, characteristic, value):
+        self.writable = 'writable-auxiliaries' in characteristic.flags
+        self.value = Value(value)
+        Descriptor.__init__(self, bus, index, uuid, flags, characteristic)
+        self.value.set(state.store.get('cud:' + self.path, value))
+
+    def ReadValue(self, options):
+        return read_value(self.value, options)
 
     def WriteValue(self, value, options):
-        print('TestCharacteristic Write: ' + repr(value))
-        self.value = value
+        if not self.writable:
+            raise NotPermittedException()
+        self.value.set(value)
+        state.store.set('cud:' + self.path, self.value.data)
 
 
-class TestDescriptor(Descriptor):
+class SamplingModeDescriptor(Descriptor):
     """
-    Dummy test descriptor. Returns a static value.
+    How its characteristic notifies samples: FORMAT, the mode
+    (sampling.MODE_SAMPLE or MODE_BATCH), the sampling interval in
+    milliseconds and the ATT MTU batches are sized for. A write may leave
+    out trailing fields to keep their value.
 
     """
-    TEST_DESC_UUID = '12345678-1234-5678-1234-56789abcdef2'
+    FORMAT = struct.Struct('<BHH')
+    MIN_INTERVAL_MS = 10
 
-    def __init__(self, bus, index, characteristic):
-        Descriptor.__init__(
-                self, bus, index,
-                self.TEST_DESC_UUID,
-                ['read', 'write'],
-                characteristic)
+    def ReadValue(self, options):
+        chrc = self.chrc
+        return self.FORMAT.pack(chrc.mode, chrc.interval_ms,
+                                chrc.packer.limit +
+                                transfer.ATT_NOTIFY_OVERHEAD)
+
+    def WriteValue(self, value, options):
+        current = self.FORMAT.unpack(self.ReadValue(options))
+        value = bytes(value)
+        if len(value) not in (1, 3, 5):
+            raise InvalidValueLengthException()
+        mode, interval_ms, mtu = self.FORMAT.unpack(
+                value + self.FORMAT.pack(*current)[len(value):])
+        if mode not in (sampling.MODE_SAMPLE, sampling.MODE_BATCH) or \
+                interval_ms < self.MIN_INTERVAL_MS:
+            raise InvalidArgsException()
+        self.chrc.set_sampling(mode, interval_ms, mtu)
+
+
+class MetricsChrc(Characteristic):
+    """
+    Read-only snapshot of the per attribute call counters and latencies,
+    packed as described in metrics.py. Taken on the read at offset 0 and
+    kept for the blob reads that follow.
+
+    """
+    def __init__(self, bus, index, uuid, flags, service):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.snapshot = Value()
 
     def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+        if int(options.get('offset', 0)) == 0:
+            self.snapshot.set(metrics.snapshot(transfer.MAX_ATTR_LEN))
+        return read_value(self.snapshot, options)
 
 
-class CharacteristicUserDescriptionDescriptor(Descriptor):
+class StartupChrc(Characteristic):
     """
-    Writable CUD descriptor.
+    Where startup went, as JSON: {"fast": --fast-startup given, "phases":
+    startup.breakdown()}. Taken on the read at offset 0.
 
     """
-    CUD_UUID = '2901'
+    def __init__(self, bus, index, uuid, flags, service):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.breakdown = Value()
 
-    def __init__(self, bus, index, characteristic):
-        self.writable = 'writable-auxiliaries' in characteristic.flags
-        self.value = array.array('B', b'This is a characteristic for testing')
-        self.value = self.value.tolist()
-        Descriptor.__init__(
-                self, bus, index,
-                self.CUD_UUID,
-                ['read', 'write'],
-                characteristic)
+    def ReadValue(self, options):
+        if int(options.get('offset', 0)) == 0:
+            self.breakdown.set(encode_json({
+                    'fast': FAST_STARTUP,
+                    'phases': startup.breakdown()}))
+        return read_value(self.breakdown, options)
+
+
+class HubService(Service):
+    """
+    State of the hub itself, and the devices it drives directly: sounds
+    are played by an audio.AudioEngine and programs run by a
+    runner.ProgramRunner, both started with the service. Programs take
+    their events from the hub's events.bus.
+
+    """
+    def __init__(self, bus, index, uuid, primary):
+        Service.__init__(self, bus, index, uuid, primary)
+        self.storage = storage.Storage()
+        self.audio = audio.AudioEngine(self.storage,
+                                       audio.open_sink(AUDIO_SINK))
+        self.audio.start()
+        self.events = events.bus
+        self.timer = events.TimerSource(self.events)
+        self.runner = runner.ProgramRunner(bus=self.events)
+        self.runner.start()
+
+
+class AudioChrc(Characteristic):
+    """
+    Sound blocks. Writes are JSON: {"play": path} starts a clip of the
+    storage (e.g. "audios/x.mp3"), {"stop": true} stops all of them,
+    {"volume": n} sets the volume in percent and {"change_volume": n}
+    moves it. Reading returns the engine's stats (cache hit rate, decode
+    time, trigger latency) as JSON.
+
+    """
+    PRIORITY = dispatch.CONTROL
+
+    def __init__(self, bus, index, uuid, flags, service):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.stats = Value()
 
     def ReadValue(self, options):
-        return self.value
+        if int(options.get('offset', 0)) == 0:
+            self.stats.set(encode_json(self.service.audio.stats()))
+        return read_value(self.stats, options)
 
     def WriteValue(self, value, options):
-        if not self.writable:
-            raise NotPermittedException()
-        self.value = value
+        request = parse_json_value(value)
+        engine = self.service.audio
+        try:
+            if 'volume' in request:
+                engine.set_volume(int(request['volume']))
+            if 'change_volume' in request:
+                engine.change_volume(int(request['change_volume']))
+        except (TypeError, ValueError):
+            raise InvalidArgsException()
+        if request.get('stop'):
+            engine.stop_all()
+        path = request.get('play')
+        if path is not None:
+            try:
+                engine.play(str(path))
+            except ValueError:
+                raise NotPermittedException()
+            except OSError as e:
+                raise FailedException(str(e))
+
+
+class ProgramChrc(Characteristic):
+    """
+    Runs the editor's programs. Writes are JSON: {"source": code} or
+    {"path": storage path} runs a program, {"stop": id} stops one and
+    {"stop": true} all of them. Reading returns the recent runs with their
+    state, error and output, and the runner's stats (play to first
+    statement latency, compile cache). Each state change and each chunk
+    of output is notified as {"id", "state", "error"} or {"id", "output"}.
+    Programs subscribe to the hub's events through the 'events' object in
+    their globals (see worker.ProgramEvents).
 
-class TestEncryptCharacteristic(Characteristic):
     """
-    Dummy test characteristic requiring encryption.
+    PRIORITY = dispatch.CONTROL
+    # Output notified at once, so a notification fits a typical MTU.
+    NOTIFY_OUTPUT = 160
+
+    def __init__(self, bus, index, uuid, flags, service):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.notifying = False
+        self.status = Value()
+        service.runner.on_event = self._on_event
+
+    def ReadValue(self, options):
+        if int(options.get('offset', 0)) == 0:
+            programs = self.service.runner
+            self.status.set(encode_json({
+                    'runs': [run.describe() for run in programs.runs.values()],
+                    'stats': programs.stats(),
+            }))
+        return read_value(self.status, options)
+
+    def WriteValue(self, value, options):
+        value = self.reassemble(value, options)
+        if value is None:
+            return
+        request = parse_json_value(value)
+        programs = self.service.runner
+        stop = request.get('stop')
+        if stop is True:
+            programs.stop()
+        elif stop is not None:
+            try:
+                programs.stop(int(stop))
+            except (TypeError, ValueError):
+                raise InvalidArgsException()
+
+        source = request.get('source')
+        name = '<program>'
+        path = request.get('path')
+        if path is not None:
+            name = str(path)
+            try:
+                data = self.service.storage.open_map(name)
+            except ValueError:
+                raise NotPermittedException()
+            except OSError as e:
+                raise FailedException(str(e))
+            source = bytes(data).decode('utf-8', 'replace')
+            if hasattr(data, 'close'):
+                data.close()
+        if source is None:
+            return
+        try:
+            run = programs.run(str(source), name)
+        except runner.ProgramError as e:
+            raise InvalidArgsException(str(e))
+        logger.info('Program %d started: %s', run.id, name)
+
+    def StartNotify(self):
+        self.notifying = True
+
+    def StopNotify(self):
+        self.notifying = False
+
+    def _on_event(self, run, output):
+        if output is None:
+            beacon.set('programs', sum(
+                    1 for r in self.service.runner.runs.values()
+                    if r.state == 'running'))
+        if not self.notifying:
+            return
+        if output is None:
+            event = {'id': run.id, 'state': run.state, 'error': run.error}
+        else:
+            event = {'id': run.id, 'output': output[:self.NOTIFY_OUTPUT]}
+        self.notify_value(encode_json(event))
+
 
+class EventsChrc(Characteristic):
     """
-    TEST_CHRC_UUID = '12345678-1234-5678-1234-56789abcdef3'
+    Writing {"topic", "key", "value"} publishes an event to the programs
+    subscribed to it, "key" and "value" being optional. Reading returns
+    the bus counters and the event to handler latency of the programs.
 
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-                self, bus, index,
-                self.TEST_CHRC_UUID,
-                ['encrypt-read', 'encrypt-write'],
-                service)
-        self.value = []
-        self.add_descriptor(TestEncryptDescriptor(bus, 2, self))
-        self.add_descriptor(
-                CharacteristicUserDescriptionDescriptor(bus, 3, self))
+    """
+    def __init__(self, bus, index, uuid, flags, service):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.stats = Value()
 
     def ReadValue(self, options):
-        print('TestEncryptCharacteristic Read: ' + repr(self.value))
-        return self.value
+        if int(options.get('offset', 0)) == 0:
+            stats = self.service.events.stats()
+            stats.update((name, value) for name, value in
+                         self.service.runner.stats().items()
+                         if name.startswith('event'))
+            self.stats.set(encode_json(stats))
+        return read_value(self.stats, options)
 
     def WriteValue(self, value, options):
-        print('TestEncryptCharacteristic Write: ' + repr(value))
-        self.value = value
+        request = parse_json_value(value)
+        topic = request.get('topic')
+        key = request.get('key')
+        value = request.get('value')
+        if not isinstance(topic, str) or \
+                not isinstance(value, (type(None), bool, int, float, str)) or \
+                not isinstance(key, (type(None), int, str)):
+            raise InvalidArgsException()
+        self.service.events.publish(topic, key, value)
+
 
-class TestEncryptDescriptor(Descriptor):
+def read_value(value, options):
+    try:
+        return value.read(options)
+    except ValueError:
+        raise InvalidOffsetException()
+
+
+def keep(options, key, value, size=0):
     """
-    Dummy test descriptor requiring encryption. Returns a static value.
+    Keeps 'value' under 'key' in the session of the calling client,
+    charging 'size' bytes against its budget (see sessions.py).
 
     """
-    TEST_DESC_UUID = '12345678-1234-5678-1234-56789abcdef4'
+    try:
+        sessions.store.get(options).set(key, value, size)
+    except sessions.BudgetError as e:
+        logger.info('%s', e)
+        raise InvalidValueLengthException()
+
+
+def session_key(device, path):
+    """Where the value 'device' wrote to characteristic 'path' is kept."""
+    return 'session:%s:%s' % (device, path)
+
+
+def restore_sessions():
+    """
+    Gives the values clients wrote to the test characteristics before a
+    restart back to their sessions, and has the values of a session
+    forgotten once it is dropped.
+
+    """
+    for key in state.store.keys('session:'):
+        device, path = key[len('session:'):].rsplit(':', 1)
+        value = state.store.get(key)
+        try:
+            sessions.store.restore(device).set(path, Value(value), len(value))
+        except sessions.BudgetError as e:
+            logger.info('Not restoring %s: %s', key, e)
+            state.store.delete(key)
+    sessions.store.on_drop = forget_session
+
+
+def forget_session(device):
+    for key in state.store.keys(session_key(device, '')):
+        state.store.delete(key)
+
 
-    def __init__(self, bus, index, characteristic):
-        Descriptor.__init__(
-                self, bus, index,
-                self.TEST_DESC_UUID,
-                ['encrypt-read', 'encrypt-write'],
-                characteristic)
+def read_budget(options):
+    """The most a value can hold to be read in one go at the link's MTU."""
+    budget = transfer.MAX_ATTR_LEN
+    mtu = int(options.get('mtu', 0))
+    if mtu:
+        budget = min(budget, mtu - 1)
+    return budget
 
+
+def parse_json_value(value):
+    try:
+        request = json.loads(bytes(value).decode('utf-8'))
+    except ValueError:
+        raise InvalidArgsException()
+    if not isinstance(request, dict):
+        raise InvalidArgsException()
+    return request
+
+
+def encode_json(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def decode_base64(data):
+    try:
+        return base64.b64decode(data or '', validate=True)
+    except ValueError:
+        raise InvalidArgsException()
+
+
+def decode_data(request):
+    """The file content of a create/write request, 'encoding' undone."""
+    data = decode_base64(request.get('data'))
+    try:
+        return compression.decompress(request.get('encoding'), data)
+    except ValueError as e:
+        raise InvalidArgsException(str(e))
+
+
+class WifiService(Service):
+    """
+    Wi-Fi provisioning, laid out the way the www client expects: scan,
+    status, set-network and disconnect characteristics. Commands run on
+    the worker thread of a wifi.WifiManager, so none of them holds up the
+    main loop; reads that need one are answered once it finishes.
+
+    """
+    def __init__(self, bus, index, uuid, primary):
+        Service.__init__(self, bus, index, uuid, primary)
+        self.wifi = wifi.WifiManager(wifi.open_backend(WIFI_BACKEND))
+
+
+class WifiScanChrc(Characteristic):
+    """
+    Networks seen by the last scan, strongest first, as JSON pages that
+    each fit in one read at the link's MTU: {"networks", "next", "age_ms",
+    "scanning"}, 'next' being the cursor of the following page or null.
+    A client writes {"cursor": n} to read from there and {"scan": true} to
+    rescan now. Reads are served from the scan cache; only the first
+    waits for a scan.
+
+    """
     def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+        session = sessions.store.get(options)
+        page = session.get((self.path, 'page'))
+        if page is None:
+            page = Value()
+            session.set((self.path, 'page'), page)
+        if int(options.get('offset', 0)) != 0:
+            return read_value(page, options)
+        reply = Deferred()
+        budget = read_budget(options)
+
+        def answer(networks, error):
+            if error is not None:
+                reply.reject(FailedException(str(error)))
+                return
+            page.set(self.encode_page(
+                    networks, session.get((self.path, 'cursor'), 0), budget))
+            reply.resolve(read_value(page, options))
+        self.service.wifi.scan(answer)
+        return reply
+
+    def WriteValue(self, value, options):
+        request = parse_json_value(value)
+        try:
+            cursor = int(request.get('cursor') or 0)
+        except (TypeError, ValueError):
+            raise InvalidArgsException()
+        keep(options, (self.path, 'cursor'), max(0, cursor))
+        if request.get('scan'):
+            self.service.wifi.scan(lambda networks, error: None, force=True)
+
+    def encode_page(self, networks, cursor, budget):
+        manager = self.service.wifi
+        reply = {'networks': [], 'next': len(networks),
+                 'age_ms': manager.scan_age_ms(),
+                 'scanning': manager.scanning()}
+        # Sized with the largest cursor the reply can carry.
+        size = len(encode_json(reply))
+        end = cursor
+        while end < len(networks):
+            size += len(encode_json(networks[end])) + 1
+            if size > budget and end > cursor:
+                break
+            end += 1
+        reply['networks'] = networks[cursor:end]
+        reply['next'] = end if end < len(networks) else None
+        return encode_json(reply)
+
+
+class WifiStatusChrc(Characteristic):
+    """
+    The connection as JSON: {"state", "ssid", "ip", "error"}, 'error'
+    being what the last connect or disconnect failed with. Changes are
+    notified, and the status is polled every POLL_INTERVAL_MS while a
+    client listens.
+
+    """
+    POLL_INTERVAL_MS = 5000
+
+    def __init__(self, bus, index, uuid, flags, service):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.notifying = False
+        self.poll_id = None
+        self.status = Value()
+        service.wifi.on_status = self._on_status
+
+    def ReadValue(self, options):
+        manager = self.service.wifi
+        if int(options.get('offset', 0)) != 0:
+            return read_value(self.status, options)
+        if manager.status is not None:
+            self.status.set(encode_json(manager.describe()))
+            return read_value(self.status, options)
+        reply = Deferred()
+
+        def answer(status):
+            self.status.set(encode_json(status))
+            reply.resolve(read_value(self.status, options))
+        manager.refresh_status(answer)
+        return reply
+
+    def StartNotify(self):
+        if self.notifying:
+            return
+        self.notifying = True
+        self.service.wifi.refresh_status()
+        self.poll_id = eventloop.timeout_add(self.POLL_INTERVAL_MS,
+                                             self._poll)
 
+    def StopNotify(self):
+        self.notifying = False
+        if self.poll_id is not None:
+            eventloop.source_remove(self.poll_id)
+            self.poll_id = None
 
-class TestSecureCharacteristic(Characteristic):
+    def _poll(self):
+        self.service.wifi.refresh_status()
+        return True
+
+    def _on_status(self, status):
+        beacon.set('wifi', status['state'] == wifi.STATE_CONNECTED)
+        if self.notifying:
+            self.notify_value(encode_json(status))
+
+
+class WifiSetNetworkChrc(Characteristic):
     """
-    Dummy test characteristic requiring secure connection.
+    Connects to a network: {"ssid", "psk"}, 'psk' left out for open
+    networks. The write is answered once the request is checked and
+    queued; how it went is notified on the status characteristic.
 
     """
-    TEST_CHRC_UUID = '12345678-1234-5678-1234-56789abcdef5'
+    def WriteValue(self, value, options):
+        value = self.reassemble(value, options)
+        if value is None:
+            return
+        request = parse_json_value(value)
+        try:
+            self.service.wifi.connect(request.get('ssid'), request.get('psk'))
+        except ValueError as e:
+            raise InvalidArgsException(str(e))
 
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-                self, bus, index,
-                self.TEST_CHRC_UUID,
-                ['secure-read', 'secure-write'],
-                service)
-        self.value = []
-        self.add_descriptor(TestSecureDescriptor(bus, 2, self))
-        self.add_descriptor(
-                CharacteristicUserDescriptionDescriptor(bus, 3, self))
+
+class WifiDisconnectChrc(Characteristic):
+    """Any write disconnects from the current network."""
+    PRIORITY = dispatch.CONTROL
+
+    def WriteValue(self, value, options):
+        self.service.wifi.disconnect()
+
+
+class StorageService(Service):
+    """
+    File service over hub/storage, laid out the way the www client expects:
+    list, create, delete, read and write characteristics taking JSON
+    requests. File data in create and write requests may be compressed,
+    named by an "encoding" of "zlib" or "lzma" next to "data".
+
+    """
+    def __init__(self, bus, index, uuid, primary):
+        # Imported here, as the 'index' argument shadows the module.
+        from index import Index
+
+        Service.__init__(self, bus, index, uuid, primary)
+        self.storage = storage.Storage()
+        self.index = Index(self.storage)
+        self.chunks = chunks.ChunkStore(self.storage, self.index)
+        self.cache = compression.Cache()
+        self.selected = ''
+        # compression.transfer_info() of the file selected for reading.
+        self.transfer = None
+        self.uploads = transfer.UploadReceiver(self.storage, self.chunks,
+                                               journal.Journal())
+        beacon.add_source('generation', lambda: self.index.generation)
+
+    def call(self, func, *args):
+        try:
+            return func(*args)
+        except (ValueError, OSError) as e:
+            raise self.error(e)
+
+    def error(self, e):
+        """The D-Bus error for a storage operation that raised 'e'."""
+        if isinstance(e, transfer.UploadError):
+            if e.code == transfer.ERR_OFFSET:
+                return InvalidOffsetException(str(e))
+            if e.code in (transfer.ERR_FRAME, transfer.ERR_CRC):
+                return InvalidArgsException(str(e))
+            return FailedException(str(e))
+        if isinstance(e, ValueError):
+            return NotPermittedException(str(e))
+        if isinstance(e, FileNotFoundError):
+            return FailedException('file not found')
+        if isinstance(e, FileExistsError):
+            return FailedException('file exists')
+        if isinstance(e, OSError):
+            return FailedException(e.strerror)
+        return FailedException(str(e))
+
+
+class StorageListChrc(Characteristic):
+    """
+    Lists the directory last selected through FS_READ as JSON. The listing
+    is taken on the read at offset 0 and kept for the blob reads that
+    follow, so a long read sees one consistent snapshot. When a file is
+    selected, "transfer" reports how it is being sent: its encoding, both
+    sizes, the ratio and the estimated time saved.
+
+    A client that writes a query gets pages instead, each sized to fit in
+    one read at the link's MTU, until it writes another query:
+
+    {"path", "cursor", "limit"} lists a directory from after 'cursor', the
+    reply carrying the "next" cursor, null on the last page.
+
+    {"since": N, "limit"} tells what changed after generation N, with
+    "generation" to ask from next and "more" while pages are left, or
+    "reset": true if N is too old to tell and the client must list again.
+
+    Every reply carries "generation", so a full listing can be followed
+    by change queries from there.
+
+    """
+    def __init__(self, bus, index, uuid, flags, service):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.listing = Value()
 
     def ReadValue(self, options):
-        print('TestSecureCharacteristic Read: ' + repr(self.value))
-        return self.value
+        # (query, page) of the client.
+        query = sessions.store.get(options).get(self.path)
+        if query is not None:
+            return self.read_page(query[0], query[1], options)
+
+        offset = int(options.get('offset', 0))
+        if offset == 0:
+            service = self.service
+            path = service.selected
+            if not os.path.isdir(service.call(service.storage.resolve, path)):
+                path = os.path.dirname(path)
+            files = service.call(service.index.list, path)
+            listing = {'path': path, 'files': files}
+            if service.transfer is not None:
+                listing['transfer'] = service.transfer
+            self.listing.set(encode_json(listing))
+        return read_value(self.listing, options)
+
+    def WriteValue(self, value, options):
+        request = parse_json_value(value)
+        try:
+            if 'since' in request:
+                request['since'] = int(request['since'])
+            if request.get('limit') is not None:
+                request['limit'] = int(request['limit'])
+        except (TypeError, ValueError):
+            raise InvalidArgsException()
+        keep(options, self.path, (request, Value()), len(value))
+
+    def read_page(self, request, page, options):
+        if int(options.get('offset', 0)) == 0:
+            budget = read_budget(options)
+            if 'since' in request:
+                reply = self.changes(request, budget)
+            else:
+                reply = self.files(request, budget)
+            page.set(reply)
+        return read_value(page, options)
+
+    def changes(self, request, budget):
+        index = self.service.index
+        # The largest "generation" the reply may end up with.
+        envelope = encode_json({'generation': 1 << 63, 'changes': [],
+                                'more': False})
+        result = self.service.call(index.changes, request['since'],
+                                   request.get('limit'),
+                                   budget - len(envelope))
+        if result is None:
+            return encode_json({'generation': index.generation,
+                                'reset': True})
+        changes, generation, more = result
+        return encode_json({'generation': generation, 'changes': changes,
+                            'more': more})
+
+    def files(self, request, budget):
+        index = self.service.index
+        path = request.get('path') or ''
+        reply = {'path': path, 'generation': 0, 'files': [], 'next': None}
+        files, cursor = self.service.call(
+                index.page, path, request.get('cursor'),
+                request.get('limit'), budget - len(encode_json(reply)))
+        reply.update(generation=index.generation, files=files, next=cursor)
+        encoded = encode_json(reply)
+        # The cursor is counted only once it is known; drop the last entry
+        # if it did not fit.
+        while len(encoded) > budget and len(files) > 1:
+            files.pop()
+            reply['next'] = files[-1]['name']
+            encoded = encode_json(reply)
+        return encoded
+
+
+class StorageCreateChrc(Characteristic):
+    PRIORITY = dispatch.BULK
+
+    def WriteValue(self, value, options):
+        value = self.reassemble(value, options)
+        if value is None:
+            return
+        request = parse_json_value(value)
+        data = decode_data(request)
+        storage_logger.info('Storage create: %r', request.get('path'))
+        self.service.call(self.service.storage.create,
+                          request.get('path'), data)
+
+
+class StorageDeleteChrc(Characteristic):
 
     def WriteValue(self, value, options):
-        print('TestSecureCharacteristic Write: ' + repr(value))
-        self.value = value
+        request = parse_json_value(value)
+        storage_logger.info('Storage delete: %r', request.get('path'))
+        self.service.call(self.service.storage.delete, request.get('path'))
 
 
-class TestSecureDescriptor(Descriptor):
+class StorageReadChrc(Characteristic):
     """
-    Dummy test descriptor requiring secure connection. Returns a static value.
+    Writing {"path": ...} selects a file, which ReadValue then returns
+    honouring the 'offset' and 'mtu' options BlueZ passes for long reads.
+
+    Writing {"path": ..., "mode": "stream"} starts a bulk download instead:
+    the memory-mapped file is pushed back-to-back as notifications framed
+    by transfer.DownloadStream, and the client opens the window again by
+    writing acks to this same characteristic. "offset", "window" and "mtu"
+    may be given in the request; the MTU otherwise comes from the write
+    options.
+
+    A request listing the codecs the client can decode, as in
+    "compress": ["lzma", "zlib"], may get the file compressed with one of
+    them, in both modes; offsets then count compressed bytes. FS_LIST
+    tells which encoding was picked. A file not compressed before is
+    compressed on the cache's worker thread, and the write is answered
+    once that is done.
+
+    An interrupted download resumes from the bytes the client has: it
+    asks for them as "offset", with their CRC-32 as "crc", and gets an
+    invalid offset error if the file no longer starts with them.
 
     """
-    TEST_DESC_UUID = '12345678-1234-5678-1234-56789abcdef6'
+    PRIORITY = dispatch.BULK
+    # Frames emitted per main loop iteration, so a download with flow
+    # control disabled does not starve everything else.
+    PUMP_BURST = 32
 
-    def __init__(self, bus, index, characteristic):
-        Descriptor.__init__(
-                self, bus, index,
-                self.TEST_DESC_UUID,
-                ['secure-read', 'secure-write'],
-                characteristic)
+    def __init__(self, bus, index, uuid, flags, service):
+        Characteristic.__init__(self, bus, index, uuid, flags, service)
+        self.notifying = False
+        self.stream = None
+        self.base = 0
+        self.streaming = False
+        self.pump_id = None
+
+    def _open(self, data, info, mtu, offset, window, crc, stream):
+        self.service.transfer = info
+        if crc is not None and (offset > len(data) or
+                                zlib.crc32(memoryview(data)[:offset]) != crc):
+            if hasattr(data, 'close'):
+                data.close()
+            raise InvalidOffsetException('file changed before offset')
+        self._close()
+        self.stream = transfer.DownloadStream(data, mtu, offset, window)
+        self.base = self.stream.offset
+        if stream:
+            self.streaming = True
+            self._schedule_pump()
+
+    def _close(self):
+        self._cancel_pump()
+        self.streaming = False
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def _schedule_pump(self):
+        if self.pump_id is None and self.notifying and self.streaming:
+            self.pump_id = eventloop.idle_add(self._pump)
+
+    def _cancel_pump(self):
+        if self.pump_id is not None:
+            eventloop.source_remove(self.pump_id)
+            self.pump_id = None
+
+    def _pump(self):
+        for _ in range(self.PUMP_BURST):
+            frame = self.stream.next_frame()
+            if frame is None:
+                break
+            self.notify_value(frame)
+        else:
+            return True
+
+        self.pump_id = None
+        if self.stream.done:
+            storage_logger.info('Storage stream finished: %d frames',
+                                self.stream.seq)
+            self.streaming = False
+        return False
 
     def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+        if self.stream is None:
+            raise FailedException('no file selected')
 
-def register_app_cb():
-    print('GATT application registered')
+        offset = int(options.get('offset', 0))
+        if offset > transfer.MAX_ATTR_LEN:
+            raise InvalidOffsetException()
 
+        length = transfer.MAX_ATTR_LEN - offset
+        mtu = int(options.get('mtu', 0))
+        if mtu:
+            length = min(length, mtu - 1)
+        return self.stream.read(self.base + offset, length)
 
-def register_app_error_cb(error):
-    print('Failed to register application: ' + str(error))
-    mainloop.quit()
+    def WriteValue(self, value, options):
+        seq = transfer.parse_ack(value)
+        if seq is not None:
+            if self.streaming:
+                self.stream.ack(seq)
+                self._schedule_pump()
+            return
 
+        request = parse_json_value(value)
+        path = request.get('path')
+        full = self.service.call(self.service.storage.resolve, path)
+        self.service.selected = path or ''
+        if os.path.isdir(full):
+            self.service.transfer = None
+            self._close()
+            return
 
-def register_ad_cb():
-    print('Advertisement registered')
+        try:
+            mtu = int(request.get('mtu',
+                                  options.get('mtu', transfer.DEFAULT_MTU)))
+            offset = int(request.get('offset', 0))
+            window = int(request.get('window', transfer.DEFAULT_WINDOW))
+            crc = request.get('crc')
+            if crc is not None:
+                crc = int(crc)
+        except (TypeError, ValueError):
+            raise InvalidArgsException()
+        accepted = request.get('compress') or []
+        if not isinstance(accepted, list):
+            raise InvalidArgsException()
 
+        storage_logger.debug('Storage read: %r', path)
+        stream = request.get('mode') == 'stream'
+        if not accepted:
+            data = self.service.call(self.service.storage.open_map, path)
+            self._open(data, None, mtu, offset, window, crc, stream)
+            return
+
+        reply = Deferred()
+
+        def opened(result, error):
+            try:
+                if error is not None:
+                    raise self.service.error(error)
+                self._open(result[0], result[1], mtu, offset, window, crc,
+                           stream)
+            except gatt.Error as e:
+                reply.reject(e)
+                return
+            reply.resolve()
+        self.service.cache.open_later(full, accepted, opened)
+        return reply
 
-def register_ad_error_cb(error):
-    print('Failed to register advertisement: ' + str(error))
-    mainloop.quit()
+    def StartNotify(self):
+        if self.notifying:
+            logger.debug('Already notifying, nothing to do')
+            return
 
+        self.notifying = True
+        self._schedule_pump()
 
-def find_adapter(bus):
-    remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, '/'),
-                               DBUS_OM_IFACE)
-    objects = remote_om.GetManagedObjects()
+    def StopNotify(self):
+        if not self.notifying:
+            logger.debug('Not notifying, nothing to do')
+            return
 
-    for o, props in objects.items():
-        if GATT_MANAGER_IFACE in props.keys():
-            return o
+        self.notifying = False
+        self._cancel_pump()
 
-    return None
 
-def main():
-    global mainloop
+class StorageChunksChrc(Characteristic):
+    """
+    Which chunks of a file the hub has, before a chunked upload (see
+    chunks.py). Writing SHA-256 chunk hashes back to back asks about them;
+    reading answers the writing client with one bit per hash, least
+    significant first, set for the chunks the upload may reference. The
+    write is answered once files changed since the last one have been
+    chunked, on the chunk store's worker thread.
 
-    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    """
+    PRIORITY = dispatch.BULK
 
-    bus = dbus.SystemBus()
+    def ReadValue(self, options):
+        reply = sessions.store.get(options).get(self.path)
+        if reply is None:
+            raise FailedException('no chunks asked about')
+        return read_value(reply, options)
 
-    adapter = find_adapter(bus)
-    if not adapter:
-        print('GattManager1 interface not found')
-        return
+    def WriteValue(self, value, options):
+        value = self.reassemble(value, options)
+        if value is None:
+            return
+        if not value or len(value) % chunks.HASH_SIZE:
+            raise InvalidValueLengthException()
+        reply = Deferred()
 
-    service_manager = dbus.Interface(
-            bus.get_object(BLUEZ_SERVICE_NAME, adapter),
-            GATT_MANAGER_IFACE)
+        def answer(bitmap):
+            try:
+                keep(options, self.path, Value(bitmap), len(bitmap))
+            except gatt.Error as e:
+                reply.reject(e)
+                return
+            reply.resolve()
+        self.service.chunks.have_later(value, answer)
+        return reply
 
-    ad_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
-                                LE_ADVERTISING_MANAGER_IFACE)
 
-    app = Application(bus)
-    test_advertisement = TestAdvertisement(bus, 0)
+class StorageWriteChrc(Characteristic):
+    """
+    Takes either a JSON request {"path", "data" (base64), "overwrite"} or
+    the binary upload frames described in transfer.py, whose payloads go
+    to the file as they arrive and which may be written without response.
+    Reading returns the status of the reading client's last frame; a
+    client that cannot read it is talking to an older hub and falls back
+    to JSON. After a disconnect, or a hub restart, a client opens its
+    upload again with OPEN_RESUME and continues at the status offset.
 
-    mainloop = GLib.MainLoop()
+    """
+    PRIORITY = dispatch.BULK
 
-    print('Registering GATT application...')
+    def ReadValue(self, options):
+        device = str(options.get('device', ''))
+        return values.marshal(self.service.uploads.get_status(device))
 
-    service_manager.RegisterApplication(app.get_path(), {},
-                                    reply_handler=register_app_cb,
-                                    error_handler=register_app_error_cb)
+    def WriteValue(self, value, options):
+        if transfer.is_upload_frame(value):
+            self.service.call(self.service.uploads.handle, value,
+                              str(options.get('device', '')))
+            return
 
-    print('Registering advertisement...')
+        value = self.reassemble(value, options)
+        if value is None:
+            return
+        request = parse_json_value(value)
+        data = decode_data(request)
+        storage_logger.info('Storage write: %r (%d bytes)',
+                            request.get('path'), len(data))
+        self.service.call(self.service.storage.write, request.get('path'),
+                          data, bool(request.get('overwrite', True)))
+
+
+# Attribute tree served by the hub, compiled once by Application. Services
+# and characteristics are handled by 'class' and get the entry's UUID and
+# flags; characteristics and descriptors without a 'class' serve their
+# 'value' as a constant. 'max_rate' caps notifications per second. The
+# 'authorize' flag makes BlueZ forward prepared writes, which is what lets
+# a characteristic reassemble long writes (see reassembly.py). Services
+# marked 'lazy' are left for when BlueZ registers the application under
+# --fast-startup.
+GATT_SCHEMA = [
+    {
+        'class': HeartRateService,
+        'uuid': '0000180d-0000-1000-8000-00805f9b34fb',
+        'characteristics': [
+            {
+                # Heart Rate Measurement
+                'class': HeartRateMeasurementChrc,
+                'uuid': '00002a37-0000-1000-8000-00805f9b34fb',
+                'flags': ['notify'],
+                'max_rate': 4,
+                'descriptors': [
+                    {
+                        'class': SamplingModeDescriptor,
+                        'uuid': '12345678-1234-5678-1234-56789abcde10',
+                        'flags': ['read', 'write'],
+                    },
+                ],
+            },
+            {
+                # Body Sensor Location: chest
+                'uuid': '00002a38-0000-1000-8000-00805f9b34fb',
+                'flags': ['read'],
+                'value': [0x01],
+            },
+            {
+                # Heart Rate Control Point
+                'class': HeartRateControlPointChrc,
+                'uuid': '00002a39-0000-1000-8000-00805f9b34fb',
+                'flags': ['write'],
+            },
+        ],
+    },
+    {
+        # Battery Service
+        'uuid': '180f',
+        'characteristics': [
+            {
+                'class': BatteryLevelCharacteristic,
+                'uuid': '2a19',
+                'flags': ['read', 'notify'],
+                'max_rate': 1,
+            },
+        ],
+    },
+    {
+        # Dummy test service exercising various API functionality. The
+        # ...def0 UUID belongs to the storage service, which the www client
+        # looks up by UUID.
+        'uuid': '12345678-1234-5678-1234-56789abcdee0',
+        'characteristics': [
+            {
+                'class': TestCharacteristic,
+                'uuid': '12345678-1234-5678-1234-56789abcdef1',
+                'flags': ['read', 'write', 'writable-auxiliaries',
+                          'authorize'],
+                'descriptors': [
+                    {
+                        'uuid': '12345678-1234-5678-1234-56789abcdef2',
+                        'flags': ['read', 'write'],
+                        'value': b'Test',
+                    },
+                    {
+                        'class': CharacteristicUserDescriptionDescriptor,
+                        'uuid': '2901',
+                        'flags': ['read', 'write'],
+                        'value': b'This is a characteristic for testing',
+                    },
+                ],
+            },
+            {
+                'class': TestCharacteristic,
+                'uuid': '12345678-1234-5678-1234-56789abcdef3',
+                'flags': ['encrypt-read', 'encrypt-write', 'authorize'],
+                'descriptors': [
+                    {
+                        'uuid': '12345678-1234-5678-1234-56789abcdef4',
+                        'flags': ['encrypt-read', 'encrypt-write'],
+                        'value': b'Test',
+                    },
+                    {
+                        'class': CharacteristicUserDescriptionDescriptor,
+                        'uuid': '2901',
+                        'flags': ['read', 'write'],
+                        'value': b'This is a characteristic for testing',
+                    },
+                ],
+            },
+            {
+                'class': TestCharacteristic,
+                'uuid': '12345678-1234-5678-1234-56789abcdef5',
+                'flags': ['secure-read', 'secure-write', 'authorize'],
+                'descriptors': [
+                    {
+                        'uuid': '12345678-1234-5678-1234-56789abcdef6',
+                        'flags': ['secure-read', 'secure-write'],
+                        'value': b'Test',
+                    },
+                    {
+                        'class': CharacteristicUserDescriptionDescriptor,
+                        'uuid': '2901',
+                        'flags': ['read', 'write'],
+                        'value': b'This is a characteristic for testing',
+                    },
+                ],
+            },
+        ],
+    },
+    {
+        # Hub service: state of the hub itself.
+        'class': HubService,
+        'lazy': True,
+        'uuid': '12345678-1234-5678-1234-56789abcde00',
+        'characteristics': [
+            {
+                'class': MetricsChrc,
+                'uuid': '12345678-1234-5678-1234-56789abcde01',
+                'flags': ['read'],
+            },
+            {
+                'class': AudioChrc,
+                'uuid': '12345678-1234-5678-1234-56789abcde02',
+                'flags': ['read', 'write'],
+            },
+            {
+                'class': ProgramChrc,
+                'uuid': '12345678-1234-5678-1234-56789abcde03',
+                'flags': ['read', 'write', 'notify', 'authorize'],
+            },
+            {
+                'class': EventsChrc,
+                'uuid': '12345678-1234-5678-1234-56789abcde04',
+                'flags': ['read', 'write', 'write-without-response'],
+            },
+            {
+                'class': StartupChrc,
+                'uuid': '12345678-1234-5678-1234-56789abcde05',
+                'flags': ['read'],
+            },
+        ],
+    },
+    {
+        # Wi-Fi provisioning, UUIDs as the www client expects them.
+        'class': WifiService,
+        'lazy': True,
+        'uuid': '87654321-4321-6789-4321-0fedcba98765',
+        'characteristics': [
+            {
+                'class': WifiScanChrc,
+                'uuid': '87654321-4321-6789-4321-0fedcba98766',
+                'flags': ['read', 'write'],
+            },
+            {
+                'class': WifiStatusChrc,
+                'uuid': '87654321-4321-6789-4321-0fedcba98767',
+                'flags': ['read', 'notify'],
+            },
+            {
+                'class': WifiSetNetworkChrc,
+                'uuid': '87654321-4321-6789-4321-0fedcba98768',
+                'flags': ['write', 'authorize'],
+            },
+            {
+                'class': WifiDisconnectChrc,
+                'uuid': '87654321-4321-6789-4321-0fedcba98769',
+                'flags': ['write'],
+            },
+        ],
+    },
+    {
+        'class': StorageService,
+        'lazy': True,
+        'uuid': '12345678-1234-5678-1234-56789abcdef0',
+        'characteristics': [
+            {
+                'class': StorageListChrc,
+                'uuid': '12345678-1234-5678-1234-56789abcdef1',
+                'flags': ['read', 'write'],
+            },
+            {
+                'class': StorageCreateChrc,
+                'uuid': '12345678-1234-5678-1234-56789abcdef2',
+                'flags': ['write', 'authorize'],
+            },
+            {
+                'class': StorageDeleteChrc,
+                'uuid': '12345678-1234-5678-1234-56789abcdef3',
+                'flags': ['write'],
+            },
+            {
+                'class': StorageReadChrc,
+                'uuid': '12345678-1234-5678-1234-56789abcdef4',
+                'flags': ['read', 'write', 'notify'],
+            },
+            {
+                'class': StorageWriteChrc,
+                'uuid': '12345678-1234-5678-1234-56789abcdef5',
+                'flags': ['read', 'write', 'write-without-response',
+                          'authorize'],
+            },
+            {
+                'class': StorageChunksChrc,
+                'uuid': '12345678-1234-5678-1234-56789abcdef6',
+                'flags': ['read', 'write', 'authorize'],
+            },
+        ],
+    },
+]
+
+
+def build_descriptor(bus, index, entry, chrc):
+    cls = entry.get('class')
+    if cls is None:
+        return StaticDescriptor(bus, index, entry['uuid'], entry['flags'],
+                                chrc, entry['value'])
+    if 'value' in entry:
+        return cls(bus, index, entry['uuid'], entry['flags'], chrc,
+                   entry['value'])
+    return cls(bus, index, entry['uuid'], entry['flags'], chrc)
+
+
+def build_characteristic(bus, index, entry, service):
+    cls = entry.get('class')
+    if cls is None:
+        chrc = StaticCharacteristic(bus, index, entry['uuid'],
+                                    entry['flags'], service, entry['value'])
+    else:
+        chrc = cls(bus, index, entry['uuid'], entry['flags'], service)
+    for i, desc in enumerate(entry.get('descriptors', [])):
+        chrc.add_descriptor(build_descriptor(bus, i, desc, chrc))
+    scheduler.set_max_rate(chrc, entry.get('max_rate'))
+    return chrc
+
+
+def build_service(bus, index, entry):
+    cls = entry.get('class', Service)
+    service = cls(bus, index, entry['uuid'], entry.get('primary', True))
+    for i, chrc in enumerate(entry.get('characteristics', [])):
+        service.add_characteristic(build_characteristic(bus, i, chrc, service))
+    return service
+
+
+def setup(bus):
+    metrics.start()
+    app = Application(bus, lazy=FAST_STARTUP)
+    restore_sessions()
+    advertisement = TestAdvertisement(bus, 0)
+    beacon.attach(advertisement)
+    return app, advertisement
 
-    ad_manager.RegisterAdvertisement(test_advertisement.get_path(), {},
-                                     reply_handler=register_ad_cb,
-                                     error_handler=register_ad_error_cb)
 
-    mainloop.run()
+def main():
+    global AUDIO_SINK, WIFI_BACKEND, FAST_STARTUP
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        default=DEFAULT_BACKEND,
+                        help='D-Bus binding and main loop: dbus-python on '
+                             'GLib, or dbus_next on asyncio')
+    parser.add_argument('--audio-sink', default=AUDIO_SINK,
+                        help='where sounds play: aplay[:DEVICE], '
+                             'file:PATH (WAV), null, or auto for aplay '
+                             'when installed')
+    parser.add_argument('--wifi-backend', default=WIFI_BACKEND,
+                        help='commands behind the Wi-Fi service: nmcli, '
+                             'or stub for development; auto is nmcli, '
+                             'unavailable when not installed')
+    parser.add_argument('--fast-startup', action='store_true',
+                        help='advertise first and build the hub, Wi-Fi '
+                             'and storage services only once BlueZ asks '
+                             'for them')
+    parser.add_argument('--state-window-ms', type=int,
+                        default=state.FLUSH_INTERVAL_MS,
+                        help='most milliseconds a change to the state '
+                             'kept across restarts waits before being '
+                             'written to disk, and can be lost in a crash')
+    parser.add_argument('--dispatch', choices=('fair', 'fifo'),
+                        default='fair',
+                        help='order of GATT calls: control first and '
+                             'clients in turn, or as they arrive')
+    parser.add_argument('--bulk-rate', type=int,
+                        default=dispatch.BULK_RATE,
+                        help='bytes per second each client may move '
+                             'through the storage service, 0 for no limit')
+    args = parser.parse_args()
+    # Checked here rather than with choices, which would import wifi.py
+    # at startup for nothing when left to auto.
+    if args.wifi_backend != 'auto' and args.wifi_backend not in wifi.BACKENDS:
+        parser.error('argument --wifi-backend: invalid choice: %r (choose '
+                     'from auto, %s)' % (args.wifi_backend,
+                                         ', '.join(sorted(wifi.BACKENDS))))
+    AUDIO_SINK = args.audio_sink
+    WIFI_BACKEND = args.wifi_backend
+    FAST_STARTUP = args.fast_startup
+    state.store.interval_ms = args.state_window_ms
+    dispatch.dispatcher.fair = args.dispatch == 'fair'
+    dispatch.dispatcher.bulk_rate = args.bulk_rate
+
+    log.setup()
+    try:
+        backend = importlib.import_module(BACKENDS[args.backend])
+        startup.mark('imports')
+        backend.run(setup, advertise_first=FAST_STARTUP)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        state.store.close()
+        log.shutdown()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,280 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import functools
+import inspect
+import os
+import re
+import struct
+import time
+
+import eventloop
+import log
+
+# Latency histograms have one bucket per power of two microseconds, the
+# last one open ended (>= ~8 s).
+BUCKETS = 24
+
+# Codes used for the methods in the binary snapshot.
+METHODS = {
+    'ReadValue': 0,
+    'WriteValue': 1,
+    'StartNotify': 2,
+    'StopNotify': 3,
+    'PropertiesChanged': 4,
+    'MainLoopLag': 5,
+}
+
+# Snapshot layout: header, then one entry per (attribute, method) sorted by
+# call count. Attributes are given by their service/char/desc indices in
+# the object tree, 0xff where a level does not apply.
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<BIH')
+SNAPSHOT_ENTRY = struct.Struct('<BBBBIHIIII')
+
+LAG_INTERVAL_MS = 1000
+EXPORT_INTERVAL_S = 15
+
+PATH_RE = re.compile(r'service(\d+)(?:/char(\d+))?(?:/desc(\d+))?$')
+
+started = time.monotonic()
+stats = {}
+# Gauge name: function returning {labels: value}.
+gauges = {}
+
+logger = log.get_logger('metrics')
+
+
+class Stat(object):
+    """
+    Counters of one method of one attribute. They are plain integers bumped
+    in place from the main loop, which is the only writer, so recording
+    takes no lock and allocates nothing.
+
+    """
+    __slots__ = ('path', 'method', 'calls', 'errors', 'bytes_in',
+                 'bytes_out', 'latency_sum', 'buckets')
+
+    def __init__(self, path, method):
+        self.path = path
+        self.method = method
+        self.calls = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def observe(self, seconds):
+        self.calls += 1
+        self.latency_sum += seconds
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket if bucket < BUCKETS else BUCKETS - 1] += 1
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding quantile 'q', in microseconds."""
+        if not self.calls:
+            return 0
+        rank = q * self.calls
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return 1 << bucket
+        return 1 << (BUCKETS - 1)
+
+
+def get_stat(path, method):
+    key = (path, method)
+    stat = stats.get(key)
+    if stat is None:
+        stat = stats[key] = Stat(path, method)
+    return stat
+
+
+def instrument(method, func):
+    """
+    Wraps a ReadValue/WriteValue/StartNotify/StopNotify implementation so
+    each call is counted and timed against the object's path. A coroutine
+    handler is timed until it completes rather than until it yields, and
+    one returning a gatt.Deferred until the reply is known.
+
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args):
+        stat = get_stat(self.path, method)
+        start = time.perf_counter()
+        try:
+            result = func(self, *args)
+        except Exception:
+            stat.errors += 1
+            stat.observe(time.perf_counter() - start)
+            raise
+        if inspect.isawaitable(result):
+            return complete(stat, method, args, start, result)
+        if hasattr(result, 'add_callback'):
+            result.add_callback(lambda value, error: settle(
+                    stat, method, args, start, value, error))
+            return result
+        record(stat, method, args, start, result)
+        return result
+    return wrapper
+
+
+def settle(stat, method, args, start, result, error):
+    if error is not None:
+        stat.errors += 1
+        stat.observe(time.perf_counter() - start)
+    else:
+        record(stat, method, args, start, result)
+
+
+def record(stat, method, args, start, result):
+    stat.observe(time.perf_counter() - start)
+    if method == 'WriteValue':
+        stat.bytes_in += len(args[0])
+    elif method == 'ReadValue' and result is not None:
+        stat.bytes_out += len(result)
+
+
+async def complete(stat, method, args, start, awaitable):
+    try:
+        result = await awaitable
+    except Exception:
+        stat.errors += 1
+        stat.observe(time.perf_counter() - start)
+        raise
+    record(stat, method, args, start, result)
+    return result
+
+
+def attribute_ids(path):
+    match = PATH_RE.search(path or '')
+    if match is None:
+        return (0xff, 0xff, 0xff)
+    return tuple(0xff if i is None else int(i) for i in match.groups())
+
+
+def snapshot(max_len):
+    """
+    Packs the busiest entries that fit in 'max_len' bytes into the binary
+    layout described by SNAPSHOT_HEADER and SNAPSHOT_ENTRY.
+
+    """
+    room = (max_len - SNAPSHOT_HEADER.size) // SNAPSHOT_ENTRY.size
+    entries = sorted(stats.values(), key=lambda s: s.calls, reverse=True)
+    entries = entries[:room]
+
+    out = bytearray(SNAPSHOT_HEADER.size + len(entries) * SNAPSHOT_ENTRY.size)
+    SNAPSHOT_HEADER.pack_into(out, 0, SNAPSHOT_VERSION,
+                              int(time.monotonic() - started), len(entries))
+    offset = SNAPSHOT_HEADER.size
+    for stat in entries:
+        SNAPSHOT_ENTRY.pack_into(
+                out, offset,
+                *(attribute_ids(stat.path) + (
+                        METHODS[stat.method],
+                        stat.calls & 0xffffffff,
+                        min(stat.errors, 0xffff),
+                        stat.bytes_in & 0xffffffff,
+                        stat.bytes_out & 0xffffffff,
+                        stat.percentile(0.5),
+                        stat.percentile(0.99))))
+        offset += SNAPSHOT_ENTRY.size
+    return bytes(out)
+
+
+def prometheus_text():
+    lines = []
+    counters = (('hub_gatt_calls_total', 'calls'),
+                ('hub_gatt_errors_total', 'errors'),
+                ('hub_gatt_bytes_in_total', 'bytes_in'),
+                ('hub_gatt_bytes_out_total', 'bytes_out'))
+    entries = sorted(stats.values(), key=lambda s: (s.path or '', s.method))
+    gatt = [s for s in entries if s.path is not None]
+    for name, field in counters:
+        lines.append('# TYPE %s counter' % name)
+        for stat in gatt:
+            lines.append('%s{path="%s",method="%s"} %d' %
+                         (name, stat.path, stat.method, getattr(stat, field)))
+
+    histograms = (('hub_gatt_latency_seconds', gatt),
+                  ('hub_mainloop_lag_seconds',
+                   [s for s in entries if s.path is None]))
+    for name, group in histograms:
+        lines.append('# TYPE %s histogram' % name)
+        for stat in group:
+            labels = '' if stat.path is None else \
+                    'path="%s",method="%s",' % (stat.path, stat.method)
+            seen = 0
+            for bucket, count in enumerate(stat.buckets[:-1]):
+                seen += count
+                lines.append('%s_bucket{%sle="%g"} %d' %
+                             (name, labels, (1 << bucket) / 1e6, seen))
+            lines.append('%s_bucket{%sle="+Inf"} %d' %
+                         (name, labels, stat.calls))
+            lines.append('%s_sum{%s} %f' %
+                         (name, labels.rstrip(','), stat.latency_sum))
+            lines.append('%s_count{%s} %d' %
+                         (name, labels.rstrip(','), stat.calls))
+    for name, func in sorted(gauges.items()):
+        lines.append('# TYPE %s gauge' % name)
+        for labels, value in sorted(func().items()):
+            lines.append('%s{%s} %g' % (name, labels, value))
+    return '\n'.join(lines) + '\n'
+
+
+def add_gauge(name, func):
+    """
+    Exports what func() returns, {labels: value} with labels as in the
+    text format (e.g. 'adapter="/org/bluez/hci0"'), as gauge 'name'.
+
+    """
+    gauges[name] = func
+
+
+def write_prometheus(path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+
+
+class LagProbe(object):
+    """
+    Measures how late the main loop runs a timer that should fire every
+    LAG_INTERVAL_MS, as the 'MainLoopLag' histogram.
+
+    """
+    def __init__(self, interval_ms=LAG_INTERVAL_MS):
+        self.interval = interval_ms / 1000.0
+        self.stat = get_stat(None, 'MainLoopLag')
+        self.expected = time.monotonic() + self.interval
+        eventloop.timeout_add(interval_ms, self._on_timer)
+
+    def _on_timer(self):
+        now = time.monotonic()
+        self.stat.observe(max(0.0, now - self.expected))
+        self.expected = now + self.interval
+        return True
+
+
+def start(export_path=None, export_interval=EXPORT_INTERVAL_S):
+    """
+    Starts the main loop lag probe and, if 'export_path' (or HUB_METRICS_FILE)
+    is set, rewrites that file in Prometheus text format periodically.
+
+    """
+    LagProbe()
+    if export_path is None:
+        export_path = os.environ.get('HUB_METRICS_FILE')
+    if not export_path:
+        return
+
+    def export():
+        try:
+            write_prometheus(export_path)
+        except OSError as e:
+            logger.warning('Cannot write metrics to %s: %s', export_path, e)
+        return True
+
+    eventloop.timeout_add_seconds(export_interval, export)
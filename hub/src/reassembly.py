@@ -0,0 +1,151 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Reassembly of prepared (long) writes.
+
+A central writes a value longer than one ATT payload as Prepare Write
+requests followed by an Execute Write. For characteristics with the
+'authorize' flag BlueZ forwards every prepared chunk to WriteValue with
+the 'prepare-authorize' option set and no effect expected, then, on
+execute, replays the queued chunks as WriteValue calls at increasing
+offsets. There is no D-Bus call for the execute itself.
+
+Uploads follows both phases for each client (the 'device' option). The
+prepare phase checks that chunks are contiguous and reserves their size
+against the client's budget; the execute phase copies the chunks into a
+bytearray preallocated for the prepared length, and the value is handed
+back only once it is complete, so a characteristic never sees part of a
+long write. Uploads idle for longer than the timeout are evicted.
+
+"""
+
+import eventloop
+import log
+
+# Bytes one client may hold in unfinished uploads, all attributes together.
+DEFAULT_BUDGET = 16 * 1024
+DEFAULT_TIMEOUT_MS = 30000
+SWEEP_INTERVAL_S = 5
+
+logger = log.get_logger('gatt')
+
+
+class OffsetError(ValueError):
+    pass
+
+
+class BudgetError(ValueError):
+    pass
+
+
+class Upload(object):
+    __slots__ = ('size', 'buffer', 'filled', 'deadline')
+
+    def __init__(self):
+        self.size = 0
+        self.buffer = None
+        self.filled = 0
+        self.deadline = 0
+
+
+class Uploads(object):
+
+    def __init__(self, budget=DEFAULT_BUDGET, timeout_ms=DEFAULT_TIMEOUT_MS):
+        self.budget = budget
+        self.timeout_ms = timeout_ms
+        self.uploads = {}
+        self.usage = {}
+        self.sweep_id = None
+
+    def write(self, path, value, options):
+        """
+        Feeds one WriteValue call on the attribute at 'path'. Returns the
+        value to apply, which is 'value' itself for a plain write, or None
+        while a long write is still being prepared or executed. Raises
+        OffsetError for a chunk that leaves a gap or overlaps, and
+        BudgetError when the client has too much outstanding.
+
+        """
+        device = str(options.get('device', ''))
+        offset = int(options.get('offset', 0))
+        key = (path, device)
+        upload = self.uploads.get(key)
+
+        if options.get('prepare-authorize'):
+            if offset == 0:
+                self._drop(key)
+                upload = None
+            elif upload is None or upload.buffer is not None or \
+                    offset != upload.size:
+                self._drop(key)
+                raise OffsetError('prepared chunk at %d' % offset)
+            if upload is None:
+                upload = self.uploads[key] = Upload()
+            self._reserve(key, device, len(value))
+            upload.size += len(value)
+            self._touch(upload)
+            return None
+
+        if upload is None:
+            if offset:
+                raise OffsetError('write at %d without prepare' % offset)
+            return value
+
+        if offset != upload.filled or \
+                offset + len(value) > upload.size:
+            self._drop(key)
+            raise OffsetError('executed chunk at %d' % offset)
+        if upload.buffer is None:
+            upload.buffer = bytearray(upload.size)
+        upload.buffer[offset:offset + len(value)] = value
+        upload.filled += len(value)
+        if upload.filled < upload.size:
+            self._touch(upload)
+            return None
+
+        self._drop(key)
+        return bytes(upload.buffer)
+
+    def pending(self, device):
+        """Bytes 'device' holds in unfinished uploads."""
+        return self.usage.get(device, 0)
+
+    def _reserve(self, key, device, size):
+        used = self.usage.get(device, 0) + size
+        if used > self.budget:
+            self._drop(key)
+            raise BudgetError('%s over its %d byte budget' %
+                              (device, self.budget))
+        self.usage[device] = used
+
+    def _touch(self, upload):
+        upload.deadline = eventloop.monotonic_ms() + self.timeout_ms
+        if self.sweep_id is None:
+            self.sweep_id = eventloop.timeout_add_seconds(SWEEP_INTERVAL_S,
+                                                          self._sweep)
+
+    def _drop(self, key):
+        upload = self.uploads.pop(key, None)
+        if upload is None:
+            return
+        device = key[1]
+        used = self.usage.get(device, 0) - upload.size
+        if used > 0:
+            self.usage[device] = used
+        else:
+            self.usage.pop(device, None)
+
+    def _sweep(self):
+        now = eventloop.monotonic_ms()
+        for key, upload in list(self.uploads.items()):
+            if upload.deadline <= now:
+                logger.info('Evicting unfinished long write to %s from %s '
+                            '(%d/%d bytes)', key[0], key[1] or 'unknown',
+                            upload.filled, upload.size)
+                self._drop(key)
+        if self.uploads:
+            return True
+        self.sweep_id = None
+        return False
+
+
+uploads = Uploads()
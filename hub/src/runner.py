@@ -0,0 +1,383 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Runs the Python programs the editor generates, in a pool of worker
+processes (worker.py) started ahead of time with their imports done, so
+pressing play costs neither an interpreter startup nor an import.
+
+Sources are compiled in the hub and the marshalled code objects kept by
+SHA-256 of the source, so running the same program again skips the
+compile too. Each run goes to an idle worker, or waits for one, and the
+worker goes back to the pool when the program ends. A stop interrupts
+the program; a worker that does not stop within STOP_GRACE_MS, or that
+dies, is replaced.
+
+With an events.EventBus, each worker also gets an events.Ring; the
+events a program subscribes to are pushed there while it runs.
+
+"""
+
+import collections
+import hashlib
+import marshal
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import eventloop
+import events
+import log
+import worker
+
+POOL_SIZE = 2
+CPU_LIMIT_S = 30
+MEMORY_LIMIT = 256 * 1024 * 1024
+STOP_GRACE_MS = 1000
+# Before replacing a worker that died without getting ready.
+RESPAWN_DELAY_S = 1
+CODE_CACHE_SIZE = 64
+# Finished runs kept for the status, and printed text kept per run.
+KEEP_RUNS = 8
+KEEP_OUTPUT = 4096
+# Play to first statement and event to handler latencies kept for the
+# percentiles in stats().
+LATENCY_SAMPLES = 256
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'worker.py')
+
+logger = log.get_logger('runner')
+
+
+class ProgramError(ValueError):
+    pass
+
+
+def percentiles(samples, prefix):
+    """p50, p99 and max of 'samples' (seconds) in milliseconds."""
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return dict((prefix + name, round(pick(q) * 1000, 2) if samples else 0.0)
+                for name, q in (('_p50_ms', 0.5), ('_p99_ms', 0.99),
+                                ('_max_ms', 1.0)))
+
+
+class Run(object):
+
+    def __init__(self, run_id, name, code):
+        self.id = run_id
+        self.name = name
+        self.code = code
+        self.state = 'queued'
+        self.error = None
+        self.output = ''
+        self.requested = time.monotonic()
+        self.latency = None
+
+    def describe(self):
+        return {
+                'id': self.id,
+                'name': self.name,
+                'state': self.state,
+                'error': self.error,
+                'latency_ms': None if self.latency is None else
+                round(self.latency * 1000, 2),
+                'output': self.output,
+        }
+
+
+class Worker(object):
+    """
+    A worker process and the hub's ends of its two pipes, and of its event
+    ring and doorbell when 'with_events'.
+
+    """
+    def __init__(self, memory_limit, with_events=False):
+        to_child, self.to_fd = os.pipe()
+        self.from_fd, from_child = os.pipe()
+        child_fds = [to_child, from_child]
+        self.ring = self.bell_fd = None
+        if with_events:
+            self.ring, ring_fd = events.Ring.create()
+            bell_child, self.bell_fd = os.pipe()
+            os.set_blocking(self.bell_fd, False)
+            child_fds += [ring_fd, bell_child]
+        self.process = subprocess.Popen(
+                [sys.executable, WORKER_PATH, str(to_child), str(from_child),
+                 str(memory_limit)] + [str(fd) for fd in child_fds[2:]],
+                stdin=subprocess.DEVNULL, pass_fds=child_fds)
+        for fd in child_fds:
+            os.close(fd)
+        os.set_blocking(self.from_fd, False)
+        # Event bus tokens of the running program's subscriptions.
+        self.subscriptions = []
+        self.buffer = bytearray()
+        self.ready = False
+        self.run = None
+        self.watch_id = None
+        self.kill_id = None
+
+    def send(self, message):
+        worker.send(self.to_fd, message)
+
+    def deliver(self, event):
+        if self.ring.push(events.encode(event)) and self.ring.waiting():
+            try:
+                os.write(self.bell_fd, b'\0')
+            except BlockingIOError:
+                # Rung already.
+                pass
+
+    def messages(self):
+        """Messages read so far; None once the worker is gone."""
+        try:
+            data = os.read(self.from_fd, 65536)
+        except BlockingIOError:
+            return []
+        if not data:
+            return None
+        self.buffer += data
+        messages = []
+        header = worker.FRAME_HEADER
+        while len(self.buffer) >= header.size:
+            size = header.unpack_from(self.buffer)[0]
+            if len(self.buffer) < header.size + size:
+                break
+            messages.append(marshal.loads(
+                    bytes(self.buffer[header.size:header.size + size])))
+            del self.buffer[:header.size + size]
+        return messages
+
+    def close(self):
+        if self.watch_id is not None:
+            eventloop.source_remove(self.watch_id)
+            self.watch_id = None
+        if self.kill_id is not None:
+            eventloop.source_remove(self.kill_id)
+            self.kill_id = None
+        os.close(self.to_fd)
+        os.close(self.from_fd)
+        if self.ring is not None:
+            self.ring.close()
+            os.close(self.bell_fd)
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+class ProgramRunner(object):
+    """
+    Pool of 'size' workers running programs, which may subscribe to the
+    events of 'bus'. 'on_event' is called with a Run whenever its state
+    changes or it prints something.
+
+    """
+    def __init__(self, size=POOL_SIZE, cpu_limit_s=CPU_LIMIT_S,
+                 memory_limit=MEMORY_LIMIT, on_event=None, bus=None):
+        self.size = size
+        self.bus = bus
+        self.cpu_limit_s = cpu_limit_s
+        self.memory_limit = memory_limit
+        self.on_event = on_event
+        self.workers = []
+        self.queue = collections.deque()
+        self.runs = collections.OrderedDict()
+        self.next_id = 1
+        # SHA-256 of a source: its marshalled code object.
+        self.code_cache = collections.OrderedDict()
+        self.compiles = 0
+        self.compile_hits = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.event_latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def start(self):
+        while len(self.workers) < self.size:
+            self._spawn()
+
+    def run(self, source, name='<program>'):
+        """Queues 'source' to run and returns its Run."""
+        run = Run(self.next_id, name, self.compile(source, name))
+        self.next_id += 1
+        self.runs[run.id] = run
+        while len(self.runs) > KEEP_RUNS and \
+                next(iter(self.runs.values())).state not in ('queued',
+                                                             'running'):
+            self.runs.popitem(last=False)
+        self.queue.append(run)
+        self._dispatch()
+        return run
+
+    def compile(self, source, name='<program>'):
+        key = hashlib.sha256(('%s\0%s' % (name, source)).encode('utf-8')) \
+                .digest()
+        code = self.code_cache.get(key)
+        if code is not None:
+            self.code_cache.move_to_end(key)
+            self.compile_hits += 1
+            return code
+        try:
+            code = marshal.dumps(compile(source, name, 'exec'))
+        except (SyntaxError, ValueError) as e:
+            raise ProgramError('%s: %s' % (type(e).__name__, e))
+        self.compiles += 1
+        self.code_cache[key] = code
+        if len(self.code_cache) > CODE_CACHE_SIZE:
+            self.code_cache.popitem(last=False)
+        return code
+
+    def stop(self, run_id=None):
+        """Stops run 'run_id', or every run when it is None."""
+        for run in list(self.queue):
+            if run_id is None or run.id == run_id:
+                self.queue.remove(run)
+                self._finish(run, 'stopped', None)
+        for w in self.workers:
+            if w.run is None or (run_id is not None and w.run.id != run_id):
+                continue
+            w.process.send_signal(signal.SIGINT)
+            if w.kill_id is None:
+                w.kill_id = eventloop.timeout_add(
+                        STOP_GRACE_MS, lambda w=w: self._on_stop_timeout(w))
+
+    def stats(self):
+        stats = {
+                'workers': len(self.workers),
+                'idle': sum(1 for w in self.workers
+                            if w.ready and w.run is None),
+                'queued': len(self.queue),
+                'compiles': self.compiles,
+                'compile_hits': self.compile_hits,
+                'events_dropped': sum(w.ring.dropped for w in self.workers
+                                      if w.ring is not None),
+        }
+        stats.update(percentiles(self.latencies, 'latency'))
+        stats.update(percentiles(self.event_latencies, 'event_latency'))
+        return stats
+
+    def close(self):
+        self.stop()
+        for w in self.workers:
+            w.close()
+        self.workers = []
+
+    def _spawn(self):
+        w = Worker(self.memory_limit, self.bus is not None)
+        w.watch_id = eventloop.io_add_watch(w.from_fd,
+                                            lambda: self._on_readable(w))
+        self.workers.append(w)
+        return w
+
+    def _dispatch(self):
+        for w in self.workers:
+            if not self.queue:
+                return
+            if not w.ready or w.run is not None:
+                continue
+            run = self.queue.popleft()
+            w.run = run
+            run.state = 'running'
+            try:
+                w.send(('run', run.id, run.code, self.cpu_limit_s))
+            except OSError as e:
+                logger.warning('Program worker %d failed: %s', w.process.pid,
+                               e)
+                self._replace(w)
+                continue
+            self._notify(run)
+
+    def _on_readable(self, w):
+        messages = w.messages()
+        if messages is None:
+            # Returning False removes the watch.
+            w.watch_id = None
+            self._replace(w)
+            return False
+        for message in messages:
+            kind = message[0]
+            if kind == 'ready':
+                w.ready = True
+            elif kind == 'started':
+                run = self.runs.get(message[1])
+                if run is not None:
+                    run.latency = message[2] - run.requested
+                    self.latencies.append(run.latency)
+            elif kind == 'out':
+                run = self.runs.get(message[1])
+                if run is not None:
+                    run.output = (run.output + message[2])[-KEEP_OUTPUT:]
+                    self._notify(run, message[2])
+            elif kind == 'subscribe':
+                if self.bus is not None and w.run is not None and \
+                        w.run.id == message[1]:
+                    w.subscriptions.append(self.bus.subscribe(
+                            message[2], message[3], w.deliver))
+            elif kind == 'latency':
+                self.event_latencies.extend(ns / 1e9 for ns in message[2])
+            elif kind == 'done':
+                self._unsubscribe(w)
+                run = w.run
+                w.run = None
+                if w.kill_id is not None:
+                    eventloop.source_remove(w.kill_id)
+                    w.kill_id = None
+                if run is not None:
+                    error = message[2]
+                    if error == 'stopped':
+                        self._finish(run, 'stopped', None)
+                    else:
+                        self._finish(run, 'failed' if error else 'done',
+                                     error)
+        self._dispatch()
+        return True
+
+    def _on_stop_timeout(self, w):
+        w.kill_id = None
+        if w in self.workers:
+            logger.info('Program worker %d did not stop, killing it',
+                        w.process.pid)
+            self._replace(w)
+        return False
+
+    def _replace(self, w):
+        """Drops worker 'w', failing its run, and starts another one."""
+        if w not in self.workers:
+            return
+        self.workers.remove(w)
+        self._unsubscribe(w)
+        run = w.run
+        w.run = None
+        w.close()
+        if run is not None:
+            if w.process.returncode == -signal.SIGKILL:
+                self._finish(run, 'stopped', None)
+            else:
+                self._finish(run, 'failed', 'worker exited with status %d' %
+                             w.process.returncode)
+        if w.ready:
+            self._spawn()
+        else:
+            logger.warning('Program worker %d exited with status %d',
+                           w.process.pid, w.process.returncode)
+            eventloop.timeout_add_seconds(RESPAWN_DELAY_S,
+                                          self._on_respawn)
+
+    def _unsubscribe(self, w):
+        for token in w.subscriptions:
+            self.bus.unsubscribe(token)
+        w.subscriptions = []
+
+    def _on_respawn(self):
+        self.start()
+        return False
+
+    def _finish(self, run, state, error):
+        run.state = state
+        run.error = error
+        logger.info('Program %d (%s) %s%s', run.id, run.name, state,
+                    ': ' + error if error else '')
+        self._notify(run)
+
+    def _notify(self, run, output=None):
+        if self.on_event is not None:
+            self.on_event(run, output)
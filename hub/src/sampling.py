@@ -0,0 +1,174 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Sensor samples on their way to notifications. A source appends
+fixed-width samples to a SampleRing, preallocated arrays of timestamps
+and values; a characteristic then either notifies each sample as it
+comes (per-sample mode, lowest latency) or lets a BatchPacker fill each
+notification up to the connection's MTU (batched mode, highest
+throughput).
+
+A batch is BATCH_HEADER, the sample count and the timestamp of the first
+sample in milliseconds of the hub clock (modulo 2**32), then each sample
+as the milliseconds since the previous one, an unsigned LEB128 varint (0
+for the first), followed by its fields in little endian.
+
+"""
+
+import struct
+import sys
+from array import array
+
+import eventloop
+import transfer
+
+RING_CAPACITY = 1024
+BATCH_HEADER = struct.Struct('<BI')
+MAX_BATCH = 255
+# A batch that is not full is sent at the latest this long after its
+# oldest sample was taken.
+MAX_DELAY_MS = 250
+
+MODE_SAMPLE = 0
+MODE_BATCH = 1
+
+
+def varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+class SampleRing(object):
+    """
+    The last 'capacity' samples of a source, each a timestamp and 'fields'
+    values of array typecode 'typecode'. When full, the oldest samples
+    are overwritten and counted in 'overruns'.
+
+    """
+    def __init__(self, typecode, fields=1, capacity=RING_CAPACITY):
+        self.fields = fields
+        self.capacity = capacity
+        self.times = array('I', bytes(4 * capacity))
+        self.values = array(typecode, [0]) * (fields * capacity)
+        self.sample_size = self.values.itemsize * fields
+        self.start = 0
+        self.count = 0
+        self.overruns = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, time_ms, *values):
+        end = (self.start + self.count) % self.capacity
+        self.times[end] = time_ms & 0xffffffff
+        self.values[end * self.fields:(end + 1) * self.fields] = \
+                array(self.values.typecode, values)
+        if self.count == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+            self.overruns += 1
+        else:
+            self.count += 1
+
+    def oldest_ms(self):
+        return self.times[self.start] if self.count else None
+
+    def pop(self):
+        """The oldest sample as (time_ms, values), removed from the ring."""
+        i = self.start
+        sample = (self.times[i],
+                  tuple(self.values[i * self.fields:(i + 1) * self.fields]))
+        self.start = (i + 1) % self.capacity
+        self.count -= 1
+        return sample
+
+    def pack(self, limit):
+        """
+        Removes samples from the ring into a batch of at most 'limit'
+        bytes, or returns None if not even one fits.
+
+        """
+        if not self.count:
+            return None
+        out = bytearray(BATCH_HEADER.size)
+        first = self.times[self.start]
+        previous = first
+        packed = 0
+        while packed < min(self.count, MAX_BATCH):
+            i = (self.start + packed) % self.capacity
+            delta = varint((self.times[i] - previous) & 0xffffffff)
+            if len(out) + len(delta) + self.sample_size > limit:
+                break
+            out += delta
+            fields = self.values[i * self.fields:(i + 1) * self.fields]
+            if sys.byteorder != 'little':
+                fields.byteswap()
+            out += fields.tobytes()
+            previous = self.times[i]
+            packed += 1
+        if not packed:
+            return None
+        BATCH_HEADER.pack_into(out, 0, packed, first)
+        self.start = (self.start + packed) % self.capacity
+        self.count -= packed
+        return bytes(out)
+
+
+class BatchPacker(object):
+    """
+    Turns the samples of 'ring' into notifications of 'chrc', each filled
+    up to 'mtu'. flush() sends what fills whole notifications, and the
+    rest once its oldest sample is MAX_DELAY_MS old.
+
+    """
+    def __init__(self, ring, chrc, mtu=transfer.DEFAULT_MTU,
+                 max_delay_ms=MAX_DELAY_MS):
+        self.ring = ring
+        self.chrc = chrc
+        self.max_delay_ms = max_delay_ms
+        self.timeout_id = None
+        self.notifications = 0
+        self.samples = 0
+        self.set_mtu(mtu)
+
+    def set_mtu(self, mtu):
+        self.limit = min(max(int(mtu), transfer.DEFAULT_MTU) -
+                         transfer.ATT_NOTIFY_OVERHEAD, transfer.MAX_ATTR_LEN)
+        # Samples in a full notification, assuming one byte deltas.
+        self.per_batch = min(MAX_BATCH, (self.limit - BATCH_HEADER.size) //
+                             (1 + self.ring.sample_size))
+
+    def flush(self, now_ms, force=False):
+        while len(self.ring) >= self.per_batch or (self.ring and (
+                force or self._age(now_ms) >= self.max_delay_ms)):
+            before = len(self.ring)
+            batch = self.ring.pack(self.limit)
+            if batch is None:
+                break
+            self.notifications += 1
+            self.samples += before - len(self.ring)
+            self.chrc.notify_value(batch)
+        self._arm(now_ms)
+
+    def stop(self):
+        if self.timeout_id is not None:
+            eventloop.source_remove(self.timeout_id)
+            self.timeout_id = None
+
+    def _arm(self, now_ms):
+        if not self.ring:
+            self.stop()
+            return
+        if self.timeout_id is None:
+            delay = max(0, self.max_delay_ms - self._age(now_ms))
+            self.timeout_id = eventloop.timeout_add(delay, self._on_timeout)
+
+    def _age(self, now_ms):
+        return (now_ms - self.ring.oldest_ms()) & 0xffffffff
+
+    def _on_timeout(self):
+        self.timeout_id = None
+        self.flush(eventloop.monotonic_ms())
+        return False
@@ -0,0 +1,154 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import eventloop
+
+# Resolution of the wheel; periods are rounded up to whole ticks.
+DEFAULT_TICK_MS = 50
+DEFAULT_SLOTS = 256
+
+
+class NotificationScheduler(object):
+    """
+    Owns every periodic notification source of the hub behind one main loop
+    timer. Sources sit in a timer wheel keyed by the tick they are due on,
+    and there is at most one per characteristic, so restarting a source
+    replaces it instead of stacking timers.
+
+    When a tick fires, every due source is polled first and the values
+    that changed are then emitted together, one batch per main loop wakeup.
+    The timer is re-armed against absolute tick deadlines so periods do not
+    drift, and it is not armed at all while nothing is scheduled.
+
+    Characteristics are notified through their notify_value() method.
+
+    """
+    def __init__(self, tick_ms=DEFAULT_TICK_MS, slots=DEFAULT_SLOTS):
+        self.tick_ms = tick_ms
+        self.wheel = [dict() for _ in range(slots)]
+        self.entries = {}
+        self.pending = {}
+        self.last_value = {}
+        self.last_emit = {}
+        self.min_interval = {}
+        self.start = eventloop.monotonic_ms()
+        self.tick = 0
+        self.timer_id = None
+        self.timer_due = None
+
+    def now_tick(self):
+        return (eventloop.monotonic_ms() - self.start) // self.tick_ms
+
+    def set_max_rate(self, chrc, hz):
+        """Caps how often 'chrc' is notified; 0 or None lifts the cap."""
+        if hz:
+            self.min_interval[chrc] = 1000.0 / hz
+        else:
+            self.min_interval.pop(chrc, None)
+
+    def add(self, chrc, interval_ms, callback):
+        """
+        Polls 'callback' every 'interval_ms' and notifies 'chrc' with what
+        it returns, unless that is None. Replaces any earlier source of the
+        same characteristic.
+
+        """
+        self.remove(chrc)
+        interval = max(1, -(-interval_ms // self.tick_ms))
+        entry = [self.now_tick() + interval, interval, callback]
+        self.entries[chrc] = entry
+        self._insert(chrc, entry)
+        self._arm()
+
+    def remove(self, chrc):
+        entry = self.entries.pop(chrc, None)
+        if entry is not None:
+            self.wheel[entry[0] % len(self.wheel)].pop(chrc, None)
+        self.pending.pop(chrc, None)
+
+    def forget(self, chrc):
+        """Drops the remembered value, so the next one is always sent."""
+        self.last_value.pop(chrc, None)
+
+    def notify(self, chrc, value):
+        """
+        Queues a one-off notification for the next tick. Only the newest
+        value queued for a characteristic within a tick is sent.
+
+        """
+        self.pending[chrc] = value
+        self._arm()
+
+    def _insert(self, chrc, entry):
+        self.wheel[entry[0] % len(self.wheel)][chrc] = entry
+
+    def _pending_due(self, chrc):
+        min_interval = self.min_interval.get(chrc)
+        last = self.last_emit.get(chrc)
+        if not min_interval or last is None:
+            return self.tick + 1
+        return int(-(-(last + min_interval) // self.tick_ms))
+
+    def _arm(self):
+        dues = [entry[0] for entry in self.entries.values()]
+        dues.extend(self._pending_due(chrc) for chrc in self.pending)
+        if not dues:
+            return
+        due = max(min(dues), self.tick + 1)
+
+        if self.timer_id is not None:
+            if self.timer_due <= due:
+                return
+            eventloop.source_remove(self.timer_id)
+
+        now = eventloop.monotonic_ms()
+        delay = max(0, self.start + due * self.tick_ms - now)
+        self.timer_due = due
+        self.timer_id = eventloop.timeout_add(delay, self._on_timer)
+
+    def _on_timer(self):
+        self.timer_id = None
+        self.timer_due = None
+
+        current = self.now_tick()
+        # After a long sleep one turn of the wheel visits every slot.
+        first = max(self.tick + 1, current - len(self.wheel) + 1)
+        for tick in range(first, current + 1):
+            slot = self.wheel[tick % len(self.wheel)]
+            for chrc, entry in list(slot.items()):
+                if entry[0] > current:
+                    continue
+                del slot[chrc]
+                value = entry[2]()
+                if value is not None:
+                    self.pending[chrc] = value
+                # Keep the original phase; skip periods missed while the
+                # main loop was busy rather than firing them all at once.
+                while entry[0] <= current:
+                    entry[0] += entry[1]
+                if self.entries.get(chrc) is entry:
+                    self._insert(chrc, entry)
+        self.tick = max(self.tick, current)
+
+        self._flush(current)
+        self._arm()
+        return False
+
+    def _flush(self, current):
+        now_ms = current * self.tick_ms
+        batch = []
+        for chrc, value in list(self.pending.items()):
+            min_interval = self.min_interval.get(chrc)
+            last = self.last_emit.get(chrc)
+            if min_interval and last is not None and \
+                    now_ms - last < min_interval:
+                continue
+            del self.pending[chrc]
+            value = bytes(value)
+            if self.last_value.get(chrc) == value:
+                continue
+            self.last_value[chrc] = value
+            self.last_emit[chrc] = now_ms
+            batch.append((chrc, value))
+
+        for chrc, value in batch:
+            chrc.notify_value(value)
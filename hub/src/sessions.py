@@ -0,0 +1,219 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Per-connection state. ReadValue and WriteValue name the central they come
+from in the 'device' option; store.get(options) returns that central's
+Session, where characteristics keep what would otherwise be shared by
+every client, under keys of their own (their path, usually).
+
+A session holds at most 'budget' bytes, as charged by set(); going over
+raises BudgetError and leaves the session as it was. When its device
+disconnects (adapters.AdapterPool follows Device1 "Connected") a session
+goes idle but is kept, so a central coming back finds its state. Idle
+sessions are evicted least recently used first, beyond MAX_IDLE of them
+or once idle for IDLE_TIMEOUT_MS (checked every SWEEP_S while any are
+idle), which keeps memory flat however many devices come and go. Calls
+without a 'device', from local tools, share the ANONYMOUS session, which
+never goes idle. restore() brings back the sessions of devices from
+before a restart, idle, and on_drop hears of every session dropped, so
+what was kept of it elsewhere can go too.
+
+"""
+
+import collections
+
+import eventloop
+import log
+import metrics
+
+DEFAULT_BUDGET = 4 * 1024
+MAX_IDLE = 32
+IDLE_TIMEOUT_MS = 30 * 60 * 1000
+SWEEP_S = 60
+# All sessions, connected ones included, should disconnects go unseen.
+MAX_SESSIONS = 256
+ANONYMOUS = ''
+
+logger = log.get_logger('sessions')
+
+
+class BudgetError(ValueError):
+    pass
+
+
+class Session(object):
+    __slots__ = ('device', 'budget', 'values', 'size', 'connected',
+                 'used_ms')
+
+    def __init__(self, device, budget):
+        self.device = device
+        self.budget = budget
+        # Key: (value, bytes charged).
+        self.values = {}
+        self.size = 0
+        self.connected = True
+        self.used_ms = 0
+
+    def get(self, key, default=None):
+        entry = self.values.get(key)
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, size=0):
+        """
+        Stores 'value' under 'key', charging 'size' bytes against the
+        budget in place of what the key held before.
+
+        """
+        entry = self.values.get(key)
+        used = self.size + size - (0 if entry is None else entry[1])
+        if used > self.budget:
+            raise BudgetError('%s over its %d byte budget' %
+                              (self.device or 'anonymous', self.budget))
+        self.values[key] = (value, size)
+        self.size = used
+
+    def pop(self, key):
+        entry = self.values.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry[1]
+        return entry[0]
+
+
+class SessionStore(object):
+
+    def __init__(self, budget=DEFAULT_BUDGET, max_idle=MAX_IDLE,
+                 idle_timeout_ms=IDLE_TIMEOUT_MS, max_sessions=MAX_SESSIONS):
+        self.budget = budget
+        self.max_idle = max_idle
+        self.idle_timeout_ms = idle_timeout_ms
+        self.max_sessions = max_sessions
+        # Device: Session, least recently used first.
+        self.sessions = collections.OrderedDict()
+        self.idle = 0
+        self.created = 0
+        self.evicted = 0
+        # Called with the device of each session dropped.
+        self.on_drop = None
+        self.sweep_id = None
+
+    def get(self, options):
+        """The session of the central behind a call's 'options'."""
+        device = str(options.get('device', ANONYMOUS))
+        session = self.sessions.get(device)
+        if session is None:
+            self._make_room()
+            session = self.sessions[device] = Session(device, self.budget)
+            self.created += 1
+        else:
+            self.sessions.move_to_end(device)
+            if not session.connected:
+                # Calling, so connected whatever we were told.
+                session.connected = True
+                self.idle -= 1
+        session.used_ms = eventloop.monotonic_ms()
+        return session
+
+    def restore(self, device):
+        """
+        The session of 'device', created idle if there is none: for state
+        kept across a restart, before its central connects again.
+
+        """
+        session = self.sessions.get(device)
+        if session is None:
+            self._make_room()
+            session = self.sessions[device] = Session(device, self.budget)
+            self.created += 1
+            session.used_ms = eventloop.monotonic_ms()
+            if device != ANONYMOUS:
+                session.connected = False
+                self.idle += 1
+                self._evict()
+                self._schedule_sweep()
+        return session
+
+    def connected(self, device):
+        session = self.sessions.get(device)
+        if session is not None and not session.connected:
+            session.connected = True
+            self.idle -= 1
+
+    def disconnected(self, device):
+        session = self.sessions.get(device)
+        if session is not None and session.connected and \
+                device != ANONYMOUS:
+            session.connected = False
+            session.used_ms = eventloop.monotonic_ms()
+            self.sessions.move_to_end(device)
+            self.idle += 1
+        self._evict()
+        self._schedule_sweep()
+
+    def stats(self):
+        return {'sessions': len(self.sessions),
+                'idle': self.idle,
+                'bytes': sum(session.size
+                             for session in self.sessions.values()),
+                'created': self.created,
+                'evicted': self.evicted}
+
+    def _evict(self):
+        now = eventloop.monotonic_ms()
+        for device, session in list(self.sessions.items()):
+            if session.connected:
+                continue
+            # Idle sessions after this one are more recent still.
+            if self.idle <= self.max_idle and \
+                    now - session.used_ms < self.idle_timeout_ms:
+                break
+            self._drop(device)
+
+    def _schedule_sweep(self):
+        if self.idle and self.sweep_id is None:
+            self.sweep_id = eventloop.timeout_add_seconds(SWEEP_S,
+                                                          self._sweep)
+
+    def _sweep(self):
+        self._evict()
+        if self.idle:
+            return True
+        self.sweep_id = None
+        return False
+
+    def _make_room(self):
+        while len(self.sessions) >= self.max_sessions:
+            device = next((device for device, session in self.sessions.items()
+                           if not session.connected), None)
+            if device is None:
+                device = next((device for device in self.sessions
+                               if device != ANONYMOUS), None)
+                if device is None:
+                    # Only the anonymous session, which stays.
+                    return
+                logger.warning('%d sessions, evicting the one of %s, '
+                               'still connected', len(self.sessions), device)
+            self._drop(device)
+
+    def _drop(self, device):
+        session = self.sessions.pop(device)
+        if not session.connected:
+            self.idle -= 1
+        self.evicted += 1
+        logger.debug('Evicted session of %s (%d bytes)', device, session.size)
+        if self.on_drop is not None:
+            self.on_drop(device)
+
+
+def by_state(value):
+    totals = {'state="connected"': 0, 'state="idle"': 0}
+    for session in store.sessions.values():
+        totals['state="%s"' % ('connected' if session.connected
+                               else 'idle')] += value(session)
+    return totals
+
+
+store = SessionStore()
+
+metrics.add_gauge('hub_sessions', lambda: by_state(lambda session: 1))
+metrics.add_gauge('hub_session_bytes',
+                  lambda: by_state(lambda session: session.size))
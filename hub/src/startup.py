@@ -0,0 +1,115 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+What the hub spends its startup on. Each phase is marked when it ends,
+with the time since the process started, so the interpreter's own
+startup and the imports before anything ran count too:
+
+    imports                   main.py and what it imports
+    bus_connect               connection to the system bus
+    setup                     services built, advertisement filled in
+    export                    objects exported on the bus
+    adapter_lookup            bluetoothd's objects fetched
+    advertisement_registered  first RegisterAdvertisement reply
+    services_built            lazy services built, see gatt.Application
+    application_registered    first RegisterApplication reply
+
+The process start comes from /proc, in clock ticks (usually 10 ms). The
+breakdown is exported as gauge hub_startup_seconds and read through the
+STARTUP characteristic.
+
+"""
+
+import importlib.util
+import os
+import sys
+import time
+
+import log
+import metrics
+
+logger = log.get_logger('startup')
+
+if hasattr(time, 'CLOCK_BOOTTIME'):
+    def clock():
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+else:
+    clock = time.monotonic
+
+
+def process_start():
+    """When this process started on the clock() timeline, or now."""
+    if not hasattr(time, 'CLOCK_BOOTTIME'):
+        return clock()
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        # Fields resume after the command name, which may hold spaces;
+        # starttime is field 22.
+        ticks = int(stat.rsplit(')', 1)[1].split()[19])
+        return ticks / float(os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return clock()
+
+
+STARTED = process_start()
+# (phase, seconds since STARTED), in the order reached.
+phases = []
+
+
+def mark(name):
+    """
+    Records that phase 'name' ended now and returns True; later marks of
+    it are ignored and return False.
+
+    """
+    if any(phase == name for phase, _ in phases):
+        return False
+    phases.append((name, clock() - STARTED))
+    logger.debug('%s after %.1f ms', name, phases[-1][1] * 1000)
+    return True
+
+
+def breakdown():
+    """
+    The phases reached so far: when each ended and how long it took after
+    the one before, in milliseconds.
+
+    """
+    result = []
+    last = 0.0
+    for name, at in phases:
+        result.append({'phase': name, 'at_ms': round(at * 1000, 1),
+                       'ms': round((at - last) * 1000, 1)})
+        last = at
+    return result
+
+
+def summary():
+    return ', '.join('%s %.0f ms' % (phase['phase'], phase['ms'])
+                     for phase in breakdown())
+
+
+def lazy_import(name):
+    """
+    Module 'name', executed on its first attribute access rather than
+    now, so code only some services use costs nothing until they are
+    built. Already imported modules are returned as they are.
+
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named %r' % name, name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+metrics.add_gauge('hub_startup_seconds',
+                  lambda: dict(('phase="%s"' % name, at)
+                               for name, at in phases))
@@ -0,0 +1,292 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+State that outlives the hub process (battery level, energy expended,
+descriptor text, values clients wrote), as byte strings under string
+keys.
+
+set() only updates memory and marks the key dirty. Dirty values go to
+disk as one batch once the durability window (interval_ms, see
+--state-window-ms) has passed or max_dirty_bytes are waiting, so a value
+set many times in a window is written once, and a crash loses at most
+the last window. Batches are appended to the log and synced by a worker
+thread; the main loop never waits for the disk.
+
+The log is a sequence of records: the CRC-32 of the rest of the record,
+RECORD (key length, value length or TOMBSTONE for a deleted key), the key
+in UTF-8 and the value. Loading stops at the first record cut short or
+failing its CRC, the tail of an append the hub died in, and the log is
+cut back to there. Once the log is COMPACT_RATIO times the size of its
+live records (and at least COMPACT_MIN_BYTES), the worker writes the live
+records alone to a new file and renames it over the log.
+
+stats() counts the bytes of the changes set() was asked for against the
+bytes appended and rewritten by compaction; their ratio is the write
+amplification.
+
+"""
+
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+import eventloop
+import log
+import metrics
+from storage import CACHE_ROOT, PartialFile
+
+STATE_PATH = os.path.join(CACHE_ROOT, 'state.log')
+CRC = struct.Struct('<I')
+RECORD = struct.Struct('<HI')
+TOMBSTONE = 0xffffffff
+FLUSH_INTERVAL_MS = 1000
+MAX_DIRTY_BYTES = 64 * 1024
+COMPACT_RATIO = 2
+COMPACT_MIN_BYTES = 64 * 1024
+
+logger = log.get_logger('state')
+
+
+def encode_record(key, value):
+    key = key.encode('utf-8')
+    if value is None:
+        body = RECORD.pack(len(key), TOMBSTONE) + key
+    else:
+        body = RECORD.pack(len(key), len(value)) + key + value
+    return CRC.pack(zlib.crc32(body)) + body
+
+
+def record_size(key, value):
+    return CRC.size + RECORD.size + len(key.encode('utf-8')) + len(value)
+
+
+def parse(data):
+    """The values in log 'data', and the length of its valid part."""
+    values = {}
+    offset = 0
+    start = CRC.size + RECORD.size
+    while offset + start <= len(data):
+        crc, = CRC.unpack_from(data, offset)
+        key_len, value_len = RECORD.unpack_from(data, offset + CRC.size)
+        value_at = offset + start + key_len
+        end = value_at + (0 if value_len == TOMBSTONE else value_len)
+        if end > len(data) or \
+                zlib.crc32(data[offset + CRC.size:end]) != crc:
+            break
+        try:
+            key = data[offset + start:value_at].decode('utf-8')
+        except UnicodeDecodeError:
+            break
+        if value_len == TOMBSTONE:
+            values.pop(key, None)
+        else:
+            values[key] = bytes(data[value_at:end])
+        offset = end
+    return values, offset
+
+
+class StateStore(object):
+
+    def __init__(self, path=None, interval_ms=FLUSH_INTERVAL_MS,
+                 max_dirty_bytes=MAX_DIRTY_BYTES):
+        if path is None:
+            path = os.environ.get('HUB_STATE_FILE') or STATE_PATH
+        self.path = path
+        self.interval_ms = interval_ms
+        self.max_dirty_bytes = max_dirty_bytes
+        self.values = None
+        # Key: value, or None if deleted, since the last flush.
+        self.dirty = {}
+        self.dirty_bytes = 0
+        self.flush_id = None
+        self.jobs = queue.Queue()
+        self.thread = None
+        # Owned by the worker once started: the log file, its length and
+        # the values in it with the size of their records.
+        self.fd = None
+        self.log_bytes = 0
+        self.disk = {}
+        self.live_bytes = 0
+        self.load_ms = 0.0
+        self.bytes_set = 0
+        self.bytes_appended = 0
+        self.bytes_compacted = 0
+        self.flushes = 0
+        self.compactions = 0
+        self.errors = 0
+
+    def get(self, key, default=None):
+        self.load()
+        return self.values.get(key, default)
+
+    def keys(self, prefix=''):
+        self.load()
+        return [key for key in self.values if key.startswith(prefix)]
+
+    def set(self, key, value):
+        self.load()
+        value = bytes(value)
+        if self.values.get(key) == value:
+            return
+        self.values[key] = value
+        self.bytes_set += len(key) + len(value)
+        self._mark(key, value)
+
+    def delete(self, key):
+        self.load()
+        if self.values.pop(key, None) is not None:
+            self._mark(key, None)
+
+    def flush(self):
+        """Hands what is dirty to the worker now."""
+        if self.flush_id is not None:
+            eventloop.source_remove(self.flush_id)
+            self.flush_id = None
+        if self.dirty:
+            self.jobs.put(self.dirty)
+            self.dirty = {}
+            self.dirty_bytes = 0
+
+    def close(self):
+        """Writes out what is dirty and waits for the worker to finish."""
+        if self.thread is None:
+            return
+        self.flush()
+        self.jobs.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def load(self):
+        """Reads the log and starts the worker, the first time only."""
+        if self.values is not None:
+            return
+        start = time.perf_counter()
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        except OSError as e:
+            logger.warning('Reading %s failed: %s', self.path, e)
+            data = b''
+        self.values, self.log_bytes = parse(data)
+        if self.log_bytes < len(data):
+            logger.warning('Dropping %d bytes at the end of %s',
+                           len(data) - self.log_bytes, self.path)
+        self.disk = dict(self.values)
+        self.live_bytes = sum(record_size(key, value)
+                              for key, value in self.values.items())
+        self.load_ms = (time.perf_counter() - start) * 1000
+        logger.info('Loaded %d values from %s in %.1f ms', len(self.values),
+                    self.path, self.load_ms)
+        self.thread = threading.Thread(target=self._work, name='state',
+                                       daemon=True)
+        self.thread.start()
+
+    def stats(self):
+        written = self.bytes_appended + self.bytes_compacted
+        return {'keys': len(self.values or ()),
+                'bytes_set': self.bytes_set,
+                'bytes_appended': self.bytes_appended,
+                'bytes_compacted': self.bytes_compacted,
+                'write_amplification': (float(written) / self.bytes_set
+                                        if self.bytes_set else 0.0),
+                'flushes': self.flushes,
+                'compactions': self.compactions,
+                'log_bytes': self.log_bytes,
+                'load_ms': self.load_ms,
+                'errors': self.errors}
+
+    def _mark(self, key, value):
+        size = len(key) + len(value or b'')
+        previous = self.dirty.get(key)
+        if key in self.dirty:
+            size -= len(key) + len(previous or b'')
+        self.dirty[key] = value
+        self.dirty_bytes += size
+        if self.dirty_bytes >= self.max_dirty_bytes:
+            self.flush()
+        elif self.flush_id is None:
+            self.flush_id = eventloop.timeout_add(self.interval_ms,
+                                                  self._on_flush)
+
+    def _on_flush(self):
+        self.flush_id = None
+        self.flush()
+        return False
+
+    def _work(self):
+        while True:
+            batch = self.jobs.get()
+            if batch is None:
+                break
+            try:
+                self._append(batch)
+            except OSError as e:
+                self.errors += 1
+                logger.warning('Writing %s failed: %s', self.path, e)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        # Cuts off a torn tail, or what a failed append left.
+        os.ftruncate(self.fd, self.log_bytes)
+
+    def _append(self, batch):
+        if self.fd is None:
+            self._open()
+        records = []
+        for key, value in batch.items():
+            record = encode_record(key, value)
+            records.append(record)
+            old = self.disk.pop(key, None)
+            if old is not None:
+                self.live_bytes -= record_size(key, old)
+            if value is not None:
+                self.disk[key] = value
+                self.live_bytes += len(record)
+        data = b''.join(records)
+        view = memoryview(data)
+        offset = self.log_bytes
+        while view:
+            n = os.pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+        os.fdatasync(self.fd)
+        self.log_bytes += len(data)
+        self.bytes_appended += len(data)
+        self.flushes += 1
+        if self.log_bytes >= COMPACT_MIN_BYTES and \
+                self.log_bytes > COMPACT_RATIO * self.live_bytes:
+            self._compact()
+
+    def _compact(self):
+        data = b''.join(encode_record(key, value)
+                        for key, value in self.disk.items())
+        f = PartialFile(self.path)
+        try:
+            f.write(data, 0)
+            f.sync()
+        except OSError:
+            f.abort()
+            raise
+        os.close(self.fd)
+        self.fd = None
+        f.commit()
+        logger.debug('Compacted %s from %d to %d bytes', self.path,
+                     self.log_bytes, len(data))
+        self.log_bytes = len(data)
+        self.bytes_compacted += len(data)
+        self.compactions += 1
+
+
+store = StateStore()
+
+metrics.add_gauge('hub_state',
+                  lambda: dict(('stat="%s"' % name, value)
+                               for name, value in store.stats().items()))
@@ -0,0 +1,164 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import mmap
+import os
+
+STORAGE_ROOT = os.path.normpath(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     '..', 'storage'))
+# The hub's state, apart from the compressed copies compression.Cache
+# prunes in COMPRESSED_ROOT below it.
+CACHE_ROOT = os.path.normpath(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     '..', 'cache'))
+# The hub's own data under the root (see chunks.py), out of clients' reach.
+STORE_DIR = '.store'
+
+
+class Storage(object):
+    """
+    Files kept under hub/storage. Every path coming from a client is
+    relative to the root and is refused if it escapes it.
+
+    """
+    def __init__(self, root=STORAGE_ROOT):
+        self.root = root
+        self.store = os.path.join(root, STORE_DIR)
+        os.makedirs(self.root, exist_ok=True)
+
+    def resolve(self, path):
+        if path is None:
+            path = ''
+        elif not isinstance(path, str):
+            raise ValueError('path is not a string: ' + repr(path))
+        full = os.path.normpath(os.path.join(self.root, path.lstrip('/')))
+        if full != self.root and not full.startswith(self.root + os.sep) or \
+                full == self.store or full.startswith(self.store + os.sep):
+            raise ValueError('path outside storage: ' + repr(path))
+        return full
+
+    def list(self, path=''):
+        entries = []
+        with os.scandir(self.resolve(path)) as it:
+            for entry in sorted(it, key=lambda e: e.name):
+                if entry.path == self.store:
+                    continue
+                st = entry.stat()
+                entries.append({
+                        'name': entry.name,
+                        'type': 'dir' if entry.is_dir() else 'file',
+                        'size': st.st_size,
+                        'mtime': int(st.st_mtime),
+                })
+        return entries
+
+    def open_map(self, path):
+        """
+        Memory-maps a file read-only. Empty files cannot be mapped, so they
+        come back as an empty bytes object instead.
+
+        """
+        return map_file(self.resolve(path))
+
+    def open_write(self, path, overwrite=True, suffix='.part', offset=None):
+        """
+        Starts writing a file, or resumes at 'offset'; see PartialFile.
+        Nothing is visible under 'path' until the returned PartialFile is
+        committed.
+
+        """
+        full = self.resolve(path)
+        if full == self.root or os.path.isdir(full):
+            raise IsADirectoryError(path)
+        if not overwrite and os.path.exists(full):
+            raise FileExistsError(path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        return PartialFile(full, suffix, offset)
+
+    def write(self, path, data, overwrite=True):
+        f = self.open_write(path, overwrite)
+        replace_file(f, data)
+
+    def create(self, path, data=b''):
+        self.write(path, data, overwrite=False)
+
+    def delete(self, path):
+        full = self.resolve(path)
+        if full == self.root:
+            raise ValueError('refusing to delete storage root')
+        if os.path.isdir(full):
+            os.rmdir(full)
+        else:
+            os.remove(full)
+
+
+def replace_file(f, data):
+    """Writes all of 'data' to PartialFile 'f' and commits it."""
+    try:
+        f.write(data, 0)
+    except OSError:
+        f.abort()
+        raise
+    f.commit()
+
+
+def map_file(full):
+    with open(full, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class PartialFile(object):
+    """
+    A file written as '<name>.part' next to its final name and renamed
+    over it on commit, so readers see either the old or the new file.
+    Writers that must not share a partial file pass their own 'suffix'.
+    With 'offset', an existing partial file is reopened and cut back to
+    that many bytes rather than started afresh.
+
+    """
+    def __init__(self, full, suffix='.part', offset=None):
+        self.full = full
+        self.tmp = full + suffix
+        if offset is None:
+            self.fd = os.open(self.tmp,
+                              os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            return
+        self.fd = os.open(self.tmp, os.O_WRONLY)
+        if os.fstat(self.fd).st_size < offset:
+            os.close(self.fd)
+            raise EOFError('%s is shorter than %d bytes' % (self.tmp, offset))
+        os.ftruncate(self.fd, offset)
+
+    def write(self, data, offset):
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+
+    def sync(self):
+        os.fdatasync(self.fd)
+
+    def commit(self):
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.tmp, self.full)
+        self.tmp = None
+
+    def close(self):
+        """Closes the partial file, leaving it there to be reopened."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def abort(self):
+        if self.tmp is None:
+            return
+        self.close()
+        try:
+            os.remove(self.tmp)
+        except FileNotFoundError:
+            pass
+        self.tmp = None
@@ -0,0 +1,483 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import mmap
+import os
+import struct
+import time
+import zlib
+
+import eventloop
+import log
+import startup
+
+# Only uploads and downloads need these; the ATT constants below are also
+# wanted by services built at startup (see startup.lazy_import()).
+chunks = startup.lazy_import('chunks')
+compression = startup.lazy_import('compression')
+
+# ATT_MTU when the link did not negotiate anything larger.
+DEFAULT_MTU = 23
+# Opcode (1) + handle (2) taken by every ATT notification.
+ATT_NOTIFY_OVERHEAD = 3
+# Largest value an attribute may carry (Core spec, Vol 3, Part F, 3.2.9).
+MAX_ATTR_LEN = 512
+
+# Frames sent without an ack before the stream pauses.
+DEFAULT_WINDOW = 16
+
+# Frame header: sequence number (wraps at 16 bits) and file offset of the
+# first payload byte. A frame with an empty payload marks the end of file.
+FRAME_HEADER = struct.Struct('<HI')
+
+# Ack written back by the client: 0x06 followed by the last sequence number
+# received, acknowledging it and every frame before it.
+ACK_OPCODE = 0x06
+ACK_FORMAT = struct.Struct('<BH')
+
+SEQ_MOD = 1 << 16
+
+# Uploads are written to FS_WRITE as frames: opcode, transfer id chosen by
+# the client, file offset, payload length and CRC-32 of the payload, then
+# the raw payload. No opcode is '{', so JSON requests still get through.
+UPLOAD_VERSION = 2
+UPLOAD_HEADER = struct.Struct('<BBIHI')
+# Payload: flags byte then the UTF-8 path. Offset: the file size if known.
+OP_OPEN = 0x10
+# Payload: file bytes at offset.
+OP_DATA = 0x11
+# No payload. Offset: file size. CRC: CRC-32 of the whole file.
+OP_COMMIT = 0x12
+OP_ABORT = 0x13
+UPLOAD_OPCODES = (OP_OPEN, OP_DATA, OP_COMMIT, OP_ABORT)
+
+OPEN_OVERWRITE = 0x01
+# The payload of the DATA frames is one stream in that codec, decompressed
+# into the file as it arrives. Offsets and CRCs cover the stream as sent.
+OPEN_ZLIB = 0x02
+OPEN_LZMA = 0x04
+OPEN_CODECS = ((OPEN_ZLIB, 'zlib'), (OPEN_LZMA, 'lzma'))
+# The DATA stream is chunk references and literals (chunks.ChunkDecoder),
+# after asking FS_CHUNKS which chunks the hub has.
+OPEN_CHUNKED = 0x08
+# Continue the client's upload with this transfer id and path where it
+# stopped, if the hub still has it, rather than start over; the status
+# tells the offset to continue from. Uploads without a codec survive hub
+# restarts through the journal (journal.py).
+OPEN_RESUME = 0x10
+
+# Read back from FS_WRITE: opcode, protocol version, transfer id, next
+# offset expected, the error of the client's last frame and the bytes
+# written to the file so far, which tells the client what compression
+# saved. Reading it is also how a client finds out the hub speaks this
+# protocol at all.
+STATUS_OPCODE = 0x14
+STATUS_FORMAT = struct.Struct('<BBBIBI')
+
+ERR_NONE = 0
+ERR_FRAME = 1
+ERR_CRC = 2
+ERR_OFFSET = 3
+ERR_TRANSFER = 4
+ERR_SIZE = 5
+ERR_STORAGE = 6
+# A referenced chunk is not on the hub (anymore); ask again and resend.
+ERR_CHUNK = 7
+
+UPLOAD_TIMEOUT_MS = 60000
+UPLOAD_SWEEP_S = 10
+
+logger = log.get_logger('storage')
+
+
+def parse_ack(value):
+    """
+    Returns the sequence number carried by an ack write, or None if the
+    value is not an ack.
+
+    """
+    if len(value) != ACK_FORMAT.size or value[0] != ACK_OPCODE:
+        return None
+    return ACK_FORMAT.unpack(bytes(value))[1]
+
+
+def is_upload_frame(value):
+    return len(value) > 0 and value[0] in UPLOAD_OPCODES
+
+
+def upload_chunk_size(mtu):
+    """Payload bytes that fit in one write without response."""
+    mtu = max(int(mtu), DEFAULT_MTU)
+    return min(mtu - ATT_NOTIFY_OVERHEAD, MAX_ATTR_LEN) - UPLOAD_HEADER.size
+
+
+def upload_frame(opcode, tid, offset, payload=b'', crc=None):
+    """Packs an upload frame, the way a client sends one."""
+    if crc is None:
+        crc = zlib.crc32(payload)
+    return UPLOAD_HEADER.pack(opcode, tid, offset, len(payload), crc) + \
+            bytes(payload)
+
+
+def chunk_size(mtu):
+    """Payload bytes that fit in one notification for a given ATT_MTU."""
+    mtu = max(int(mtu), DEFAULT_MTU)
+    return min(mtu - ATT_NOTIFY_OVERHEAD, MAX_ATTR_LEN) - FRAME_HEADER.size
+
+
+class DownloadStream(object):
+    """
+    Slices a memory-mapped file into MTU sized frames. Payloads are
+    memoryview slices of the map so the only copy made is the one into the
+    outgoing frame. At most 'window' frames are outstanding before the
+    client has to ack; a window of 0 disables flow control.
+
+    """
+    def __init__(self, data, mtu=DEFAULT_MTU, offset=0,
+                 window=DEFAULT_WINDOW):
+        self.data = data
+        self.view = memoryview(data)
+        self.size = len(data)
+        self.chunk = chunk_size(mtu)
+        self.window = window
+        self.offset = min(offset, self.size)
+        self.seq = 0
+        self.acked = 0
+        self.done = False
+        self.frame = bytearray(FRAME_HEADER.size + self.chunk)
+        self.released = self.offset - self.offset % mmap.PAGESIZE
+
+    def in_flight(self):
+        return self.seq - self.acked
+
+    def can_send(self):
+        if self.done:
+            return False
+        return not self.window or self.in_flight() < self.window
+
+    def next_frame(self):
+        """
+        Returns the next frame as bytes, or None when the window is full or
+        the end-of-file frame has already been sent.
+
+        """
+        if not self.can_send():
+            return None
+
+        payload = self.view[self.offset:self.offset + self.chunk]
+        n = len(payload)
+        FRAME_HEADER.pack_into(self.frame, 0, self.seq % SEQ_MOD, self.offset)
+        self.frame[FRAME_HEADER.size:FRAME_HEADER.size + n] = payload
+        payload.release()
+
+        self.offset += n
+        self.seq += 1
+        if n == 0:
+            self.done = True
+        return bytes(self.frame[:FRAME_HEADER.size + n])
+
+    def ack(self, seq):
+        """
+        Acknowledges every frame up to and including the 16-bit 'seq'. Acks
+        for frames that were never sent are ignored.
+
+        """
+        delta = (seq - self.acked) % SEQ_MOD + 1
+        if delta > self.in_flight():
+            return
+        self.acked += delta
+        self._release_pages()
+
+    def _release_pages(self):
+        # Pages the client has acked are not needed again; drop them so a
+        # long download does not keep the whole file resident.
+        if not isinstance(self.data, mmap.mmap) or \
+                not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        end = min(self.offset, self.size)
+        if self.window:
+            end -= (self.seq - self.acked) * self.chunk
+        end -= end % mmap.PAGESIZE
+        if end > self.released:
+            self.data.madvise(mmap.MADV_DONTNEED, self.released,
+                              end - self.released)
+            self.released = end
+
+    def read(self, offset, length):
+        """Bytes at 'offset' for a plain (non streamed) ReadValue."""
+        return bytes(self.view[offset:offset + length])
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+class UploadError(ValueError):
+
+    def __init__(self, code, message):
+        ValueError.__init__(self, message)
+        self.code = code
+
+
+def parse_upload_frame(value):
+    """
+    Returns (opcode, transfer id, offset, crc, payload) for an upload
+    frame, the payload as a memoryview of 'value'. Raises UploadError when
+    the frame is truncated or its payload fails the CRC.
+
+    """
+    if len(value) < UPLOAD_HEADER.size:
+        raise UploadError(ERR_FRAME, 'short frame')
+    opcode, tid, offset, length, crc = UPLOAD_HEADER.unpack_from(value)
+    payload = memoryview(value)[UPLOAD_HEADER.size:]
+    if len(payload) != length:
+        raise UploadError(ERR_FRAME, 'length %d, got %d' %
+                          (length, len(payload)))
+    if opcode != OP_COMMIT and zlib.crc32(payload) != crc:
+        raise UploadError(ERR_CRC, 'bad CRC at offset %d' % offset)
+    return opcode, tid, offset, crc, payload
+
+
+class FileUpload(object):
+    """
+    One file being received. Payloads go from the frame straight into the
+    partial file, through 'decompressor' if the client compressed them,
+    and into a running CRC, so nothing is buffered.
+
+    """
+    def __init__(self, file, path, decompressor=None):
+        self.file = file
+        self.path = path
+        self.decompressor = decompressor
+        self.offset = 0
+        self.written = 0
+        self.crc = 0
+        self.deadline = 0
+
+    def write(self, offset, payload):
+        if offset < self.offset and offset + len(payload) <= self.offset:
+            # A frame sent again after a lost status: already written.
+            return
+        if offset != self.offset:
+            raise UploadError(ERR_OFFSET, 'expected offset %d, got %d' %
+                              (self.offset, offset))
+        data = payload
+        if self.decompressor is not None:
+            try:
+                data = self.decompressor.decompress(payload)
+            except chunks.MissingChunk as e:
+                raise UploadError(ERR_CHUNK, str(e))
+            except Exception as e:
+                # zlib.error, lzma.LZMAError and the ValueErrors of the
+                # chunk decoder share no base but Exception.
+                raise UploadError(ERR_FRAME, 'bad stream at offset %d: %s' %
+                                  (offset, e))
+        self.file.write(data, self.written)
+        self.written += len(data)
+        self.crc = zlib.crc32(payload, self.crc)
+        self.offset += len(payload)
+
+    def commit(self, size, crc):
+        if size != self.offset or crc != self.crc:
+            raise UploadError(ERR_SIZE, 'got %d bytes, crc %08x; expected '
+                              '%d, %08x' % (self.offset, self.crc, size, crc))
+        if self.decompressor is not None and not self.decompressor.eof:
+            raise UploadError(ERR_SIZE, 'compressed stream ends early')
+        self.file.commit()
+
+    def abort(self):
+        self.file.abort()
+
+
+class UploadReceiver(object):
+    """
+    Upload frames of every client, keyed by (device, transfer id), into
+    files opened through 'storage'. Chunked uploads take their chunks from
+    the chunks.ChunkStore 'chunk_store'.
+
+    Uploads idle for 'timeout_ms' are put aside if they are in 'journal',
+    a journal.Journal, and can be resumed until it expires them; other
+    uploads are aborted, which removes their partial file.
+
+    """
+    def __init__(self, storage, chunk_store=None, journal=None,
+                 timeout_ms=UPLOAD_TIMEOUT_MS):
+        self.storage = storage
+        self.chunk_store = chunk_store
+        self.journal = journal
+        self.timeout_ms = timeout_ms
+        self.uploads = {}
+        self.status = {}
+        self.sweep_id = None
+
+    def handle(self, value, device):
+        """
+        Applies one frame from 'device' and returns its opcode. Storage
+        errors propagate as they are (OSError, ValueError for paths outside
+        storage) and frame errors raise UploadError; either way the
+        client's status records it.
+
+        """
+        tid = value[1] if len(value) > 1 else 0
+        key = (device, tid)
+        try:
+            opcode, tid, offset, crc, payload = parse_upload_frame(value)
+            upload = self._apply(opcode, key, offset, crc, payload)
+        except UploadError as e:
+            self._set_status(key, e.code)
+            raise
+        except (OSError, ValueError):
+            self._drop(key)
+            self._set_status(key, ERR_STORAGE)
+            raise
+        self._set_status(key, ERR_NONE, upload)
+        return opcode
+
+    def get_status(self, device):
+        tid, offset, error, written = self.status.get(device,
+                                                      (0, 0, ERR_NONE, 0))
+        return STATUS_FORMAT.pack(STATUS_OPCODE, UPLOAD_VERSION, tid, offset,
+                                  error, written)
+
+    def _apply(self, opcode, key, offset, crc, payload):
+        """Returns the upload the frame went to, None once aborted."""
+        if opcode == OP_OPEN:
+            if len(payload) < 2:
+                raise UploadError(ERR_FRAME, 'open without a path')
+            path = bytes(payload[1:]).decode('utf-8', 'replace')
+            flags = payload[0]
+            if flags & OPEN_RESUME:
+                upload = self._resume(key, path, flags)
+                if upload is not None:
+                    return upload
+            self._drop(key)
+            if flags & OPEN_CHUNKED:
+                if self.chunk_store is None:
+                    raise UploadError(ERR_FRAME, 'chunked uploads unsupported')
+                decoder = self.chunk_store.decoder()
+            else:
+                codec = None
+                for flag, name in OPEN_CODECS:
+                    if flags & flag:
+                        codec = name
+                decoder = compression.decompressor(codec)
+            upload = FileUpload(
+                    self.storage.open_write(path, flags & OPEN_OVERWRITE,
+                                            self._suffix(key)),
+                    path, decoder)
+            logger.info('Storage upload %d from %s: %r', key[1],
+                        key[0] or 'unknown', path)
+            self.uploads[key] = upload
+            self._touch(upload)
+            return upload
+
+        upload = self.uploads.get(key)
+        if upload is None:
+            raise UploadError(ERR_TRANSFER, 'no transfer %d' % key[1])
+        if opcode == OP_DATA:
+            upload.write(offset, payload)
+            self._touch(upload)
+            if self._resumable(upload):
+                self.journal.update(key[0], key[1], upload)
+            return upload
+        if opcode == OP_COMMIT:
+            del self.uploads[key]
+            try:
+                upload.commit(offset, crc)
+            except Exception:
+                # Out of self.uploads already, so nothing else would.
+                upload.abort()
+                raise
+            finally:
+                if self.journal is not None:
+                    self.journal.remove(key[0], key[1])
+            logger.info('Storage upload %d committed: %r (%d bytes, %d sent)',
+                        key[1], upload.path, upload.written, upload.offset)
+            return upload
+        self._drop(key)
+        return None
+
+    def _resume(self, key, path, flags):
+        """The upload 'key' to 'path' where it stopped, or None."""
+        upload = self.uploads.get(key)
+        if upload is not None:
+            return upload if upload.path == path else None
+        if self.journal is None or \
+                flags & (OPEN_CHUNKED | OPEN_ZLIB | OPEN_LZMA):
+            return None
+        entry = self.journal.get(key[0], key[1])
+        if entry is None or entry['path'] != path:
+            return None
+        try:
+            f = self.storage.open_write(path, flags & OPEN_OVERWRITE,
+                                        self._suffix(key), entry['offset'])
+        except (OSError, ValueError, EOFError) as e:
+            logger.info('Storage upload %d from %s cannot resume: %s',
+                        key[1], key[0] or 'unknown', e)
+            return None
+        upload = FileUpload(f, path)
+        upload.offset = upload.written = entry['offset']
+        upload.crc = entry['crc']
+        logger.info('Storage upload %d from %s resumed at %d: %r', key[1],
+                    key[0] or 'unknown', upload.offset, path)
+        self.uploads[key] = upload
+        self._touch(upload)
+        return upload
+
+    def _resumable(self, upload):
+        return self.journal is not None and upload.decompressor is None
+
+    def _suffix(self, key):
+        # One partial file per upload, found again from its key.
+        return '.%08x.part' % zlib.crc32(('%s#%d' % key).encode('utf-8'))
+
+    def _set_status(self, key, error, upload=None):
+        if upload is None:
+            upload = self.uploads.get(key)
+        if upload is None:
+            self.status[key[0]] = (key[1], 0, error, 0)
+        else:
+            self.status[key[0]] = (key[1], upload.offset, error,
+                                   upload.written)
+
+    def _touch(self, upload):
+        upload.deadline = eventloop.monotonic_ms() + self.timeout_ms
+        if self.sweep_id is None:
+            self.sweep_id = eventloop.timeout_add_seconds(UPLOAD_SWEEP_S,
+                                                          self._sweep)
+
+    def _drop(self, key):
+        upload = self.uploads.pop(key, None)
+        if upload is not None:
+            upload.abort()
+        if self.journal is not None:
+            entry = self.journal.get(key[0], key[1])
+            if entry is not None:
+                try:
+                    os.remove(entry['tmp'])
+                except OSError:
+                    pass
+            self.journal.remove(key[0], key[1])
+
+    def _sweep(self):
+        now = eventloop.monotonic_ms()
+        for key, upload in list(self.uploads.items()):
+            if upload.deadline > now:
+                continue
+            if self._resumable(upload):
+                logger.info('Storage upload %d from %s idle, kept at %d: %r',
+                            key[1], key[0] or 'unknown', upload.offset,
+                            upload.path)
+                self.journal.flush()
+                del self.uploads[key]
+                upload.file.close()
+                continue
+            logger.info('Storage upload %d from %s timed out: %r',
+                        key[1], key[0] or 'unknown', upload.path)
+            self._drop(key)
+        if self.journal is not None:
+            self.journal.expire(time.time())
+        if self.uploads:
+            return True
+        self.sweep_id = None
+        return False
@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+# Type ReadValue results are handed to the bus as. Plain bytes suit
+# dbus_next; the GLib backend swaps in dbus.ByteArray.
+marshal = bytes
+
+
+class Value(object):
+    """
+    Attribute value held as bytes. The marshal form handed back to
+    ReadValue is built on the first read after a write and reused until
+    the next one, so repeated reads of a large value neither copy it nor
+    marshal it element by element.
+
+    """
+    def __init__(self, data=b''):
+        self.set(data)
+
+    def set(self, data):
+        if type(data) is marshal:
+            # What WriteValue receives from the backend: immutable and
+            # already in marshalled form.
+            self.data = data
+            self.marshalled = data
+            return
+        if isinstance(data, (bytearray, memoryview)):
+            data = bytes(data)
+        elif not isinstance(data, bytes):
+            data = bytes(bytearray(data))
+        self.data = data
+        self.marshalled = None
+
+    def get(self):
+        if self.marshalled is None:
+            self.marshalled = marshal(self.data)
+        return self.marshalled
+
+    def read(self, options):
+        """
+        The value as seen by a ReadValue call, starting at the 'offset'
+        BlueZ passes for the blob reads of a long read.
+
+        """
+        offset = int(options.get('offset', 0))
+        if offset == 0:
+            return self.get()
+        if offset > len(self.data):
+            raise ValueError('offset past end of value')
+        return marshal(memoryview(self.data)[offset:])
+
+    def __bytes__(self):
+        return self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return 'Value(%r)' % (self.data,)
@@ -0,0 +1,339 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Wi-Fi provisioning behind the hub's Wi-Fi service. Scanning, connecting
+and asking for the connection status are commands of a backend (nmcli by
+default, or a stub for development and tests) that block for up to
+seconds, so a WifiManager runs them one at a time on a
+background.Worker, and callbacks always run on the main loop.
+
+Scan results are cached for SCAN_TTL_MS. Within that time a scan is
+answered from the cache at once; past it the stale results still answer
+at once while a new scan refreshes them, and only the very first scan
+waits for the backend.
+
+"""
+
+import collections
+import re
+import shutil
+import subprocess
+import time
+
+import background
+import eventloop
+import log
+
+SCAN_TTL_MS = 30 * 1000
+# Longest a backend command may take; connecting to a network can be slow.
+COMMAND_TIMEOUT_S = 45
+
+STATE_CONNECTED = 'connected'
+STATE_CONNECTING = 'connecting'
+STATE_DISCONNECTED = 'disconnected'
+STATE_DISCONNECTING = 'disconnecting'
+STATE_UNAVAILABLE = 'unavailable'
+
+MAX_SSID_BYTES = 32
+PSK_LENGTHS = range(8, 64)
+
+logger = log.get_logger('wifi')
+
+
+class WifiError(OSError):
+    """A backend command failed; the message is what it reported."""
+
+
+def check_network(ssid, psk):
+    """Raises ValueError unless 'ssid' and 'psk' are acceptable to WPA."""
+    if not isinstance(ssid, str) or \
+            not 0 < len(ssid.encode('utf-8')) <= MAX_SSID_BYTES:
+        raise ValueError('invalid ssid')
+    if psk is not None and (not isinstance(psk, str) or
+                            len(psk) not in PSK_LENGTHS):
+        raise ValueError('invalid psk')
+
+
+def split_terse(line):
+    """The fields of a line of 'nmcli --terse' output, unescaped."""
+    fields = re.split(r'(?<!\\):', line)
+    return [re.sub(r'\\(.)', r'\1', field) for field in fields]
+
+
+class NmcliBackend(object):
+    """
+    NetworkManager through nmcli, on 'interface' or on the first Wi-Fi
+    device it manages.
+
+    """
+    def __init__(self, interface=None):
+        self.interface = interface
+
+    def nmcli(self, *args):
+        try:
+            result = subprocess.run(('nmcli', '--terse') + args,
+                                    capture_output=True, text=True,
+                                    timeout=COMMAND_TIMEOUT_S)
+        except subprocess.TimeoutExpired:
+            raise WifiError('nmcli timed out')
+        except FileNotFoundError:
+            raise WifiError('nmcli not installed')
+        if result.returncode != 0:
+            raise WifiError(result.stderr.strip() or
+                            'nmcli failed (%d)' % result.returncode)
+        return [line for line in result.stdout.splitlines() if line]
+
+    def device(self):
+        if self.interface is not None:
+            return self.interface
+        for line in self.nmcli('--fields', 'DEVICE,TYPE', 'device'):
+            device, kind = split_terse(line)[:2]
+            if kind == 'wifi':
+                return device
+        raise WifiError('no Wi-Fi device')
+
+    def scan(self):
+        networks = {}
+        for line in self.nmcli('--fields', 'SSID,SIGNAL,SECURITY,CHAN',
+                               'device', 'wifi', 'list', 'ifname',
+                               self.device(), '--rescan', 'yes'):
+            ssid, signal, security, channel = split_terse(line)[:4]
+            if not ssid:
+                continue
+            network = {'ssid': ssid, 'signal': int(signal or 0),
+                       'security': security, 'channel': int(channel or 0)}
+            if network['signal'] > networks.get(ssid, {}).get('signal', -1):
+                networks[ssid] = network
+        return sorted(networks.values(), key=lambda n: -n['signal'])
+
+    def status(self):
+        device = self.device()
+        fields = dict(split_terse(line)[:2] for line in self.nmcli(
+                '--fields', 'GENERAL.STATE,GENERAL.CONNECTION,IP4.ADDRESS',
+                'device', 'show', device))
+        state = fields.get('GENERAL.STATE', '')
+        if state.startswith('100'):
+            state = STATE_CONNECTED
+        elif state.startswith(('40', '50', '60', '70', '80', '90')):
+            state = STATE_CONNECTING
+        elif state.startswith(('10', '20')):
+            state = STATE_UNAVAILABLE
+        else:
+            state = STATE_DISCONNECTED
+        address = fields.get('IP4.ADDRESS[1]', '').split('/')[0]
+        return {'state': state,
+                'ssid': fields.get('GENERAL.CONNECTION') or None,
+                'ip': address or None}
+
+    def connect(self, ssid, psk=None):
+        args = ['device', 'wifi', 'connect', ssid, 'ifname', self.device()]
+        if psk is not None:
+            args += ['password', psk]
+        self.nmcli(*args)
+
+    def disconnect(self):
+        self.nmcli('device', 'disconnect', self.device())
+
+
+class StubBackend(object):
+    """
+    Canned networks and a connection kept in memory, each command taking
+    'delay_s' as real ones would. A network named in 'fail' refuses to
+    connect.
+
+    """
+    NETWORKS = (
+        {'ssid': 'hub-lab', 'signal': 82, 'security': 'WPA2', 'channel': 6},
+        {'ssid': 'hub-guest', 'signal': 64, 'security': '', 'channel': 11},
+        {'ssid': 'hub-iot', 'signal': 41, 'security': 'WPA2', 'channel': 1},
+    )
+
+    def __init__(self, delay_s=0.5, networks=NETWORKS, fail=()):
+        self.delay_s = delay_s
+        self.networks = [dict(network) for network in networks]
+        self.fail = set(fail)
+        self.ssid = None
+        self.commands = collections.Counter()
+
+    def _command(self, name):
+        self.commands[name] += 1
+        time.sleep(self.delay_s)
+
+    def scan(self):
+        self._command('scan')
+        return [dict(network) for network in self.networks]
+
+    def status(self):
+        self._command('status')
+        if self.ssid is None:
+            return {'state': STATE_DISCONNECTED, 'ssid': None, 'ip': None}
+        return {'state': STATE_CONNECTED, 'ssid': self.ssid,
+                'ip': '192.168.4.2'}
+
+    def connect(self, ssid, psk=None):
+        self._command('connect')
+        if ssid in self.fail or \
+                ssid not in [network['ssid'] for network in self.networks]:
+            raise WifiError('could not connect to %s' % ssid)
+        self.ssid = ssid
+
+    def disconnect(self):
+        self._command('disconnect')
+        self.ssid = None
+
+
+BACKENDS = {
+    'nmcli': NmcliBackend,
+    'stub': StubBackend,
+}
+
+
+def open_backend(name):
+    """
+    The backend called 'name'. 'auto' is nmcli even when it is not
+    installed: its commands then fail, and the service reports the Wi-Fi
+    unavailable rather than networks that are not there. The stub only
+    runs when named.
+
+    """
+    if name == 'auto':
+        if shutil.which('nmcli') is None:
+            logger.warning('nmcli not installed, Wi-Fi unavailable')
+        name = 'nmcli'
+    return BACKENDS[name]()
+
+
+class WifiManager(object):
+    """
+    Runs the commands of 'backend' on a worker thread. Callbacks are
+    called on the main loop as callback(result, error), 'error' being None
+    or the exception the command raised. on_status(status) is called
+    whenever the status differs from the last one known.
+
+    """
+    def __init__(self, backend, scan_ttl_ms=SCAN_TTL_MS, on_status=None):
+        self.backend = backend
+        self.scan_ttl_ms = scan_ttl_ms
+        self.on_status = on_status
+        self.worker = background.Worker('wifi', logger)
+        self.networks = None
+        self.scanned_ms = None
+        # Callbacks waiting for the scan in progress, or None.
+        self.scan_waiters = None
+        self.status = None
+        self.status_waiters = None
+        self.last_error = None
+        self.scans = 0
+        self.cache_hits = 0
+        self.scan_ms = 0
+
+    def close(self):
+        self.worker.close()
+
+    def submit(self, func, args, callback):
+        self.worker.submit(func, args, callback)
+
+    def scan(self, callback, force=False):
+        """
+        Calls callback(networks, error) with the cached results if any,
+        and refreshes them when older than the TTL or when forced.
+
+        """
+        age = self.scan_age_ms()
+        fresh = age is not None and age < self.scan_ttl_ms and not force
+        if self.networks is not None:
+            if fresh:
+                self.cache_hits += 1
+            callback(self.networks, None)
+            if fresh:
+                return
+            callback = None
+        if self.scan_waiters is None:
+            self.scan_waiters = []
+            self.submit(self._timed_scan, (), self._on_scan)
+        if callback is not None:
+            self.scan_waiters.append(callback)
+
+    def scan_age_ms(self):
+        if self.scanned_ms is None:
+            return None
+        return eventloop.monotonic_ms() - self.scanned_ms
+
+    def scanning(self):
+        return self.scan_waiters is not None
+
+    def refresh_status(self, callback=None):
+        """Asks the backend for the status, then calls callback(status)."""
+        if self.status_waiters is None:
+            self.status_waiters = []
+            self.submit(self.backend.status, (), self._on_status)
+        if callback is not None:
+            self.status_waiters.append(callback)
+
+    def connect(self, ssid, psk=None):
+        check_network(ssid, psk)
+        logger.info('Connecting to %r', ssid)
+        self._set_status({'state': STATE_CONNECTING, 'ssid': ssid,
+                          'ip': None})
+        self.submit(self.backend.connect, (ssid, psk), self._on_command)
+
+    def disconnect(self):
+        logger.info('Disconnecting')
+        status = dict(self.status or {'ssid': None, 'ip': None})
+        status['state'] = STATE_DISCONNECTING
+        self._set_status(status)
+        self.submit(self.backend.disconnect, (), self._on_command)
+
+    def describe(self):
+        """The status as reported to clients, with the last error."""
+        status = dict(self.status or {'state': None, 'ssid': None,
+                                      'ip': None})
+        status['error'] = self.last_error
+        return status
+
+    def stats(self):
+        return {
+                'scans': self.scans,
+                'scan_cache_hits': self.cache_hits,
+                'scan_ms': self.scan_ms,
+                'scan_age_ms': self.scan_age_ms(),
+        }
+
+    def _timed_scan(self):
+        start = time.perf_counter()
+        networks = self.backend.scan()
+        return networks, int((time.perf_counter() - start) * 1000)
+
+    def _on_scan(self, result, error):
+        waiters, self.scan_waiters = self.scan_waiters, None
+        if error is None:
+            self.networks, self.scan_ms = result
+            self.scanned_ms = eventloop.monotonic_ms()
+            self.scans += 1
+        else:
+            logger.warning('Wi-Fi scan failed: %s', error)
+        for callback in waiters:
+            callback(self.networks if error is None else None, error)
+
+    def _on_status(self, result, error):
+        waiters, self.status_waiters = self.status_waiters, None
+        if error is None:
+            self._set_status(result)
+        else:
+            logger.warning('Wi-Fi status failed: %s', error)
+            self._set_status({'state': STATE_UNAVAILABLE, 'ssid': None,
+                              'ip': None})
+        for callback in waiters:
+            callback(self.describe())
+
+    def _on_command(self, result, error):
+        self.last_error = None if error is None else str(error)
+        if error is not None:
+            logger.warning('Wi-Fi command failed: %s', error)
+        self.refresh_status()
+
+    def _set_status(self, status):
+        if status == self.status:
+            return
+        self.status = status
+        if self.on_status is not None:
+            self.on_status(self.describe())
@@ -0,0 +1,250 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+"""
+Program worker, one process of runner.py's pool. It imports IMPORTS once,
+then runs the programs it is sent one after the other, each in fresh
+globals, and goes back to waiting for the next.
+
+Messages both ways are marshalled tuples, each preceded by its length as
+a 32-bit little endian integer. The hub sends ("run", id, code, cpu_s),
+code being a marshalled code object; the worker answers ("ready", pid)
+once at startup, then for each run ("started", id, monotonic time),
+("out", id, text) for what the program prints and ("done", id, error),
+error being None or a one line description. A program subscribing to
+events (see ProgramEvents) adds ("subscribe", id, topic, key) and
+("latency", id, [ns, ...]), the time each event took from publishing to
+its handlers.
+
+A run may use 'cpu_s' seconds of CPU time, and the process as a whole
+MEMORY_BYTES of address space; going over either ends the run with an
+error but keeps the worker. SIGINT stops the program being run.
+
+    python3 worker.py READ_FD WRITE_FD MEMORY_BYTES [RING_FD BELL_FD]
+
+"""
+
+import builtins
+import collections
+import importlib
+import marshal
+import math
+import os
+import resource
+import select
+import signal
+import struct
+import sys
+import time
+
+import events
+
+# Modules programs are likely to import, paid for when the worker starts.
+IMPORTS = ('math', 'random', 'time', 'json', 're', 'collections')
+FRAME_HEADER = struct.Struct('<I')
+# Printed text is sent once a line is complete or this much is buffered.
+OUTPUT_BUFFER = 512
+# Handlers of this topic run once the program's main code is done.
+START_TOPIC = 'start'
+# Event latencies are reported in batches of this many, or when idle.
+LATENCY_BATCH = 64
+# Longest sleep waiting for events without checking the ring, in case a
+# doorbell was missed.
+WAIT_S = 0.05
+
+running = False
+
+Event = collections.namedtuple('Event', ('topic', 'key', 'value'))
+
+
+class CpuLimit(Exception):
+    pass
+
+
+def send(fd, message):
+    data = marshal.dumps(message)
+    data = memoryview(FRAME_HEADER.pack(len(data)) + data)
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def read_exact(fd, size):
+    data = b''
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def receive(fd):
+    """The next message on 'fd', or None once the hub closed it."""
+    header = read_exact(fd, FRAME_HEADER.size)
+    if header is None:
+        return None
+    data = read_exact(fd, FRAME_HEADER.unpack(header)[0])
+    return None if data is None else marshal.loads(data)
+
+
+class Output(object):
+    """sys.stdout of a run, forwarding what is printed to the hub."""
+
+    def __init__(self, fd, run_id):
+        self.fd = fd
+        self.run_id = run_id
+        self.buffer = ''
+
+    def write(self, text):
+        self.buffer += text
+        if '\n' in text or len(self.buffer) >= OUTPUT_BUFFER:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            send(self.fd, ('out', self.run_id, self.buffer))
+            self.buffer = ''
+
+
+class ProgramEvents(object):
+    """
+    'events' in a program's globals. Functions decorated with
+    @events.on(topic, key) are called with an Event for each matching
+    event the hub publishes, or for any key when 'key' is None, after the
+    program's main code ran; the run then lasts until it is stopped.
+
+    """
+    def __init__(self, fd, run_id, ring, bell):
+        self.fd = fd
+        self.run_id = run_id
+        self.ring = ring
+        self.bell = bell
+        self.handlers = {}
+        self.latencies = []
+
+    def on(self, topic, key=None):
+        def register(func):
+            self.handlers.setdefault((topic, key), []).append(func)
+            if topic != START_TOPIC:
+                send(self.fd, ('subscribe', self.run_id, topic, key))
+            return func
+        return register
+
+    def serve(self):
+        """Runs the handlers until the program is stopped."""
+        for handler in self.handlers.get((START_TOPIC, None), ()):
+            handler(Event(START_TOPIC, None, None))
+        if not any(topic != START_TOPIC for topic, _ in self.handlers):
+            return
+        while True:
+            records = self.ring.pop_all()
+            for record in records:
+                self.dispatch(*events.decode(record))
+            if records:
+                if len(self.latencies) >= LATENCY_BATCH:
+                    self.flush()
+                continue
+            self.flush()
+            self.ring.set_waiting(True)
+            try:
+                if not self.ring.pending():
+                    if select.select([self.bell], [], [], WAIT_S)[0]:
+                        os.read(self.bell, 4096)
+            finally:
+                self.ring.set_waiting(False)
+
+    def dispatch(self, topic, key, value, published_ns):
+        self.latencies.append(time.monotonic_ns() - published_ns)
+        event = Event(topic, key, value)
+        for handler in self.handlers.get((topic, key), ()):
+            handler(event)
+        if key is not None:
+            for handler in self.handlers.get((topic, None), ()):
+                handler(event)
+
+    def flush(self):
+        if self.latencies:
+            send(self.fd, ('latency', self.run_id, self.latencies))
+            self.latencies = []
+
+
+def on_sigint(signum, frame):
+    if running:
+        raise KeyboardInterrupt()
+
+
+def on_sigxcpu(signum, frame):
+    raise CpuLimit()
+
+
+def describe(e):
+    if isinstance(e, KeyboardInterrupt):
+        return 'stopped'
+    if isinstance(e, CpuLimit):
+        return 'CPU time limit exceeded'
+    if isinstance(e, MemoryError):
+        return 'memory limit exceeded'
+    return '%s: %s' % (type(e).__name__, e)
+
+
+def run(fd, run_id, code, cpu_s, ring=None, bell=None):
+    global running
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(math.ceil(usage.ru_utime + usage.ru_stime))
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_s, hard))
+    output = Output(fd, run_id)
+    sys.stdout = sys.stderr = output
+    program = {'__name__': '__main__', '__builtins__': builtins}
+    if ring is not None:
+        # Left over from the previous run.
+        ring.pop_all()
+        program['events'] = ProgramEvents(fd, run_id, ring, bell)
+    error = None
+    try:
+        code = marshal.loads(code)
+        running = True
+        send(fd, ('started', run_id, time.monotonic()))
+        exec(code, program)
+        if ring is not None:
+            program['events'].serve()
+    except SystemExit:
+        pass
+    except BaseException as e:
+        error = describe(e)
+    finally:
+        running = False
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+    output.flush()
+    send(fd, ('done', run_id, error))
+
+
+def main():
+    read_fd, write_fd, memory = (int(arg) for arg in sys.argv[1:4])
+    ring = bell = None
+    if len(sys.argv) > 5:
+        ring = events.Ring(int(sys.argv[4]))
+        bell = int(sys.argv[5])
+        os.set_blocking(bell, False)
+    for name in IMPORTS:
+        importlib.import_module(name)
+    signal.signal(signal.SIGINT, on_sigint)
+    signal.signal(signal.SIGXCPU, on_sigxcpu)
+    if memory:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (memory, hard))
+    send(write_fd, ('ready', os.getpid()))
+    while True:
+        try:
+            message = receive(read_fd)
+            if message is None:
+                return
+            run(write_fd, *message[1:], ring=ring, bell=bell)
+        except KeyboardInterrupt:
+            # A stop that came after the program ended.
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import itertools
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import eventloop
+
+
+class FakeLoop(object):
+    """
+    Timers and idle callbacks that run only when a test advances the
+    clock, which is also what eventloop.monotonic_ms() returns.
+
+    """
+    def __init__(self):
+        self.now_ms = 0
+        self.ids = itertools.count(1)
+        # Source id: [due ms, interval ms, callback].
+        self.sources = {}
+
+    def timeout_add(self, interval_ms, callback):
+        source_id = next(self.ids)
+        self.sources[source_id] = [self.now_ms + interval_ms, interval_ms,
+                                   callback]
+        return source_id
+
+    def timeout_add_seconds(self, interval, callback):
+        return self.timeout_add(interval * 1000, callback)
+
+    def idle_add(self, callback):
+        return self.timeout_add(0, callback)
+
+    def source_remove(self, source_id):
+        self.sources.pop(source_id, None)
+
+    def advance(self, ms=0):
+        """Moves the clock on by 'ms' and runs every source due by then."""
+        self.now_ms += ms
+        while True:
+            due = [(source[0], source_id)
+                   for source_id, source in self.sources.items()
+                   if source[0] <= self.now_ms]
+            if not due:
+                return
+            source_id = min(due)[1]
+            source = self.sources[source_id]
+            if source[2]():
+                source[0] = self.now_ms + max(source[1], 1)
+            else:
+                self.sources.pop(source_id, None)
+
+
+@pytest.fixture
+def loop(monkeypatch):
+    loop = FakeLoop()
+    monkeypatch.setattr(eventloop, 'current', loop)
+    monkeypatch.setattr(eventloop, 'monotonic_ms', lambda: loop.now_ms)
+    return loop
@@ -0,0 +1,136 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import hashlib
+import random
+
+import pytest
+
+import chunks
+from chunks import MAX_CHUNK, MIN_CHUNK
+
+
+def client_cut(data):
+    """Cut points as the module docstring specifies them for clients."""
+    gear = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big')
+            for i in range(256)]
+    cuts = []
+    start = 0
+    h = 0
+    for pos in range(len(data)):
+        length = pos - start
+        if length >= MIN_CHUNK:
+            h = (2 * h + gear[data[pos]]) % 2 ** 32
+            if h >> (32 - chunks.CHUNK_BITS) == 0:
+                cuts.append(pos + 1)
+                start = pos + 1
+                h = 0
+                continue
+        if pos + 1 - start == MAX_CHUNK:
+            cuts.append(pos + 1)
+            start = pos + 1
+            h = 0
+    if start < len(data):
+        cuts.append(len(data))
+    return cuts
+
+
+def random_bytes(size, seed=1):
+    return random.Random(seed).randbytes(size)
+
+
+def ends(pieces):
+    return [offset + length for offset, length in pieces]
+
+
+class Store(object):
+    """The read_chunk() of a ChunkStore holding the chunks of 'data'."""
+
+    def __init__(self, data):
+        self.chunks = {}
+        for offset, length in chunks.cut(data):
+            piece = data[offset:offset + length]
+            self.chunks[hashlib.sha256(piece).digest()] = piece
+
+    def read_chunk(self, digest):
+        try:
+            return self.chunks[digest]
+        except KeyError:
+            raise chunks.MissingChunk(digest.hex())
+
+
+@pytest.mark.parametrize('data', [
+        b'',
+        b'x',
+        bytes(MIN_CHUNK),
+        bytes(MAX_CHUNK + 1),
+        random_bytes(200 * 1024),
+])
+def test_cut_matches_client(data):
+    assert ends(chunks.cut(data)) == client_cut(data)
+
+
+def test_cut_covers_data_within_bounds():
+    data = random_bytes(300 * 1024)
+    pieces = chunks.cut(data)
+    assert pieces[0][0] == 0
+    for (offset, length), (next_offset, _) in zip(pieces, pieces[1:]):
+        assert offset + length == next_offset
+        assert MIN_CHUNK < length <= MAX_CHUNK
+    assert sum(length for _, length in pieces) == len(data)
+    assert len(pieces) > 10
+
+
+def test_cut_of_constant_data_is_max_chunks():
+    assert chunks.cut(bytes(3 * MAX_CHUNK)) == [
+            (0, MAX_CHUNK), (MAX_CHUNK, MAX_CHUNK),
+            (2 * MAX_CHUNK, MAX_CHUNK)]
+
+
+def test_gear_is_fixed():
+    assert chunks.GEAR[0] == 0x6e340b9c
+    assert len(set(chunks.GEAR)) == 256
+
+
+def test_edit_moves_nearby_cuts_only():
+    data = random_bytes(300 * 1024)
+    edited = data[:1000] + b'inserted' + data[1000:]
+    before = set(ends(chunks.cut(data)))
+    after = set(end - 8 for end in ends(chunks.cut(edited)))
+    assert len(before - after) <= 2
+
+
+def test_decode_literals():
+    data = random_bytes(100 * 1024)
+    decoder = chunks.ChunkDecoder(Store(b''))
+    assert decoder.decompress(chunks.encode(data, set())) == data
+    assert decoder.eof
+
+
+def test_decode_references_in_pieces():
+    data = random_bytes(100 * 1024)
+    edited = data[:50000] + b'changed' + data[50000:]
+    store = Store(data)
+    stream = chunks.encode(edited, set(store.chunks))
+    assert len(stream) < len(edited) // 2
+    decoder = chunks.ChunkDecoder(store)
+    out = b''.join(decoder.decompress(stream[offset:offset + 100])
+                   for offset in range(0, len(stream), 100))
+    assert out == edited
+    assert decoder.eof
+
+
+def test_decode_missing_chunk():
+    data = random_bytes(10 * 1024)
+    stream = chunks.encode(data, set(Store(data).chunks))
+    with pytest.raises(chunks.MissingChunk):
+        chunks.ChunkDecoder(Store(b'')).decompress(stream)
+
+
+def test_decode_rejects_wrong_hash():
+    data = random_bytes(10 * 1024)
+    stream = bytearray(chunks.encode(data, set()))
+    stream[-1] ^= 0x01
+    decoder = chunks.ChunkDecoder(Store(b''))
+    with pytest.raises(ValueError):
+        decoder.decompress(bytes(stream))
+    assert not decoder.eof
@@ -0,0 +1,117 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import pytest
+
+import dispatch
+import gatt
+
+DEVICE = '/org/bluez/hci0/dev_00_00_00_00_00_01'
+OTHER_DEVICE = '/org/bluez/hci0/dev_00_00_00_00_00_02'
+
+
+class Chrc(object):
+    """Records its writes in 'calls' as (name, value)."""
+
+    def __init__(self, name, priority, calls):
+        self.name = name
+        self.PRIORITY = priority
+        self.calls = calls
+
+    def WriteValue(self, value, options):
+        self.calls.append((self.name, value))
+        return value
+
+
+class FailingChrc(Chrc):
+
+    def WriteValue(self, value, options):
+        raise gatt.FailedException('no')
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def dispatcher(loop):
+    return dispatch.Dispatcher(bulk_rate=0)
+
+
+def chrcs(calls):
+    return dict((priority, Chrc(priority, priority, calls))
+                for priority in dispatch.CLASSES)
+
+
+def write(dispatcher, chrc, value, device=DEVICE):
+    return dispatcher.submit(chrc.WriteValue, value, {'device': device})
+
+
+def test_client_calls_run_in_order(loop, dispatcher, calls):
+    chrc = chrcs(calls)
+    order = [dispatch.BULK, dispatch.INTERACTIVE, dispatch.BULK,
+             dispatch.INTERACTIVE, dispatch.BULK]
+    replies = [write(dispatcher, chrc[cls], bytes([i]))
+               for i, cls in enumerate(order)]
+    assert calls == []
+    loop.advance()
+    assert calls == [(cls, bytes([i])) for i, cls in enumerate(order)]
+    assert [reply.result for reply in replies] == \
+            [bytes([i]) for i in range(len(order))]
+
+
+def test_clients_keep_their_own_order(loop, dispatcher, calls):
+    chrc = chrcs(calls)
+    for i in range(4):
+        write(dispatcher, chrc[dispatch.BULK], b'a%d' % i)
+        write(dispatcher, chrc[dispatch.INTERACTIVE], b'b%d' % i,
+              OTHER_DEVICE)
+    write(dispatcher, chrc[dispatch.INTERACTIVE], b'a4')
+    loop.advance()
+    values = [value for _, value in calls]
+    assert [v for v in values if v.startswith(b'a')] == \
+            [b'a%d' % i for i in range(5)]
+    assert [v for v in values if v.startswith(b'b')] == \
+            [b'b%d' % i for i in range(4)]
+    # Interactive calls of the other client are not held up by bulk ones.
+    assert values.index(b'b3') < values.index(b'a3')
+
+
+def test_control_runs_on_arrival(loop, dispatcher, calls):
+    chrc = chrcs(calls)
+    reply = write(dispatcher, chrc[dispatch.BULK], b'frame')
+    assert isinstance(reply, gatt.Deferred)
+    assert write(dispatcher, chrc[dispatch.CONTROL], b'\x01') == b'\x01'
+    assert calls == [(dispatch.CONTROL, b'\x01')]
+    loop.advance()
+    assert calls[1:] == [(dispatch.BULK, b'frame')]
+    assert reply.done
+
+
+def test_control_passes_throttled_bulk(loop, calls):
+    dispatcher = dispatch.Dispatcher(bulk_rate=1000, bulk_burst=50)
+    chrc = chrcs(calls)
+    for i in range(3):
+        write(dispatcher, chrc[dispatch.BULK], bytes(100))
+    loop.advance()
+    assert len(calls) == 1
+    write(dispatcher, chrc[dispatch.CONTROL], b'\x01')
+    assert calls[-1] == (dispatch.CONTROL, b'\x01')
+    assert dispatcher.stats()['queued_bulk'] == 2
+
+
+def test_unfair_runs_on_arrival(dispatcher, calls):
+    dispatcher.fair = False
+    chrc = chrcs(calls)
+    assert write(dispatcher, chrc[dispatch.BULK], b'frame') == b'frame'
+    assert calls == [(dispatch.BULK, b'frame')]
+
+
+def test_failed_call_rejects_its_reply(loop, dispatcher, calls):
+    chrc = chrcs(calls)
+    reply = write(dispatcher, FailingChrc('failing', dispatch.BULK, calls),
+                  b'frame')
+    after = write(dispatcher, chrc[dispatch.INTERACTIVE], b'next')
+    loop.advance()
+    assert isinstance(reply.error, gatt.FailedException)
+    assert after.result == b'next'
@@ -0,0 +1,140 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import pytest
+
+import reassembly
+from reassembly import BudgetError, OffsetError
+
+PATH = '/org/bluez/example/service0/char0'
+OTHER_PATH = '/org/bluez/example/service0/char1'
+DEVICE = '/org/bluez/hci0/dev_00_00_00_00_00_01'
+OTHER_DEVICE = '/org/bluez/hci0/dev_00_00_00_00_00_02'
+VALUE = bytes(range(200))
+
+
+def prepare(uploads, offset, value, path=PATH, device=DEVICE):
+    return uploads.write(path, value, {'device': device, 'offset': offset,
+                                       'prepare-authorize': True})
+
+
+def execute(uploads, offset, value, path=PATH, device=DEVICE):
+    return uploads.write(path, value, {'device': device, 'offset': offset})
+
+
+def prepare_all(uploads, value, size, path=PATH, device=DEVICE):
+    for offset in range(0, len(value), size):
+        assert prepare(uploads, offset, value[offset:offset + size],
+                       path, device) is None
+
+
+@pytest.fixture
+def uploads(loop):
+    return reassembly.Uploads(budget=256, timeout_ms=1000)
+
+
+def test_plain_write(uploads):
+    assert execute(uploads, 0, b'abc') == b'abc'
+
+
+def test_long_write(uploads):
+    prepare_all(uploads, VALUE, 50)
+    assert uploads.pending(DEVICE) == len(VALUE)
+    for offset in range(0, 150, 50):
+        assert execute(uploads, offset, VALUE[offset:offset + 50]) is None
+    assert execute(uploads, 150, VALUE[150:]) == VALUE
+    assert uploads.pending(DEVICE) == 0
+
+
+def test_prepared_gap(uploads):
+    prepare(uploads, 0, VALUE[:50])
+    with pytest.raises(OffsetError):
+        prepare(uploads, 60, VALUE[60:100])
+    assert uploads.uploads == {}
+    assert uploads.pending(DEVICE) == 0
+
+
+def test_prepared_overlap(uploads):
+    prepare(uploads, 0, VALUE[:50])
+    with pytest.raises(OffsetError):
+        prepare(uploads, 40, VALUE[40:100])
+    assert uploads.uploads == {}
+    assert uploads.pending(DEVICE) == 0
+
+
+def test_prepared_without_start(uploads):
+    with pytest.raises(OffsetError):
+        prepare(uploads, 50, VALUE[50:100])
+
+
+def test_executed_gap(uploads):
+    prepare_all(uploads, VALUE, 50)
+    execute(uploads, 0, VALUE[:50])
+    with pytest.raises(OffsetError):
+        execute(uploads, 100, VALUE[100:150])
+    assert uploads.uploads == {}
+    assert uploads.pending(DEVICE) == 0
+
+
+def test_executed_overlap(uploads):
+    prepare_all(uploads, VALUE, 50)
+    execute(uploads, 0, VALUE[:50])
+    with pytest.raises(OffsetError):
+        execute(uploads, 25, VALUE[25:75])
+
+
+def test_executed_past_prepared(uploads):
+    prepare_all(uploads, VALUE, 50)
+    with pytest.raises(OffsetError):
+        execute(uploads, 0, VALUE + b'x')
+
+
+def test_write_at_offset_without_prepare(uploads):
+    with pytest.raises(OffsetError):
+        execute(uploads, 10, b'abc')
+
+
+def test_new_prepare_restarts(uploads):
+    prepare(uploads, 0, VALUE[:50])
+    prepare_all(uploads, VALUE[:100], 50)
+    assert uploads.pending(DEVICE) == 100
+
+
+def test_budget(uploads):
+    prepare(uploads, 0, bytes(200))
+    with pytest.raises(BudgetError):
+        prepare(uploads, 200, bytes(100))
+    assert uploads.uploads == {}
+    assert uploads.pending(DEVICE) == 0
+
+
+def test_budget_covers_all_attributes(uploads):
+    prepare(uploads, 0, bytes(200))
+    with pytest.raises(BudgetError):
+        prepare(uploads, 0, bytes(100), path=OTHER_PATH)
+    assert uploads.pending(DEVICE) == 200
+
+
+def test_budget_is_per_client(uploads):
+    prepare(uploads, 0, bytes(200))
+    prepare(uploads, 0, bytes(256), device=OTHER_DEVICE)
+    assert uploads.pending(DEVICE) == 200
+    assert uploads.pending(OTHER_DEVICE) == 256
+
+
+def test_idle_upload_is_evicted(loop, uploads):
+    prepare(uploads, 0, VALUE[:50])
+    loop.advance(reassembly.SWEEP_INTERVAL_S * 1000)
+    assert uploads.uploads == {}
+    assert uploads.pending(DEVICE) == 0
+    assert uploads.sweep_id is None
+
+
+def test_active_upload_is_kept(loop):
+    uploads = reassembly.Uploads(timeout_ms=8000)
+    prepare(uploads, 0, VALUE[:50])
+    loop.advance(reassembly.SWEEP_INTERVAL_S * 1000)
+    prepare(uploads, 50, VALUE[50:100])
+    loop.advance(reassembly.SWEEP_INTERVAL_S * 1000)
+    assert uploads.pending(DEVICE) == 100
+    loop.advance(reassembly.SWEEP_INTERVAL_S * 1000)
+    assert uploads.pending(DEVICE) == 0
@@ -0,0 +1,166 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import os
+import zlib
+
+import pytest
+
+from storage import Storage
+import transfer
+from transfer import (ERR_CRC, ERR_FRAME, ERR_NONE, ERR_OFFSET, ERR_SIZE,
+                      OP_COMMIT, OP_DATA, OP_OPEN, OPEN_OVERWRITE,
+                      UploadError, upload_frame)
+
+DEVICE = '/org/bluez/hci0/dev_00_00_00_00_00_01'
+DATA = bytes(range(256)) * 8
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return Storage(str(tmp_path))
+
+
+@pytest.fixture
+def receiver(loop, storage):
+    return transfer.UploadReceiver(storage, timeout_ms=1000)
+
+
+def open_frame(path, tid=1):
+    return upload_frame(OP_OPEN, tid, 0, bytes([OPEN_OVERWRITE]) +
+                        path.encode('utf-8'))
+
+
+def status(receiver):
+    """(transfer id, offset, error, written) the client reads back."""
+    return transfer.STATUS_FORMAT.unpack(receiver.get_status(DEVICE))[2:]
+
+
+def partial_files(storage):
+    return [name for name in os.listdir(storage.root)
+            if name.endswith('.part')]
+
+
+def test_parse_returns_fields():
+    frame = upload_frame(OP_DATA, 7, 100, b'abc')
+    opcode, tid, offset, crc, payload = transfer.parse_upload_frame(frame)
+    assert (opcode, tid, offset, crc) == (OP_DATA, 7, 100, zlib.crc32(b'abc'))
+    assert bytes(payload) == b'abc'
+
+
+def test_parse_rejects_bad_crc():
+    frame = upload_frame(OP_DATA, 1, 0, b'abc', crc=zlib.crc32(b'abd'))
+    with pytest.raises(UploadError) as e:
+        transfer.parse_upload_frame(frame)
+    assert e.value.code == ERR_CRC
+
+
+def test_parse_rejects_corrupted_payload():
+    frame = bytearray(upload_frame(OP_DATA, 1, 0, b'abc'))
+    frame[-1] ^= 0x01
+    with pytest.raises(UploadError) as e:
+        transfer.parse_upload_frame(bytes(frame))
+    assert e.value.code == ERR_CRC
+
+
+def test_parse_rejects_short_frame():
+    frame = upload_frame(OP_DATA, 1, 0, b'abc')
+    with pytest.raises(UploadError) as e:
+        transfer.parse_upload_frame(frame[:transfer.UPLOAD_HEADER.size - 1])
+    assert e.value.code == ERR_FRAME
+
+
+def test_parse_rejects_truncated_payload():
+    frame = upload_frame(OP_DATA, 1, 0, b'abc')
+    with pytest.raises(UploadError) as e:
+        transfer.parse_upload_frame(frame[:-1])
+    assert e.value.code == ERR_FRAME
+
+
+def test_commit_crc_is_not_checked_against_payload():
+    # A commit's CRC is that of the whole file, and its payload is empty.
+    frame = upload_frame(OP_COMMIT, 1, len(DATA), crc=zlib.crc32(DATA))
+    assert transfer.parse_upload_frame(frame)[3] == zlib.crc32(DATA)
+
+
+def test_upload(receiver, storage):
+    receiver.handle(open_frame('a.bin'), DEVICE)
+    receiver.handle(upload_frame(OP_DATA, 1, 0, DATA[:1000]), DEVICE)
+    receiver.handle(upload_frame(OP_DATA, 1, 1000, DATA[1000:]), DEVICE)
+    receiver.handle(upload_frame(OP_COMMIT, 1, len(DATA),
+                                 crc=zlib.crc32(DATA)), DEVICE)
+    with open(os.path.join(storage.root, 'a.bin'), 'rb') as f:
+        assert f.read() == DATA
+    assert status(receiver) == (1, len(DATA), ERR_NONE, len(DATA))
+    assert partial_files(storage) == []
+
+
+def test_bad_crc_is_reported_and_upload_kept(receiver):
+    receiver.handle(open_frame('a.bin'), DEVICE)
+    receiver.handle(upload_frame(OP_DATA, 1, 0, DATA[:100]), DEVICE)
+    with pytest.raises(UploadError):
+        receiver.handle(upload_frame(OP_DATA, 1, 100, DATA[100:200],
+                                     crc=0), DEVICE)
+    assert status(receiver) == (1, 100, ERR_CRC, 100)
+    # The client sends the frame again.
+    receiver.handle(upload_frame(OP_DATA, 1, 100, DATA[100:200]), DEVICE)
+    assert status(receiver) == (1, 200, ERR_NONE, 200)
+
+
+def test_gap_is_rejected(receiver):
+    receiver.handle(open_frame('a.bin'), DEVICE)
+    receiver.handle(upload_frame(OP_DATA, 1, 0, DATA[:100]), DEVICE)
+    with pytest.raises(UploadError) as e:
+        receiver.handle(upload_frame(OP_DATA, 1, 200, DATA[200:300]), DEVICE)
+    assert e.value.code == ERR_OFFSET
+    assert status(receiver) == (1, 100, ERR_OFFSET, 100)
+
+
+def test_overlap_is_rejected(receiver):
+    receiver.handle(open_frame('a.bin'), DEVICE)
+    receiver.handle(upload_frame(OP_DATA, 1, 0, DATA[:100]), DEVICE)
+    with pytest.raises(UploadError) as e:
+        receiver.handle(upload_frame(OP_DATA, 1, 50, DATA[50:150]), DEVICE)
+    assert e.value.code == ERR_OFFSET
+
+
+def test_resent_frame_is_ignored(receiver, storage):
+    receiver.handle(open_frame('a.bin'), DEVICE)
+    receiver.handle(upload_frame(OP_DATA, 1, 0, DATA[:100]), DEVICE)
+    receiver.handle(upload_frame(OP_DATA, 1, 100, DATA[100:]), DEVICE)
+    receiver.handle(upload_frame(OP_DATA, 1, 100, DATA[100:]), DEVICE)
+    receiver.handle(upload_frame(OP_COMMIT, 1, len(DATA),
+                                 crc=zlib.crc32(DATA)), DEVICE)
+    with open(os.path.join(storage.root, 'a.bin'), 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_bad_commit_removes_partial_file(receiver, storage):
+    receiver.handle(open_frame('a.bin'), DEVICE)
+    receiver.handle(upload_frame(OP_DATA, 1, 0, DATA[:100]), DEVICE)
+    with pytest.raises(UploadError) as e:
+        receiver.handle(upload_frame(OP_COMMIT, 1, len(DATA),
+                                     crc=zlib.crc32(DATA)), DEVICE)
+    assert e.value.code == ERR_SIZE
+    assert not os.path.exists(os.path.join(storage.root, 'a.bin'))
+    assert partial_files(storage) == []
+
+
+def test_idle_upload_is_aborted(loop, receiver, storage):
+    receiver.handle(open_frame('a.bin'), DEVICE)
+    receiver.handle(upload_frame(OP_DATA, 1, 0, DATA[:100]), DEVICE)
+    assert partial_files(storage)
+    loop.advance(transfer.UPLOAD_SWEEP_S * 1000)
+    assert receiver.uploads == {}
+    assert partial_files(storage) == []
+    with pytest.raises(UploadError) as e:
+        receiver.handle(upload_frame(OP_DATA, 1, 100, DATA[100:200]), DEVICE)
+    assert e.value.code == transfer.ERR_TRANSFER
+
+
+def test_active_upload_is_kept(loop, storage):
+    receiver = transfer.UploadReceiver(storage, timeout_ms=15000)
+    receiver.handle(open_frame('a.bin'), DEVICE)
+    loop.advance(transfer.UPLOAD_SWEEP_S * 1000)
+    receiver.handle(upload_frame(OP_DATA, 1, 0, DATA[:100]), DEVICE)
+    loop.advance(transfer.UPLOAD_SWEEP_S * 1000)
+    assert list(receiver.uploads) == [(DEVICE, 1)]